@@ -1,8 +1,11 @@
 from pathlib import Path
+import json
 import pprint
 import numpy as np
 import matplotlib.pyplot as plt
-from core_utils import read_results, Result
+from core_utils import (read_results, Result, calculate_l1_norm,
+                        solve_sketches_from_json_data)
+from adjacent_api import L1Method
 
 FIGURE_PATH = "/home/nathan/Uni-Stuff/CG/Abschlussarbeit/latex/figures/pgf/dataplots/"
 
@@ -63,6 +66,42 @@ def find_not_converged_results(path: Path, remove_files: bool = False):
             file.unlink()
 
 
+def compare_irls_with_glop(path: Path, tolerance: float = 1e-4):
+    """Re-solve the L1 results with IRLS and compare them to the GLOP ones."""
+    same_points = 0
+    smaller_norm = 0
+    norm_ratios = []
+    files = list(path.glob("**/*.json"))
+    all_irls_results = solve_sketches_from_json_data(files, L1Method.IRLS)
+    for file, irls_results in zip(files, all_irls_results):
+        with open(file, "r", encoding="utf8") as f:
+            points_data = json.load(f)["points"]
+
+        deviation = 0.0
+        irls_norm = 0.0
+        glop_norm = 0.0
+        for key, point_data in points_data.items():
+            original = point_data[Result.ORIGINAL.name]
+            glop = point_data[Result.L1.name]
+            irls = irls_results[key]
+            deviation = max(deviation, abs(glop["x"] - irls["x"]),
+                            abs(glop["y"] - irls["y"]))
+            irls_norm += calculate_l1_norm(original, irls)
+            glop_norm += calculate_l1_norm(original, glop)
+
+        if deviation < tolerance:
+            same_points += 1
+        if irls_norm <= glop_norm + tolerance:
+            smaller_norm += 1
+        norm_ratios.append(irls_norm / max(glop_norm, tolerance))
+
+    print(f"Compared {len(files)} results.")
+    print(f"Same points as GLOP: {same_points}")
+    print(f"l1 norm not larger than GLOP: {smaller_norm}")
+    print("l1 norm ratio IRLS / GLOP (median, 95%, max): "
+          f"{np.percentile(norm_ratios, [50, 95, 100])}")
+
+
 def two_boxplots(paths: list[Path],
                  xticklabels: list[str],
                  key: str,
@@ -210,23 +210,25 @@ def export_entities_to_dict(
         lines: dict[str, Line] = None,
         points: dict[str, Point] = None,
         data: dict[str, dict] = None,
-        result: Result = Result.ORIGINAL) -> dict[str, dict]:
-    """Export Adjacent's Line entity to a dictionary."""
+        result: Result = Result.ORIGINAL,
+        s: Sketch = None) -> dict[str, dict]:
+    """Export Adjacent's Line entity to a dictionary (read at once if the sketch is given)."""
     new_data = {}
     if data:
         new_data = data
     if lines:
         if "lines" not in new_data.keys():
             new_data["lines"] = {}
+        ends = {}
+        for key in lines.keys():
+            ends[(key, "source")] = lines[key].source()
+            ends[(key, "target")] = lines[key].target()
+        ends = get_point_coordinates(ends, s)
         for key in lines.keys():
             source = {}
-            source_values = lines[key].source().eval()
-            source["x"] = source_values[0]
-            source["y"] = source_values[1]
+            source["x"], source["y"] = ends[(key, "source")]
             target = {}
-            target_values = lines[key].target().eval()
-            target["x"] = target_values[0]
-            target["y"] = target_values[1]
+            target["x"], target["y"] = ends[(key, "target")]
 
             if key not in new_data["lines"].keys():
                 new_data["lines"][key] = {}
@@ -240,11 +242,10 @@ def export_entities_to_dict(
     if points:
         if "points" not in new_data.keys():
             new_data["points"] = {}
+        coords = get_point_coordinates(points, s)
         for key in points.keys():
             pnt = {}
-            pnt_values = points[key].eval()
-            pnt["x"] = pnt_values[0]
-            pnt["y"] = pnt_values[1]
+            pnt["x"], pnt["y"] = coords[key]
 
             if key not in new_data["points"].keys():
                 new_data["points"][key] = {}
@@ -391,6 +392,89 @@ def read_sketch_from_json_data(
         return (points, lines, constraint_dict, move_dict)
 
 
+def build_sketch_from_json_data(
+        file_path: Path,
+        l1_method: L1Method = L1Method.GLOP) -> tuple[Sketch, dict[str, Point]]:
+    """Builds the sketch of a json file in L1 mode with the given method."""
+    points_dict, lines_dict, constraint_dict, move_dict = \
+        read_sketch_from_json_data(file_path)
+    points = {}
+    for key in points_dict.keys():
+        points[key] = point(key, points_dict[key])
+
+    lines = {}
+    for key in lines_dict.keys():
+        source = points[lines_dict[key][0]]
+        target = points[lines_dict[key][1]]
+        lines[key] = Line(source, target)
+
+    s = Sketch()
+    for line in lines.values():
+        s.add_entity(line)
+
+    for constraint in create_constraints(lines, points, constraint_dict):
+        s.add_constraint(constraint)
+
+    s.use_linear_program(True)
+    s.set_l1_method(l1_method)
+
+    for key in move_dict.keys():
+        new_point = point(key, move_dict[key]["values"])
+        old_point = points[move_dict[key]["point"]]
+        s.add_expressionVector(old_point.drag_to(new_point.expr()))
+
+    return s, points
+
+
+def point_indices(points: list[Point], s: Sketch) -> np.ndarray:
+    """Indices of the x and y values of the points in s.values(), -1 if not in the sketch."""
+    return np.array([[s.param_index(p.x()), s.param_index(p.y())] for p in points],
+                    dtype=np.int64).reshape(-1, 2)
+
+
+def get_point_coordinates(points: dict, s: Sketch = None) -> dict:
+    """Reads the x and y coordinates of the points (all at once if the sketch is given)."""
+    if s is None:
+        return {key: tuple(points[key].eval()[:2]) for key in points.keys()}
+
+    indices = point_indices(list(points.values()), s)
+    xy = s.values()[np.maximum(indices, 0)]
+    coords = {}
+    for i, key in enumerate(points.keys()):
+        if indices[i].min() < 0:
+            coords[key] = tuple(points[key].eval()[:2])
+        else:
+            coords[key] = (float(xy[i, 0]), float(xy[i, 1]))
+
+    return coords
+
+
+def get_point_results(points: dict[str, Point],
+                      s: Sketch = None) -> dict[str, dict[str, float]]:
+    """Reads the x and y coordinates of the points (all at once if the sketch is given)."""
+    coords = get_point_coordinates(points, s)
+    return {key: {"x": x, "y": y} for key, (x, y) in coords.items()}
+
+
+def solve_sketch_from_json_data(
+        file_path: Path,
+        l1_method: L1Method = L1Method.GLOP) -> dict[str, dict[str, float]]:
+    """Solves the sketch of a json file in L1 mode with the given method."""
+    s, points = build_sketch_from_json_data(file_path, l1_method)
+    s.update()
+    return get_point_results(points, s)
+
+
+def solve_sketches_from_json_data(
+        file_paths: list[Path],
+        l1_method: L1Method = L1Method.GLOP,
+        threads: int = 0) -> list[dict[str, dict[str, float]]]:
+    """Solves the sketches of several json files at once on `threads` threads."""
+    sketches = [build_sketch_from_json_data(path, l1_method) for path in file_paths]
+    solve_many([s for s, _ in sketches], threads)
+    return [get_point_results(points, s) for s, points in sketches]
+
+
 def read_results(file_path: Path) -> dict[str, dict]:
     """Read the results in to a dictionary."""
     with open(file_path, "r", encoding="utf8") as file:
@@ -597,7 +681,8 @@ def create_and_solve_sketch(lines_dict: dict[str, list[str]],
 
         json_data = export_entities_to_dict(points=points,
                                             data=json_data,
-                                            result=result)
+                                            result=result,
+                                            s=s)
 
     json_data = add_comparison_data(json_data)
     json_data["Results"]["time"] = {}
@@ -0,0 +1,189 @@
+"""Behavior tests of the Python interface, run with pytest from this directory."""
+import gc
+import numpy as np
+import pytest
+from adjacent_api import *
+from core_utils import point, get_point_results, export_entities_to_dict, Result
+
+
+def test_point_results_with_duplicate_names():
+    # parameter names are not unique, the results are read by index
+    a = point("p", (0, 0))
+    b = point("p", (3, 1))
+    free = point("p", (5, 5))
+    line = Line(a, b)
+    s = Sketch()
+    s.add_entity(line)
+    s.add_constraint(constraints.Length(line, 2.0))
+    s.update()
+    points = {"a": a, "b": b, "free": free}
+    results = get_point_results(points, s)
+    assert results == get_point_results(points)
+    assert results["free"] == {"x": 5.0, "y": 5.0}
+    assert np.hypot(results["b"]["x"] - results["a"]["x"],
+                    results["b"]["y"] - results["a"]["y"]) == pytest.approx(2.0)
+
+    data = export_entities_to_dict(lines={"l": line}, points=points,
+                                   result=Result.L2, s=s)
+    assert data["points"]["b"][Result.L2.name] == results["b"]
+    assert data["lines"]["l"]["points"]["target"][Result.L2.name] == results["b"]
+
+
+def rectangle_from_arrays(corners: np.ndarray) -> tuple[Sketch, np.ndarray]:
+    """A rectangle of width 4 and height 2 built with the array builders."""
+    s = Sketch()
+    pts = s.add_points(corners)
+    lines = s.add_lines(pts[[[0, 1], [1, 2], [2, 3], [3, 0]]])
+    s.add_constraints(constraints.Length, lines[:2], np.array([4.0, 2.0]))
+    s.add_constraints(constraints.Orthogonal, lines.reshape(2, 2))
+    s.add_constraints("Orthogonal", lines[[1, 2]].reshape(1, 2))
+    return s, pts
+
+
+def test_array_builders():
+    corners = np.array([[0.0, 0.0], [3.0, 0.5], [3.5, 2.5], [0.5, 2.0]])
+    s, pts = rectangle_from_arrays(corners)
+    assert list(pts) == [0, 1, 2, 3]
+    s.update()
+    assert s.get_result() == SolveResult.OKAY
+    xy = np.array([s.entity(h).eval()[:2] for h in pts])
+    assert np.linalg.norm(xy[1] - xy[0]) == pytest.approx(4.0)
+    assert np.linalg.norm(xy[2] - xy[1]) == pytest.approx(2.0)
+    assert np.dot(xy[1] - xy[0], xy[2] - xy[1]) == pytest.approx(0.0, abs=1e-9)
+    assert np.dot(xy[3] - xy[2], xy[0] - xy[3]) == pytest.approx(0.0, abs=1e-9)
+
+    # the same sketch built from objects solves the same way
+    points = [point(f"p{i}", c) for i, c in enumerate(corners)]
+    lines = [Line(points[i], points[(i + 1) % 4]) for i in range(4)]
+    t = Sketch()
+    for line in lines:
+        t.add_entity(line)
+    t.add_constraint(constraints.Length(lines[0], 4.0))
+    t.add_constraint(constraints.Length(lines[1], 2.0))
+    t.add_constraint(constraints.Orthogonal(lines[0], lines[1]))
+    t.add_constraint(constraints.Orthogonal(lines[2], lines[3]))
+    t.add_constraint(constraints.Orthogonal(lines[1], lines[2]))
+    t.update()
+    assert np.allclose([p.eval()[:2] for p in points], xy, atol=1e-9)
+
+    circles = s.add_circles(pts[:2], np.array([1.0, 2.0]))
+    assert list(circles) == [8, 9]
+    s.add_constraints(constraints.Diameter, circles[:1].reshape(1, 1), np.array([3.0]))
+    s.update()
+    assert s.get_result() == SolveResult.OKAY
+
+
+def test_array_builders_reject_invalid_handles():
+    s = Sketch()
+    pts = s.add_points(np.zeros((2, 2)))
+    with pytest.raises(ValueError):
+        s.add_lines(np.array([[0, 2]]))
+    with pytest.raises(ValueError):
+        s.add_constraints(constraints.Length, np.array([[-1]]), np.array([1.0]))
+    with pytest.raises(ValueError):
+        s.entity(5)
+    with pytest.raises(ValueError):
+        s.add_points(np.zeros(4))
+    # nothing was added by the failed calls
+    lines = s.add_lines(pts.reshape(1, 2))
+    assert list(lines) == [2]
+    assert len(s.param_names()) == 4
+
+
+def test_removed_entity_handle():
+    s = Sketch()
+    pts = s.add_points(np.array([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0]]))
+    lines = s.add_lines(pts[[[0, 1], [1, 2]]])
+    s.remove_entity(s.entity(lines[0]))
+    with pytest.raises(ValueError, match=f"invalid entity handle {lines[0]}"):
+        s.entity(lines[0])
+    with pytest.raises(ValueError):
+        s.add_constraints(constraints.Length, lines[:1].reshape(1, 1), np.array([1.0]))
+    with pytest.raises(ValueError):
+        s.param_indices(lines)
+    s.add_constraints(constraints.Length, lines[1:].reshape(1, 1), np.array([2.0]))
+    s.update()
+    assert s.get_result() == SolveResult.OKAY
+
+
+def test_array_builders_reject_invalid_entities():
+    s = Sketch()
+    pts = s.add_points(np.array([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0]]))
+    lines = s.add_lines(pts[[[0, 1], [1, 2]]])
+    # a line where a point is expected, and points where lines are expected
+    with pytest.raises(ValueError, match="wrong entity type"):
+        s.add_lines(np.array([[0, lines[0]]]))
+    with pytest.raises(ValueError, match="wrong entity type"):
+        s.add_constraints(constraints.Orthogonal, pts[:2].reshape(1, 2))
+    with pytest.raises(ValueError, match="wrong number of entities"):
+        s.add_constraints(constraints.Orthogonal, pts.reshape(1, 3))
+    with pytest.raises(ValueError, match="wrong number of entities"):
+        s.add_constraints(constraints.Length, lines.reshape(1, 2), np.array([1.0]))
+    with pytest.raises(ValueError, match="invalid HVOrientation"):
+        s.add_constraints(constraints.HV, lines[:1].reshape(1, 1), np.array([2.0]))
+    with pytest.raises(ValueError, match="invalid HVOrientation"):
+        s.add_constraints(constraints.HV, lines[:1].reshape(1, 1), np.array([0.5]))
+    s.add_constraints(constraints.HV, lines[1:].reshape(1, 1), np.array([1.0]))
+    s.update()
+    assert s.get_result() == SolveResult.OKAY
+    p1, p2 = s.entity(pts[1]).eval(), s.entity(pts[2]).eval()
+    assert p1[1] == pytest.approx(p2[1])
+
+
+def test_values_view():
+    corners = np.array([[0.0, 0.0], [3.0, 0.5], [3.5, 2.5], [0.5, 2.0]])
+    s, pts = rectangle_from_arrays(corners)
+    v = s.values()
+    idx = s.param_indices(pts)
+    assert idx.shape == (4, 2)
+    assert np.array_equal(v[idx], corners)
+    assert [s.param_names()[i] for i in idx[1]] == ["p1_x", "p1_y"]
+
+    # written values are the start of the solve, the results show up in the same view
+    v[idx[0]] = [1.0, 1.0]
+    s.update()
+    assert s.entity(pts[0]).eval()[:2] == pytest.approx(list(v[idx[0]]))
+    assert np.linalg.norm(v[idx[1]] - v[idx[0]]) == pytest.approx(4.0)
+
+    p = s.entity(pts[2])
+    assert s.param_index(p.x()) == idx[2, 0]
+    assert s.param_index(Param("other", 0.0)) == -1
+
+
+def test_values_view_lifetime():
+    s, pts = rectangle_from_arrays(np.array([[0.0, 0.0], [3.0, 0.0], [3.0, 2.0], [0.0, 2.0]]))
+    old = s.values()
+    size = len(old)
+    # adopting parameters while a view is alive moves the values to a new block, the old view
+    # stays readable but no longer follows the sketch
+    more = s.add_points(np.array([[7.0, 7.0]]))
+    new = s.values()
+    assert len(new) == size + 2
+    assert len(old) == size
+    new[s.param_indices(more)[0]] = [8.0, 9.0]
+    assert np.array_equal(old, new[:size])
+    old[0] = 100.0
+    assert new[0] != 100.0
+
+    # a view keeps the values alive after its sketch is gone
+    del s
+    gc.collect()
+    assert new[size] == 8.0
+
+
+def test_solve_many():
+    rng = np.random.default_rng(1)
+    starts = [np.array([[0.0, 0.0], [3.0, 0.5], [3.5, 2.5], [0.5, 2.0]])
+              + rng.uniform(-0.2, 0.2, (4, 2)) for _ in range(8)]
+    for threads in [0, 1, 3]:
+        batch = [rectangle_from_arrays(c) for c in starts]
+        single = [rectangle_from_arrays(c) for c in starts]
+        stats = solve_many([s for s, _ in batch], threads)
+        assert len(stats) == len(batch)
+        for (s, pts), (t, _), st in zip(batch, single, stats):
+            steps = t.update()
+            assert st.result == s.get_result() == SolveResult.OKAY
+            assert st.steps == steps
+            assert st.time >= 0.0
+            assert np.allclose(s.values(), t.values(), rtol=0.0, atol=1e-12)
+    assert solve_many([]) == []
@@ -1,8 +1,15 @@
 #include <set>
+#include <map>
+#include <unordered_map>
+#include <unordered_set>
+#include <chrono>
+#include <cstdint>
+#include <stdexcept>
 
 #include "entity.hpp"
 #include "expression.hpp"
 #include "equation_system.hpp"
+#include "thread_pool.hpp"
 
 #ifndef ADJACENT_CONSTRAINT_HPP
 #define ADJACENT_CONSTRAINT_HPP
@@ -76,7 +83,7 @@ public:
         sys.revert_when_not_converged = false;
         sys.add_parameter(value);
         sys.add_equations(equations());
-        return sys.solve() == SolveResult::OKAY;
+        return sys.solve() != SolveResult::DIDNT_CONVERGE;
     }
 
     bool satisfy()
@@ -817,9 +824,125 @@ public:
     }
 };
 
+template <class T>
+std::shared_ptr<T> entity_cast(const EntityPtr& e)
+{
+    auto res = std::dynamic_pointer_cast<T>(e);
+    if (res == nullptr)
+        throw std::invalid_argument("wrong entity type for constraint");
+    return res;
+}
+
+// constraint of `type` on `e`, with the entities in the order of the constructors above.
+// `value` is the length, distance, angle, diameter or factor of the value constraints and the
+// HVOrientation of HV, it's unused for the others. Entities and values that don't fit the type
+// throw std::invalid_argument.
+inline ConstraintPtr make_constraint(CONSTRAINT_TYPE type, const std::vector<EntityPtr>& e,
+                                     double value)
+{
+    auto expect = [&](std::size_t n) {
+        if (e.size() != n)
+            throw std::invalid_argument("wrong number of entities for constraint");
+    };
+    switch (type)
+    {
+        case PointOn:
+            expect(2);
+            return std::make_shared<PointOnConstraint>(entity_cast<PointE>(e[0]), e[1]);
+        case PointsCoincident:
+        {
+            expect(2);
+            auto p0 = entity_cast<PointE>(e[0]);
+            auto p1 = entity_cast<PointE>(e[1]);
+            return std::make_shared<PointsCoincidentConstraint>(p0, p1);
+        }
+        case PointCenterTriangle:
+        {
+            expect(4);
+            auto p0 = entity_cast<PointE>(e[0]);
+            auto p1 = entity_cast<PointE>(e[1]);
+            auto p2 = entity_cast<PointE>(e[2]);
+            auto c = entity_cast<PointE>(e[3]);
+            return std::make_shared<PointCenterTriangleConstraint>(p0, p1, p2, c);
+        }
+        case MidPoint:
+            expect(3);
+            return std::make_shared<MidPointConstraint>(
+                entity_cast<PointE>(e[0]), entity_cast<PointE>(e[1]), entity_cast<PointE>(e[2]));
+        case Parallel:
+        {
+            expect(2);
+            auto l0 = entity_cast<LineE>(e[0]);
+            auto l1 = entity_cast<LineE>(e[1]);
+            return std::make_shared<ParallelConstraint>(l0, l1);
+        }
+        case Orthogonal:
+        {
+            expect(2);
+            auto l0 = entity_cast<LineE>(e[0]);
+            auto l1 = entity_cast<LineE>(e[1]);
+            return std::make_shared<OrthogonalConstraint>(l0, l1);
+        }
+        case Length:
+            expect(1);
+            return std::make_shared<LengthConstraint>(e[0], value);
+        case PointsDistance:
+            if (e.size() == 1)
+                return std::make_shared<PointsDistanceConstraint>(entity_cast<LineE>(e[0]), value);
+            expect(2);
+            return std::make_shared<PointsDistanceConstraint>(
+                entity_cast<PointE>(e[0]), entity_cast<PointE>(e[1]), value);
+        case HV:
+        {
+            if (value != OX && value != OY)
+                throw std::invalid_argument("invalid HVOrientation " + std::to_string(value));
+            auto orientation = (HVOrientation) value;
+            if (e.size() == 1)
+                return std::make_shared<HVConstraint>(entity_cast<LineE>(e[0]), orientation);
+            expect(2);
+            return std::make_shared<HVConstraint>(entity_cast<PointE>(e[0]),
+                                                  entity_cast<PointE>(e[1]), orientation);
+        }
+        case Angle:
+        {
+            expect(2);
+            auto l0 = entity_cast<LineE>(e[0]);
+            auto l1 = entity_cast<LineE>(e[1]);
+            return std::make_shared<AngleConstraint>(l0, l1, value);
+        }
+        case Diameter:
+        {
+            expect(1);
+            EntityPtr c = e[0];
+            return std::make_shared<DiameterConstraint>(c, value);
+        }
+        case Tangent:
+        {
+            expect(2);
+            auto c = entity_cast<CircleE>(e[0]);
+            auto l = entity_cast<LineE>(e[1]);
+            return std::make_shared<TangentConstraint>(c, l);
+        }
+        case Equal:
+            expect(2);
+            return std::make_shared<EqualConstraint>(
+                entity_cast<LineE>(e[0]), entity_cast<LineE>(e[1]), value);
+    }
+    throw std::invalid_argument("unhandled constraint type");
+}
+
+// Sketches don't share any mutable state, so different sketches can be updated from different
+// threads at the same time. The expression constants (zero, one, ...) are shared, but never
+// modified after static initialization, the expression arena is per sketch and only current on
+// the thread updating it, and the shared thread pool is synchronized. A sketch itself, and the
+// parameters, entities and constraints added to it, must only be used by one thread at a time,
+// i.e. they can't be part of two sketches that are updated concurrently.
 class Sketch
 {
 public:
+    // values of the parameters of this sketch, declared first so it outlives all of them
+    ParamStore store;
+
     bool constraintsTopologyChanged = true;
     bool constraintsChanged = true;
     bool entitiesChanged = true;
@@ -827,16 +950,27 @@ public:
     bool topologyChanged = true;
     bool supressSolve;
     EquationSystem sys;
+    // shares identical subexpressions between the equations and derivatives of this sketch
+    ExprArena arena;
 
     std::set<EntityPtr> entities;
     std::set<ExprPtr> expressions;
     std::set<ConstraintPtr> constraints;
+    // equations of every constraint already in sys, so unchanged constraints keep their equations
+    std::map<ConstraintPtr, std::vector<ExprPtr>> constraint_equations;
+    // result of the last update
+    SolveResult result = OKAY;
+    // entities created by the array builders, a handle is the index into this. The handle of a
+    // removed entity is cleared, the others keep theirs.
+    std::vector<EntityPtr> handles;
+    std::unordered_map<const Entity*, std::size_t> handle_index;
 
     void add_entity(const EntityPtr& e)
     {
         if (entities.find(e) != entities.end())
             return;
         entities.insert(e);
+        adopt(e->parameters());
         mark_dirty(/*topo*/ true, /*constraints*/ false, /*entities*/ true, /*loops*/ false);
     }
 
@@ -845,7 +979,146 @@ public:
         if (entities.find(e) == entities.end())
             return;
         entities.erase(e);
+        auto it = handle_index.find(e.get());
+        if (it != handle_index.end())
+        {
+            handles[it->second] = nullptr;
+            handle_index.erase(it);
+        }
+        mark_dirty(/*topo*/ true, /*constraints*/ false, /*entities*/ true, /*loops*/ false);
+    }
+
+    EntityPtr entity(std::int64_t handle) const
+    {
+        check_handles(&handle, 1);
+        return handles[handle];
+    }
+
+    // throws std::invalid_argument for the first of the n handles that wasn't returned by the
+    // array builders, or whose entity was removed
+    void check_handles(const std::int64_t* h, std::size_t n) const
+    {
+        for (std::size_t i = 0; i < n; i++)
+        {
+            if (h[i] < 0 || (std::size_t) h[i] >= handles.size() || handles[h[i]] == nullptr)
+                throw std::invalid_argument("invalid entity handle " + std::to_string(h[i]));
+        }
+    }
+
+    // adds a point for each row of the n x dim (2 or 3) row major array `coords` and returns the
+    // handle of the first one, the handles of the others follow consecutively
+    std::size_t add_points(const double* coords, std::size_t n, std::size_t dim)
+    {
+        if (dim != 2 && dim != 3)
+            throw std::invalid_argument("points need 2 or 3 coordinates");
+        std::size_t first = handles.size();
+        handles.reserve(first + n);
+        handle_index.reserve(first + n);
+        for (std::size_t i = 0; i < n; i++)
+        {
+            const double* c = coords + i * dim;
+            std::string name = "p" + std::to_string(first + i);
+            auto p = std::make_shared<PointE>(param(name + "_x", c[0]),
+                                              param(name + "_y", c[1]),
+                                              param(name + "_z", dim == 3 ? c[2] : 0.0));
+            handles.push_back(p);
+            handle_index[p.get()] = handles.size() - 1;
+            entities.insert(p);
+            adopt(p->parameters());
+        }
+        mark_dirty(/*topo*/ true, /*constraints*/ false, /*entities*/ true, /*loops*/ false);
+        return first;
+    }
+
+    // adds a line between the points of each pair of handles in `points` (2 * n values),
+    // the lines share the parameters of the points
+    std::size_t add_lines(const std::int64_t* points, std::size_t n)
+    {
+        check_handles(points, 2 * n);
+        std::vector<std::shared_ptr<PointE>> p(2 * n);
+        for (std::size_t i = 0; i < 2 * n; i++)
+        {
+            p[i] = entity_cast<PointE>(handles[points[i]]);
+        }
+        std::size_t first = handles.size();
+        handles.reserve(first + n);
+        handle_index.reserve(first + n);
+        for (std::size_t i = 0; i < n; i++)
+        {
+            auto l = std::make_shared<LineE>(*p[2 * i], *p[2 * i + 1]);
+            handles.push_back(l);
+            handle_index[l.get()] = handles.size() - 1;
+            entities.insert(l);
+        }
         mark_dirty(/*topo*/ true, /*constraints*/ false, /*entities*/ true, /*loops*/ false);
+        return first;
+    }
+
+    // adds a circle around each of the point handles `centers` with the given `radii`
+    std::size_t add_circles(const std::int64_t* centers, const double* radii, std::size_t n)
+    {
+        check_handles(centers, n);
+        std::vector<std::shared_ptr<PointE>> c(n);
+        for (std::size_t i = 0; i < n; i++)
+        {
+            c[i] = entity_cast<PointE>(handles[centers[i]]);
+        }
+        std::size_t first = handles.size();
+        handles.reserve(first + n);
+        handle_index.reserve(first + n);
+        for (std::size_t i = 0; i < n; i++)
+        {
+            auto circle = std::make_shared<CircleE>(
+                *c[i], param("c" + std::to_string(first + i) + "_rad", radii[i]));
+            handles.push_back(circle);
+            handle_index[circle.get()] = handles.size() - 1;
+            entities.insert(circle);
+            store.adopt(*circle->_radius);
+        }
+        mark_dirty(/*topo*/ true, /*constraints*/ false, /*entities*/ true, /*loops*/ false);
+        return first;
+    }
+
+    // adds n constraints of `type`, the i-th on the handles entity_handles[i * arity] ...
+    // entity_handles[(i + 1) * arity - 1] with values[i] (see make_constraint). `values` can be
+    // nullptr for the types without a value.
+    void add_constraints(CONSTRAINT_TYPE type, const std::int64_t* entity_handles,
+                         std::size_t n, std::size_t arity, const double* values)
+    {
+        if (values == nullptr
+            && (type == Length || type == PointsDistance || type == Angle || type == Diameter))
+            throw std::invalid_argument("constraint type needs values");
+        check_handles(entity_handles, n * arity);
+        double default_value = type == Equal ? 1.0 : 0.0;
+        // all of them are made first, so nothing is added if one of them can't be
+        std::vector<ConstraintPtr> made(n);
+        std::vector<EntityPtr> e(arity);
+        for (std::size_t i = 0; i < n; i++)
+        {
+            for (std::size_t k = 0; k < arity; k++)
+            {
+                e[k] = handles[entity_handles[i * arity + k]];
+            }
+            made[i] = make_constraint(type, e, values ? values[i] : default_value);
+        }
+        for (const auto& c : made)
+        {
+            add_constraint(c);
+        }
+    }
+
+    void adopt(const std::vector<ParamPtr>& params)
+    {
+        for (const auto& p : params)
+        {
+            store.adopt(*p);
+        }
+    }
+
+    // index of the value of `p` in values(), -1 if it isn't part of this sketch
+    int param_index(const ParamPtr& p) const
+    {
+        return p->m_store == &store ? (int) p->m_index : -1;
     }
 
     void mark_dirty(bool topo, bool constraints, bool entities, bool loops)
@@ -862,6 +1135,7 @@ public:
         if (constraints.find(c) != constraints.end())
             return;
         constraints.insert(c);
+        adopt(c->parameters());
         mark_dirty(/*topo*/ c->type == PointsCoincident,
                    /*constraints*/ true,
                    /*entities*/ false,
@@ -959,18 +1233,110 @@ public:
         sys.use_linear_program = use_lp;
     }
 
+    L1Method get_l1_method() const
+    {
+        return sys.l1_method;
+    }
+
+    void set_l1_method(L1Method method)
+    {
+        sys.l1_method = method;
+    }
+
+    SolveResult get_result() const
+    {
+        return result;
+    }
+
+    // result of each independent component in the last update, empty if the system wasn't split
+    std::vector<SolveResult> get_component_results() const
+    {
+        return sys.component_results;
+    }
+
+    std::vector<ExprPtr> get_redundant_equations() const
+    {
+        return sys.get_redundant_equations();
+    }
+
+    // constraints with an equation that was left out of the last solve as redundant
+    std::vector<ConstraintPtr> get_redundant_constraints() const
+    {
+        auto eqs = sys.get_redundant_equations();
+        std::unordered_set<ExprPtr> redundant(eqs.begin(), eqs.end());
+        std::vector<ConstraintPtr> res;
+        for (const auto& kv : constraint_equations)
+        {
+            for (const auto& e : kv.second)
+            {
+                if (redundant.find(e) == redundant.end())
+                    continue;
+                res.push_back(kv.first);
+                break;
+            }
+        }
+        return res;
+    }
+
+    // rank and degrees of freedom of the constraints at the current values, without solving
+    const DofAnalysis& analyze()
+    {
+        ExprArena::Scope scope(arena);
+        if (is_topology_changed() || constraintsTopologyChanged)
+        {
+            update_equations(sys);
+        }
+        return sys.analyze();
+    }
+
+    int dof()
+    {
+        return analyze().dof;
+    }
+
+    bool is_using_damping() const
+    {
+        return sys.use_damping;
+    }
+
+    void use_damping(bool use_damping)
+    {
+        sys.use_damping = use_damping;
+    }
+
+    bool is_using_quasi_newton() const
+    {
+        return sys.use_quasi_newton;
+    }
+
+    void use_quasi_newton(bool use_quasi_newton)
+    {
+        sys.use_quasi_newton = use_quasi_newton;
+    }
+
+    bool is_using_iterative_solver() const
+    {
+        return sys.use_iterative_solver;
+    }
+
+    void use_iterative_solver(bool use_iterative_solver)
+    {
+        sys.use_iterative_solver = use_iterative_solver;
+    }
+
     int update()
     {
+        ExprArena::Scope scope(arena);
         if (is_constraints_changed() || is_entities_changed())
         {
             supressSolve = false;
         }
         if (is_topology_changed() || constraintsTopologyChanged)
         {
-            sys.clear();
-            generate_equations(sys);
+            update_equations(sys);
         }
         auto res = (!supressSolve || sys.has_dragged()) ? sys.solve() : DIDNT_CONVERGE;
+        result = res;
         if (res == DIDNT_CONVERGE)
         {
             supressSolve = true;
@@ -983,6 +1349,63 @@ public:
         return sys.counted_steps;
     }
 
+    // adds and removes only the equations and parameters that changed since the last update,
+    // so e.g. adding a drag expression doesn't rebuild the whole system
+    void update_equations(EquationSystem& system)
+    {
+        std::vector<ExprPtr> eqs(expressions.begin(), expressions.end());
+        std::vector<ParamPtr> params;
+        for (const auto& en : entities)
+        {
+            auto p = en->parameters();
+            params.insert(params.end(), p.begin(), p.end());
+        }
+        for (auto it = constraint_equations.begin(); it != constraint_equations.end();)
+        {
+            if (constraints.find(it->first) == constraints.end())
+                it = constraint_equations.erase(it);
+            else
+                ++it;
+        }
+        for (const auto& c : constraints)
+        {
+            auto it = constraint_equations.find(c);
+            if (it == constraint_equations.end())
+                it = constraint_equations.emplace(c, c->equations()).first;
+            eqs.insert(eqs.end(), it->second.begin(), it->second.end());
+            auto p = c->parameters();
+            params.insert(params.end(), p.begin(), p.end());
+        }
+
+        adopt(params);
+
+        std::unordered_set<ExprPtr> eq_set(eqs.begin(), eqs.end());
+        std::unordered_set<ParamPtr> param_set(params.begin(), params.end());
+        std::vector<ExprPtr> old_eqs;
+        for (const auto& e : system.source_equations)
+        {
+            if (eq_set.find(e) == eq_set.end())
+                old_eqs.push_back(e);
+        }
+        system.remove_equations(old_eqs);
+        std::vector<ParamPtr> old_params;
+        for (const auto& p : system.parameters)
+        {
+            if (param_set.find(p) == param_set.end())
+                old_params.push_back(p);
+        }
+        system.remove_parameters(old_params);
+
+        std::unordered_set<ExprPtr> existing(system.source_equations.begin(),
+                                             system.source_equations.end());
+        system.add_parameters(params);
+        for (const auto& e : eqs)
+        {
+            if (existing.insert(e).second)
+                system.add_equation(e);
+        }
+    }
+
     void generate_equations(EquationSystem& system)
     {
         for (const auto& e : expressions)
@@ -1002,4 +1425,39 @@ public:
     }
 };
 
+// outcome of one sketch of solve_many
+struct SolveStats
+{
+    SolveResult result = OKAY;
+    int steps = 0;
+    // wall time of the update in seconds
+    double time = 0.0;
+};
+
+// updates independent sketches (see the thread safety notes of Sketch) on `threads` threads,
+// with 0 the shared thread pool is used
+inline std::vector<SolveStats> solve_many(const std::vector<Sketch*>& sketches,
+                                          std::size_t threads = 0)
+{
+    std::vector<SolveStats> stats(sketches.size());
+    auto solve = [&](std::size_t i) {
+        auto start = std::chrono::steady_clock::now();
+        stats[i].steps = sketches[i]->update();
+        stats[i].result = sketches[i]->get_result();
+        stats[i].time
+            = std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+    };
+    if (threads == 0)
+    {
+        ThreadPool::shared().parallel_for(sketches.size(), solve);
+    }
+    else
+    {
+        // the calling thread works on the sketches as well
+        ThreadPool pool(threads - 1);
+        pool.parallel_for(sketches.size(), solve);
+    }
+    return stats;
+}
+
 #endif
@@ -72,7 +72,7 @@ public:
 
     bool is_changed()
     {
-        return x->m_changed || y->m_changed || z->m_changed;
+        return x->is_changed() || y->is_changed() || z->is_changed();
     }
 
     std::vector<ParamPtr> parameters()
@@ -3,12 +3,24 @@
 
 #include <vector>
 #include <unordered_map>
+#include <memory>
 
 #include <xtensor/xtensor.hpp>
+#include <Eigen/Sparse>
+#include <Eigen/SparseCholesky>
+#include <Eigen/Dense>
 #include "expression.hpp"
 #include "expression_vector.hpp"
+#include "expression_tape.hpp"
 #include "gaussian_method.hpp"
 
+namespace operations_research
+{
+    class MPSolver;
+    class MPVariable;
+    class MPConstraint;
+}
+
 enum SolveResult
 {
     OKAY,
@@ -17,7 +29,28 @@ enum SolveResult
     POSTPONE
 };
 
+// how the minimal L1 step of the linear program mode is computed
+enum L1Method
+{
+    GLOP,
+    IRLS
+};
+
+// degrees of freedom of the constraint equations (drag equations are not counted) at the current
+// parameter values
+struct DofAnalysis
+{
+    int rank = 0;
+    int dof = 0;
+    // constraint equations, including the redundant ones
+    int equations = 0;
+    // unknowns that are not determined by the equations, i.e. the columns of the jacobian that are
+    // not pivots of its column pivoted factorization
+    std::vector<std::shared_ptr<Param<double>>> free_params;
+};
+
 using expr_ptr = std::shared_ptr<Expr>;
+using SparseMatrix = Eigen::SparseMatrix<double, Eigen::RowMajor>;
 
 class EquationSystem
 {
@@ -27,41 +60,183 @@ public:
     int drag_steps = 3;
     bool revert_when_not_converged = true;
     bool use_linear_program = false;
+    L1Method l1_method = GLOP;
+    int irls_max_iterations = 50;
+    double irls_tolerance = 1e-9;
+    // Levenberg-Marquardt instead of plain Gauss-Newton steps
+    bool use_damping = false;
+    int max_damping_tries = 10;
+    // chord method: the jacobian is only evaluated and factorized again when a step didn't
+    // reduce the residual by quasi_newton_contraction, the other steps reuse the factorization,
+    // also across solves as long as the structure of the system doesn't change
+    bool use_quasi_newton = false;
+    double quasi_newton_contraction = 0.25;
+    // minimum norm steps by CGLS, which only needs products with the jacobian and its transpose
+    // that are computed from the tape, so A is never evaluated and nothing is factorized (and no
+    // redundant equations are left out). The jacobi preconditioner scales the rows of A to unit
+    // length, which leaves the solution as it is.
+    bool use_iterative_solver = false;
+    double iterative_tolerance = 1e-12;
+    int max_iterative_steps = 1000;
+    bool use_jacobi_preconditioner = false;
+    // systems with at most this many equations take the dense least squares path
+    int max_dense_size = 100;
+    // after substitution, split into independent subsystems that are solved separately
+    bool decompose = true;
+    bool use_substitution = true;
+    // unknowns that are determined by a linear equation are computed from it instead of being
+    // solved for, with eliminate_linear linear equations of several unknowns are solved for one
+    // of them as well. That changes the norm of the minimal step, as the eliminated unknowns
+    // don't count anymore.
+    bool use_presolve = true;
+    bool eliminate_linear = false;
+    // equations that are in the span of the others at the start of a solve are left out of the
+    // steps, they are only checked once the others converged
+    bool remove_redundant = true;
+    // components are solved in parallel once the system has this many equations
+    int min_parallel_size = 200;
 
     std::string stats;
     bool dof_changed;
     int counted_steps;
+    // result of analyze(), kept until the structure or the values of the system change
+    DofAnalysis analysis;
+    bool is_analyzed = false;
 
-    xt::xtensor<std::shared_ptr<Expr>, 2> J;
-    xt::xtensor<double, 2> A;
-    xt::xtensor<double, 2> AAT;
+    // jacobian in CSR form, only the structural nonzeros are stored and evaluated
+    SparseMatrix A;
+    // normal matrix A * A^T of the minimum norm step
+    Eigen::SparseMatrix<double> AAT;
+    Eigen::SparseMatrix<double> empty_rows;
+    SparseMatrix scaled_A;
+    Eigen::MatrixXd dense_AAT;
+    // Factorizations of the least squares steps, one for the drag steps and one for the steps
+    // after them, where the drag rows are cleared. The pattern of A * A^T only depends on the
+    // structure of A, so its symbolic factorization is computed once and reused for every
+    // iteration. The numeric factorization of an undamped, unscaled step is kept, together with
+    // the jacobian it belongs to, so chord steps can use it again until the structure changes.
+    struct Factorization
+    {
+        enum Kind
+        {
+            NONE,
+            DENSE_LDLT,
+            DENSE_COD,
+            SPARSE_LDLT
+        };
+        Kind kind = NONE;
+        SparseMatrix A;
+        Eigen::SimplicialLDLT<Eigen::SparseMatrix<double>> AAT_solver;
+        bool is_AAT_analyzed = false;
+        // workspace of the dense path
+        Eigen::MatrixXd dense_A;
+        Eigen::LDLT<Eigen::MatrixXd> dense_AAT_solver;
+        Eigen::CompleteOrthogonalDecomposition<Eigen::MatrixXd> dense_solver;
+    };
+    Factorization factorizations[2];
+    // the drag rows of A were cleared by the last eval_jacobian, selects the factorization
+    bool is_drag_cleared = false;
     xt::xtensor<double, 1> B;
     xt::xtensor<double, 1> X;
     xt::xtensor<double, 1> Z;
+    // residuals of a trial step and the linearized prediction of them
+    xt::xtensor<double, 1> R;
+    xt::xtensor<double, 1> AX;
+    double damping;
+    double damping_increase;
+    Eigen::VectorXd irls_weights;
+    Eigen::VectorXd irls_previous;
     xt::xtensor<double, 1> old_param_value;
+    // positions of the parameters in their store, to store and revert them in bulk
+    ParamStoreIndex param_store_index;
+    // workspace of the iterative solver
+    Eigen::VectorXd cgls_r;
+    Eigen::VectorXd cgls_s;
+    Eigen::VectorXd cgls_p;
+    Eigen::VectorXd cgls_q;
+    Eigen::VectorXd cgls_scale;
+    std::vector<double> tape_params;
+    std::vector<double> tape_roots;
+
+    // compiled equations, the jacobian rows are computed from it by reverse-mode AD
+    ExprTape tape;
+    // column in A of every tape parameter, -1 for parameters that are not solved for
+    std::vector<int> param_columns;
+    // position in A's value array for every entry of tape.root_params, -1 if not solved for
+    std::vector<int> jacobian_positions;
+    std::vector<double> gradient;
+
+    // linear program of the L1 mode, built once per jacobian structure
+    std::unique_ptr<operations_research::MPSolver> lp;
+    std::vector<operations_research::MPVariable*> lp_u;
+    std::vector<operations_research::MPVariable*> lp_v;
+    std::vector<operations_research::MPConstraint*> lp_rows;
+
+    // values of every parameter read by the equations after the last converged solve,
+    // a system none of them changed for is already solved
+    std::vector<double> solved_values;
+    bool is_solved = false;
 
     std::vector<std::shared_ptr<Expr>> source_equations;
     std::vector<std::shared_ptr<Param<double>>> parameters;
+    // index of every parameter in `parameters`, only changes when a parameter before it is removed
+    std::unordered_map<const Param<double>*, std::size_t> parameter_index;
 
     std::vector<std::shared_ptr<Expr>> equations;
     std::vector<std::shared_ptr<Param<double>>> current_params;
 
-    std::unordered_map<std::shared_ptr<Param<double>>, std::shared_ptr<Param<double>>> subs;
+    // parameters replaced by the substitution, and the rewritten form of the source equations
+    // that depend on them
+    ParamSubstitution subs;
+    // unknowns eliminated by the presolve, with the expression they are computed by
+    std::vector<std::pair<std::shared_ptr<Param<double>>, std::shared_ptr<Expr>>> presolved;
+    // expression every substituted or eliminated parameter is replaced with in the equations
+    ExprSubstitution substitution;
+    std::unordered_map<const Expr*, std::shared_ptr<Expr>> substituted;
+    // substitution equations kept as equations since their parameters had different values
+    std::vector<std::shared_ptr<Expr>> pending_substitutions;
+
+    // equations left out as redundant, in their substituted form
+    std::vector<std::shared_ptr<Expr>> redundant_equations;
+
+    // connected components of the equation-parameter graph
+    std::vector<std::unique_ptr<EquationSystem>> components;
+    std::vector<SolveResult> component_results;
+    std::unordered_map<const Expr*, int> equation_component;
+    std::unordered_map<const Param<double>*, int> param_component;
+    int constant_component = -1;
+
+    // equations added or removed since the last update, that only need their components rebuilt
+    std::vector<std::shared_ptr<Expr>> added_equations;
+    std::vector<std::shared_ptr<Expr>> removed_equations;
+    // the tape and jacobian of the whole system are only needed without components, they are
+    // rebuilt lazily after incremental changes
+    bool is_tape_dirty = false;
+
+    EquationSystem();
+    ~EquationSystem();
 
     void add_equation(const std::shared_ptr<Expr>& eq);
     void add_equation(const ExpVector& v);
     void add_equations(const std::vector<ExprPtr>& v);
 
     void remove_equation(const std::shared_ptr<Expr>& eq);
+    // removes all of `eqs` in a single pass over the equations
+    void remove_equations(const std::vector<ExprPtr>& eqs);
 
     void add_parameter(const ParamPtr& p);
     void add_parameters(const std::vector<ParamPtr>& p);
 
     void remove_parameter(const std::shared_ptr<Param<double>>& p);
+    void remove_parameters(const std::vector<ParamPtr>& p);
+    // index of `p` in `parameters`, -1 if it isn't part of the system
+    int parameter_column(const std::shared_ptr<Param<double>>& p) const;
 
     void eval(xt::xtensor<double, 1>& B, bool clear_drag);
 
     bool is_converged(bool check_drag, bool print_non_converged = false);
+    void store_solved_values();
+    bool is_changed_since_solved();
     void store_params();
     void revert_params();
 
@@ -70,25 +245,73 @@ public:
         const std::vector<std::shared_ptr<Param<double>>>& parameters);
 
     bool has_dragged();
-    void eval_jacobian(const xt::xtensor<expr_ptr, 2>& J, xt::xtensor<double, 2>& A,
-                       bool clear_drag);
-    void solve_least_squares(const xt::xtensor<double, 2>& A, const xt::xtensor<double, 1>& B,
-                             xt::xtensor<double, 1>& X);
+    void build_jacobian();
+    void eval_jacobian(SparseMatrix& A, bool clear_drag);
+    // minimum norm solution of A * X = B, with damping > 0 X = A^T * (A * A^T + damping * I)^-1 * B
+    // with column_scale S the minimum of |S^-1 * X| is computed instead of |X|
+    void solve_least_squares(const SparseMatrix& A, const xt::xtensor<double, 1>& B,
+                             xt::xtensor<double, 1>& X, double damping = 0.0,
+                             const Eigen::VectorXd* column_scale = nullptr);
+    void solve_least_squares_dense(const SparseMatrix& A, const xt::xtensor<double, 1>& B,
+                                   xt::xtensor<double, 1>& X, double damping,
+                                   const Eigen::VectorXd* column_scale);
+    // minimum norm solution with the kept factorization of the drag steps (clear_drag = false)
+    // or of the steps after them, false if there is none
+    bool solve_factorized(const xt::xtensor<double, 1>& B, xt::xtensor<double, 1>& X,
+                          bool clear_drag);
+    // Y = A * X and X = A^T * Y from the tape, without evaluating A
+    void multiply_jacobian(const double* X, double* Y, bool clear_drag);
+    void multiply_jacobian_transposed(const double* Y, double* X, bool clear_drag);
+    // minimum norm solution of A * X = B by CGLS
+    void solve_iterative(const xt::xtensor<double, 1>& B, xt::xtensor<double, 1>& X,
+                         bool clear_drag);
+    // minimum |X|_1 solution of A * X = B without a linear program
+    void solve_irls(const SparseMatrix& A, const xt::xtensor<double, 1>& B,
+                    xt::xtensor<double, 1>& X);
+    // takes a step along the damped solution, adapting the damping until the residual decreases
+    void damped_step(bool clear_drag);
 
-    void solve_linear_program(const xt::xtensor<double, 2>& A, const xt::xtensor<double, 1>& B,
+    void build_linear_program();
+    void solve_linear_program(const SparseMatrix& A, const xt::xtensor<double, 1>& B,
                               xt::xtensor<double, 1>& X);
 
 
     void clear();
+    // bookkeeping of an equation that was taken out of source_equations
+    void detach_equation(const std::shared_ptr<Expr>& eq);
 
+    // Same as analyze(): drag equations are not counted, since they don't constrain anything.
+    // True if none of the constraint equations depends on the others, the ones left out as
+    // redundant included.
     bool test_rank(int& dof);
+    // rank and degrees of freedom, components that didn't change since the last call keep theirs
+    const DofAnalysis& analyze();
 
     void update_dirty();
+    void build_tape();
+    bool is_incremental(const std::shared_ptr<Expr>& eq);
+    // true if one of the pending substitutions holds by now, a rebuild would substitute it
+    bool has_pending_substitution() const;
+    void update_components();
+
+    void back_substitution(const ParamSubstitution& subs);
+    ParamSubstitution solve_by_substitution();
+    // eliminates unknowns of the linear equations that are not yet removed, marks the equations
+    // used for that as removed
+    void presolve(const ParamSubstitution& subs, std::vector<bool>& is_removed);
+    // the equation `eq` was turned into by the substitution
+    const std::shared_ptr<Expr>& substituted_form(const std::shared_ptr<Expr>& eq) const;
+
+    // moves equations whose jacobian row depends on the others to redundant_equations
+    void find_redundant();
+    // true if the redundant equations hold, otherwise they are put back into the system
+    bool check_redundant();
+    // source equations found redundant, in this system or any of its components
+    std::vector<std::shared_ptr<Expr>> get_redundant_equations() const;
 
-    void back_substitution(
-        std::unordered_map<std::shared_ptr<Param<double>>, std::shared_ptr<Param<double>>>& subs);
-    std::unordered_map<std::shared_ptr<Param<double>>, std::shared_ptr<Param<double>>>
-    solve_by_substitution();
+    int add_component();
+    void build_components();
+    SolveResult solve_components();
 
     SolveResult solve();
 };
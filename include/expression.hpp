@@ -4,12 +4,18 @@
 #include <memory>
 #include <string>
 #include <cmath>
+#include <unordered_map>
+#include <vector>
+#include <algorithm>
+#include <cstdint>
 
 class Expr;
 
 template <class T>
 class Param;
 
+class ParamStore;
+
 using ParamPtr = std::shared_ptr<Param<double>>;
 using ExprPtr = std::shared_ptr<Expr>;
 
@@ -22,45 +28,255 @@ inline int sign(T val)
 template <class T>
 class Param : public std::enable_shared_from_this<Param<T>>
 {
-private:
-    T m_value;
-
 public:
-    std::string m_name;
     bool m_reduceable = true;
-    bool m_changed = false;
     std::shared_ptr<Expr> m_expr;
 
-    Param() = default;
+    // store holding value, name and changed flag while the parameter is part of a sketch, see
+    // ParamStore
+    ParamStore* m_store = nullptr;
+    std::uint32_t m_index = 0;
+
+    Param();
     Param(const std::string& name, bool reduceable = true);
     Param(const std::string& name, double value);
+    ~Param();
+
+    Param(const Param&) = delete;
+    Param& operator=(const Param&) = delete;
 
     std::string to_string() const
     {
-        return "(" + m_name + ":" + std::to_string(m_value) + ")";
+        return "(" + name() + ":" + std::to_string(value()) + ")";
     }
 
     void set_value(const T& other);
     T value() const;
 
+    const std::string& name() const;
+    bool is_changed() const;
+    void set_changed(bool changed);
+
     std::shared_ptr<Expr> expr();
 
     bool operator==(const Param& other) const;
+
+private:
+    // the state of a parameter that isn't adopted by a store
+    struct Detached
+    {
+        T value = T();
+        std::string name;
+        bool changed = false;
+    };
+    std::unique_ptr<Detached> m_detached;
+
+    friend class ParamStore;
+};
+
+// Structure of arrays holding the parameters of a sketch.
+// A parameter added to a sketch is adopted by its store: from then on its value, changed flag
+// and name are kept in the store at m_index and the parameter itself is only a handle, until
+// it or the store is destroyed (or another store adopts it). Values of different parameters
+// are next to each other, so they can be loaded, stored and reverted in bulk, and read and
+// written at once through a NumPy view of block(). Names are interned, parameters with the same
+// name share one string.
+// The block of values is shared with such views: while one is alive, adopting allocates a new
+// block instead of growing the shared one, so a view never dangles, but doesn't see parameters
+// adopted after it was taken.
+class ParamStore
+{
+public:
+    ParamStore()
+        : values(std::make_shared<std::vector<double>>())
+    {
+    }
+
+    ~ParamStore();
+
+    ParamStore(const ParamStore&) = delete;
+    ParamStore& operator=(const ParamStore&) = delete;
+
+    // moves the state of `p` into this store, returns its index
+    std::size_t adopt(Param<double>& p);
+    // hands the state at `index` back to its parameter
+    void release(std::size_t index);
+    // frees `index` of a parameter that is destroyed
+    void drop(std::size_t index)
+    {
+        owners[index] = nullptr;
+        (*releases)++;
+    }
+
+    double& operator[](std::size_t index)
+    {
+        return (*values)[index];
+    }
+
+    double* data()
+    {
+        return values->data();
+    }
+
+    std::size_t size() const
+    {
+        return owners.size();
+    }
+
+    // number of releases so far, positions of adopted parameters only change on a release.
+    // The counter outlives the store, which releases all its parameters when destroyed, so
+    // holders of it notice that as well.
+    std::shared_ptr<const std::size_t> release_count() const
+    {
+        return releases;
+    }
+
+    const std::string& name(std::size_t index) const
+    {
+        return names[name_ids[index]];
+    }
+
+    bool is_changed(std::size_t index) const
+    {
+        return changed[index];
+    }
+
+    void set_changed(std::size_t index, bool c)
+    {
+        changed[index] = c;
+    }
+
+    // parameter at `index`, or nullptr if it was released
+    const Param<double>* owner(std::size_t index) const
+    {
+        return owners[index];
+    }
+
+    const std::shared_ptr<std::vector<double>>& block() const
+    {
+        return values;
+    }
+
+private:
+    std::shared_ptr<std::vector<double>> values;
+    std::vector<std::uint8_t> changed;
+    std::vector<std::uint32_t> name_ids;
+    std::vector<Param<double>*> owners;
+    std::shared_ptr<std::size_t> releases = std::make_shared<std::size_t>(0);
+
+    std::vector<std::string> names;
+    std::unordered_map<std::string, std::uint32_t> name_index;
 };
 
+// Positions of a list of parameters in their common store, to move all their values between
+// the store and a buffer without going through each parameter.
+class ParamStoreIndex
+{
+public:
+    // recomputes the positions if the number of parameters or the positions in the store changed
+    // since the last call, returns false if the parameters aren't all in one store.
+    // reset() has to be called when the list changes otherwise.
+    bool update(const std::vector<std::shared_ptr<Param<double>>>& params);
+
+    void reset()
+    {
+        count = -1;
+        store = nullptr;
+    }
+
+    // writes the values in the order of the list to `out`, or to out[slots[i]] if given
+    void gather(double* out, const int* slots = nullptr) const;
+
+    // saves all values to `out` and restores them from it, in an order of their own.
+    // Restoring marks the values that differ as changed, like Param::set_value.
+    void save(double* out) const;
+    void restore(const double* in) const;
+
+private:
+    ParamStore* store = nullptr;
+    // release counter of `store` and its value when the positions were computed
+    std::shared_ptr<const std::size_t> store_releases;
+    std::size_t count = -1;
+    std::size_t releases = 0;
+    std::vector<std::uint32_t> positions;
+    // the parameters are exactly the store positions first ... first + count - 1 (in any order),
+    // so saving and restoring is a single copy
+    bool is_range = false;
+    std::uint32_t first = 0;
+};
+
+template <class T>
+Param<T>::Param()
+    : m_detached(new Detached())
+{
+}
+
+template <class T>
+Param<T>::Param(const std::string& name, bool reduceable /* = true */)
+    : m_reduceable(reduceable)
+    , m_detached(new Detached())
+{
+    m_detached->name = name;
+}
+
+template <class T>
+Param<T>::Param(const std::string& name, double value)
+    : m_detached(new Detached())
+{
+    m_detached->name = name;
+    m_detached->value = value;
+}
+
+template <class T>
+Param<T>::~Param()
+{
+    if (m_store != nullptr)
+        m_store->drop(m_index);
+}
+
 template <class T>
 void Param<T>::set_value(const T& other)
 {
-    if (other == m_value)
+    if (m_store != nullptr)
+    {
+        double& v = (*m_store)[m_index];
+        if (other == v)
+            return;
+        m_store->set_changed(m_index, true);
+        v = other;
+        return;
+    }
+    if (other == m_detached->value)
         return;
-    m_changed = true;
-    m_value = other;
+    m_detached->changed = true;
+    m_detached->value = other;
 }
 
 template <class T>
 T Param<T>::value() const
 {
-    return m_value;
+    return m_store != nullptr ? (*m_store)[m_index] : m_detached->value;
+}
+
+template <class T>
+const std::string& Param<T>::name() const
+{
+    return m_store != nullptr ? m_store->name(m_index) : m_detached->name;
+}
+
+template <class T>
+bool Param<T>::is_changed() const
+{
+    return m_store != nullptr ? m_store->is_changed(m_index) : m_detached->changed;
+}
+
+template <class T>
+void Param<T>::set_changed(bool changed)
+{
+    if (m_store != nullptr)
+        m_store->set_changed(m_index, changed);
+    else
+        m_detached->changed = changed;
 }
 
 template <class T>
@@ -73,18 +289,117 @@ std::shared_ptr<Expr> Param<T>::expr()
     return m_expr;
 }
 
-template <class T>
-Param<T>::Param(const std::string& name, bool reduceable /* = true */)
-    : m_name(name)
-    , m_reduceable(reduceable)
+inline std::size_t ParamStore::adopt(Param<double>& p)
 {
+    if (p.m_store == this)
+        return p.m_index;
+    if (p.m_store != nullptr)
+        p.m_store->release(p.m_index);
+    if (values.use_count() > 1)
+        values = std::make_shared<std::vector<double>>(*values);
+
+    auto& d = *p.m_detached;
+    auto it = name_index.find(d.name);
+    if (it == name_index.end())
+    {
+        it = name_index.emplace(d.name, names.size()).first;
+        names.push_back(std::move(d.name));
+    }
+    values->push_back(d.value);
+    changed.push_back(d.changed);
+    name_ids.push_back(it->second);
+    owners.push_back(&p);
+    p.m_detached.reset();
+    p.m_store = this;
+    p.m_index = owners.size() - 1;
+    return p.m_index;
 }
 
-template <class T>
-Param<T>::Param(const std::string& name, double value)
-    : m_name(name)
-    , m_value(value)
+inline void ParamStore::release(std::size_t index)
+{
+    Param<double>* p = owners[index];
+    p->m_detached.reset(new Param<double>::Detached());
+    p->m_detached->value = (*values)[index];
+    p->m_detached->name = name(index);
+    p->m_detached->changed = changed[index];
+    p->m_store = nullptr;
+    owners[index] = nullptr;
+    (*releases)++;
+}
+
+inline ParamStore::~ParamStore()
 {
+    for (std::size_t i = 0; i < owners.size(); i++)
+    {
+        if (owners[i] != nullptr)
+            release(i);
+    }
+}
+
+inline bool ParamStoreIndex::update(const std::vector<std::shared_ptr<Param<double>>>& params)
+{
+    if (count == params.size())
+    {
+        if (store == nullptr)
+            return false;
+        // the store itself might be gone, only its counter is known to be alive
+        if (*store_releases == releases && params[0]->m_store == store)
+            return true;
+    }
+
+    count = params.size();
+    store = params.empty() ? nullptr : params[0]->m_store;
+    store_releases = nullptr;
+    positions.resize(count);
+    std::uint32_t lo = -1, hi = 0;
+    for (std::size_t i = 0; i < count && store != nullptr; i++)
+    {
+        if (params[i]->m_store != store)
+            store = nullptr;
+        positions[i] = params[i]->m_index;
+        lo = std::min(lo, positions[i]);
+        hi = std::max(hi, positions[i]);
+    }
+    if (store == nullptr)
+        return false;
+    store_releases = store->release_count();
+    releases = *store_releases;
+    // positions are unique, so a range of the same size holds exactly these parameters
+    is_range = hi - lo + 1 == count;
+    first = lo;
+    return true;
+}
+
+inline void ParamStoreIndex::gather(double* out, const int* slots) const
+{
+    const double* v = store->data();
+    for (std::size_t i = 0; i < count; i++)
+    {
+        out[slots != nullptr ? slots[i] : i] = v[positions[i]];
+    }
+}
+
+inline void ParamStoreIndex::save(double* out) const
+{
+    if (is_range)
+    {
+        std::copy_n(store->data() + first, count, out);
+        return;
+    }
+    gather(out);
+}
+
+inline void ParamStoreIndex::restore(const double* in) const
+{
+    double* v = store->data();
+    for (std::size_t i = 0; i < count; i++)
+    {
+        std::uint32_t k = is_range ? first + i : positions[i];
+        if (v[k] == in[i])
+            continue;
+        v[k] = in[i];
+        store->set_changed(k, true);
+    }
 }
 
 inline std::shared_ptr<Param<double>> param(const std::string& name, double value)
@@ -181,6 +496,64 @@ public:
     Op get_op() const;
 };
 
+// Hash-consing of expression nodes.
+// While an arena is current (see ExprArena::Scope), the expression operators return an existing
+// node for every (op, a, b, value) they have already built instead of allocating a new one, so
+// structurally identical subtrees are shared and the tape evaluates them only once.
+// The arena only holds weak references, nodes are still owned by the expressions using them.
+class ExprArena
+{
+public:
+    class Scope
+    {
+    public:
+        explicit Scope(ExprArena& arena);
+        ~Scope();
+
+        Scope(const Scope&) = delete;
+        Scope& operator=(const Scope&) = delete;
+
+    private:
+        ExprArena* previous;
+    };
+
+    // the arena of the calling thread, or nullptr if none is active
+    static ExprArena* current();
+
+    std::shared_ptr<Expr> intern(const Op& op, const std::shared_ptr<Expr>& a,
+                                 const std::shared_ptr<Expr>& b);
+    std::shared_ptr<Expr> constant(double value);
+
+    // number of live interned nodes
+    std::size_t size();
+    void clear();
+
+private:
+    struct Key
+    {
+        Op op;
+        const Expr* a;
+        const Expr* b;
+        double value;
+
+        bool operator==(const Key& other) const
+        {
+            return op == other.op && a == other.a && b == other.b && value == other.value;
+        }
+    };
+
+    struct KeyHash
+    {
+        std::size_t operator()(const Key& k) const;
+    };
+
+    std::unordered_map<Key, std::weak_ptr<Expr>, KeyHash> nodes;
+    std::size_t purge_at = 1024;
+
+    std::shared_ptr<Expr> lookup(const Key& key);
+    void insert(const Key& key, const std::shared_ptr<Expr>& e);
+};
+
 static std::shared_ptr<Expr> zero = std::make_shared<Expr>(0.), one = std::make_shared<Expr>(1.),
                              mOne = std::make_shared<Expr>(-1.), two = std::make_shared<Expr>(2.0),
                              PI_E = std::make_shared<Expr>(M_PI),
@@ -189,6 +562,15 @@ static std::shared_ptr<Expr> zero = std::make_shared<Expr>(0.), one = std::make_
 
 std::shared_ptr<Expr> expr(double);
 
+using ParamSubstitution = std::unordered_map<ParamPtr, ParamPtr>;
+using ExprSubstitution = std::unordered_map<ParamPtr, ExprPtr>;
+
+// copy of `e` with the parameters in `subs` replaced, subtrees without any of them are shared
+// with `e`. `rewritten` caches the result per node, so subtrees shared by several expressions are
+// only copied once.
+std::shared_ptr<Expr> substitute(const std::shared_ptr<Expr>& e, const ExprSubstitution& subs,
+                                 std::unordered_map<const Expr*, std::shared_ptr<Expr>>& rewritten);
+
 // note missing unary +?
 std::shared_ptr<Expr> operator-(const std::shared_ptr<Expr>& a);
 std::shared_ptr<Expr> operator-(const std::shared_ptr<Expr>& a, const std::shared_ptr<Expr>& b);
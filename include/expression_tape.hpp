@@ -0,0 +1,102 @@
+#ifndef ADJACENT_EXPRESSION_TAPE_HPP
+#define ADJACENT_EXPRESSION_TAPE_HPP
+
+#include <vector>
+#include <unordered_map>
+#include <memory>
+
+#include "expression.hpp"
+
+// Compiled form of a set of expression trees.
+// Every distinct node gets a slot in one contiguous value array, the operations are stored as a
+// linear list of instructions in evaluation order, so evaluating is a single loop without any
+// recursion or pointer chasing. Subtrees that are shared by pointer are compiled only once.
+// For every root the tape also records the instructions and parameters it depends on, which is
+// used to compute the gradient of a root with a single reverse sweep (reverse-mode AD).
+class ExprTape
+{
+public:
+    struct Instruction
+    {
+        Op op;
+        int a;
+        int b;
+        int out;
+    };
+
+    std::vector<Instruction> instructions;
+    std::vector<double> values;
+
+    std::vector<std::shared_ptr<Param<double>>> params;
+    std::vector<int> param_slots;
+
+    // slot of each compiled root, in the order they were added
+    std::vector<int> roots;
+
+    // indices into `params` of the parameters root i depends on:
+    // root_params[root_param_begin[i]] ... root_params[root_param_begin[i + 1] - 1]
+    std::vector<std::size_t> root_param_begin = { 0 };
+    std::vector<int> root_params;
+
+    void clear();
+
+    // compiles `e` and returns the index of its root
+    std::size_t add(const std::shared_ptr<Expr>& e);
+
+    // loads the current parameter values and runs the first `end` instructions
+    void eval(std::size_t end);
+    void eval();
+
+    double value(std::size_t root) const
+    {
+        return values[roots[root]];
+    }
+
+    std::size_t param_count(std::size_t root) const
+    {
+        return root_param_begin[root + 1] - root_param_begin[root];
+    }
+
+    // writes the derivatives of `root` by each of its parameters (in root_params order) to `grad`,
+    // the values have to be up to date, i.e. eval() has to be called before
+    void gradient(std::size_t root, double* grad);
+
+    // writes the product of the jacobian of the roots by the parameters with `v` to `out`
+    // (one value per root), in a single forward sweep over the tape. The values have to be up to
+    // date.
+    void jacobian_vector(const double* v, double* out);
+    // writes the product of the transposed jacobian with `w` to `out` (one value per parameter),
+    // in a single reverse sweep over the tape. The values have to be up to date.
+    void vector_jacobian(const double* w, double* out);
+
+    std::size_t size() const
+    {
+        return instructions.size();
+    }
+
+private:
+    std::vector<std::shared_ptr<Expr>> sources;
+    std::unordered_map<const Expr*, int> expr_slots;
+    std::unordered_map<const Param<double>*, int> param_index;
+
+    // instruction computing each slot, or the parameter loaded into it, -1 otherwise
+    std::vector<int> slot_instruction;
+    std::vector<int> slot_param;
+
+    // instructions root i depends on, in evaluation order
+    std::vector<std::size_t> cone_begin = { 0 };
+    std::vector<int> cones;
+
+    // to load the parameter values straight from their store
+    ParamStoreIndex store_index;
+
+    std::vector<double> adjoints;
+    std::vector<double> tangents;
+    std::vector<int> marks;
+
+    int compile(const std::shared_ptr<Expr>& e);
+    int new_slot(double value);
+    void add_cone(int root_slot);
+};
+
+#endif
@@ -1,7 +1,10 @@
 #ifndef ADJACENT_GAUSSIAN_METHOD_HPP
 #define ADJACENT_GAUSSIAN_METHOD_HPP
 
+#include <vector>
+
 #include <xtensor/xtensor.hpp>
+#include <Eigen/Sparse>
 
 class GaussianMethod
 {
@@ -9,13 +12,18 @@ public:
     static constexpr double epsilon = 1e-10;
     static constexpr double rank_epsilon = 1e-8;
 
-    // copy A so it doesn't get overwritten
-    // note: could use xt::linalg::rank
-    static int rank(xt::xtensor<double, 2> A);
+    // number of rows whose squared distance to the span of the others exceeds rank_epsilon
+    static int rank(const xt::xtensor<double, 2>& A);
+
+    // the first `rank` columns of the returned order are independent, the others are in their
+    // span (up to rank_epsilon). Small matrices take a column pivoted QR, large ones a sparse QR
+    // that moves the columns with a pivot below the threshold to the end.
+    static std::vector<int> independent_columns(const Eigen::SparseMatrix<double>& M, int& rank,
+                                                bool dense);
 
-    // copy A & B so they don't get overwritten
-    static void solve(xt::xtensor<double, 2> A, xt::xtensor<double, 1> B,
+    // solves A * X = B, for singular A the minimum norm least squares solution is returned
+    static void solve(const xt::xtensor<double, 2>& A, const xt::xtensor<double, 1>& B,
                       xt::xtensor<double, 1>& X);
 };
 
-#endif
\ No newline at end of file
+#endif
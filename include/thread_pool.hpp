@@ -0,0 +1,145 @@
+#ifndef ADJACENT_THREAD_POOL_HPP
+#define ADJACENT_THREAD_POOL_HPP
+
+#include <algorithm>
+#include <atomic>
+#include <condition_variable>
+#include <deque>
+#include <functional>
+#include <memory>
+#include <mutex>
+#include <thread>
+#include <vector>
+
+// Fixed set of worker threads running queued tasks.
+// parallel_for lets the calling thread work on the range as well and only waits for indices that
+// were actually picked up, so it can be nested (e.g. a sketch solved on the pool solving its
+// components on the pool) without running out of workers.
+class ThreadPool
+{
+public:
+    explicit ThreadPool(std::size_t threads)
+    {
+        for (std::size_t i = 0; i < threads; i++)
+        {
+            workers.emplace_back([this] { work(); });
+        }
+    }
+
+    ~ThreadPool()
+    {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            stopping = true;
+        }
+        wake.notify_all();
+        for (auto& w : workers)
+        {
+            w.join();
+        }
+    }
+
+    ThreadPool(const ThreadPool&) = delete;
+    ThreadPool& operator=(const ThreadPool&) = delete;
+
+    // pool shared by the solver, one worker per additional core
+    static ThreadPool& shared()
+    {
+#if defined(__EMSCRIPTEN__) && !defined(__EMSCRIPTEN_PTHREADS__)
+        static ThreadPool pool(0);
+#else
+        static ThreadPool pool(std::max(1u, std::thread::hardware_concurrency()) - 1);
+#endif
+        return pool;
+    }
+
+    std::size_t size() const
+    {
+        return workers.size();
+    }
+
+    void submit(std::function<void()> task)
+    {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            tasks.push_back(std::move(task));
+        }
+        wake.notify_one();
+    }
+
+    // calls f(0) ... f(n - 1), distributed over the calling thread and the workers
+    template <class F>
+    void parallel_for(std::size_t n, F&& f)
+    {
+        if (n == 0)
+            return;
+        if (n == 1 || workers.empty())
+        {
+            for (std::size_t i = 0; i < n; i++)
+            {
+                f(i);
+            }
+            return;
+        }
+
+        struct Range
+        {
+            std::atomic<std::size_t> next{ 0 };
+            std::size_t done = 0;
+            std::mutex mutex;
+            std::condition_variable finished;
+        };
+        // helpers may only start after this call returned, so the shared state is owned by them
+        auto range = std::make_shared<Range>();
+        std::function<void(std::size_t)> body = f;
+        auto run = [range, n, body] {
+            std::size_t count = 0;
+            for (std::size_t i; (i = range->next++) < n; count++)
+            {
+                body(i);
+            }
+            if (count == 0)
+                return;
+            std::lock_guard<std::mutex> lock(range->mutex);
+            range->done += count;
+            if (range->done == n)
+                range->finished.notify_all();
+        };
+
+        std::size_t helpers = std::min(workers.size(), n - 1);
+        for (std::size_t i = 0; i < helpers; i++)
+        {
+            submit(run);
+        }
+        run();
+
+        std::unique_lock<std::mutex> lock(range->mutex);
+        range->finished.wait(lock, [&] { return range->done == n; });
+    }
+
+private:
+    std::vector<std::thread> workers;
+    std::deque<std::function<void()>> tasks;
+    std::mutex mutex;
+    std::condition_variable wake;
+    bool stopping = false;
+
+    void work()
+    {
+        while (true)
+        {
+            std::function<void()> task;
+            {
+                std::unique_lock<std::mutex> lock(mutex);
+                wake.wait(lock, [this] { return stopping || !tasks.empty(); });
+                if (stopping && tasks.empty())
+                    return;
+                task = std::move(tasks.front());
+                tasks.pop_front();
+            }
+            task();
+        }
+    }
+};
+
+#endif
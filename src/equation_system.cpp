@@ -1,15 +1,21 @@
 #include <vector>
 #include <unordered_map>
+#include <unordered_set>
 #include <memory>
+#include <algorithm>
+#include <cmath>
 
 #include <xtensor/xtensor.hpp>
 #include <xtensor/xio.hpp>
+#include <Eigen/Sparse>
+#include <Eigen/SparseQR>
 #include <ortools/linear_solver/linear_solver.h>
-#include <ortools/linear_solver/linear_solver.pb.h>
 
 #include "expression.hpp"
 #include "expression_vector.hpp"
+#include "expression_tape.hpp"
 #include "gaussian_method.hpp"
+#include "thread_pool.hpp"
 #include "equation_system.hpp"
 
 constexpr bool DEBUG = false;
@@ -19,15 +25,19 @@ void EquationSystem::add_equation(const std::shared_ptr<Expr>& eq)
     if (DEBUG)
         std::cout << "Adding equation: " << eq->to_string() << std::endl;
     source_equations.push_back(eq);
+    if (is_incremental(eq))
+    {
+        added_equations.push_back(eq);
+        return;
+    }
     is_dirty = true;
 }
 
 void EquationSystem::add_equation(const ExpVector& v)
 {
-    source_equations.push_back(v.x);
-    source_equations.push_back(v.y);
-    source_equations.push_back(v.z);
-    is_dirty = true;
+    add_equation(v.x);
+    add_equation(v.y);
+    add_equation(v.z);
 }
 
 void EquationSystem::add_equations(const std::vector<ExprPtr>& eq)
@@ -45,6 +55,61 @@ void EquationSystem::remove_equation(const std::shared_ptr<Expr>& eq)
             "Could not remove equation, it doesn't exist in source_equations vector.");
     }
     source_equations.erase(it);
+    detach_equation(eq);
+}
+
+void EquationSystem::remove_equations(const std::vector<ExprPtr>& eqs)
+{
+    // the same equation can be part of the system several times, each entry removes one of them
+    std::unordered_map<const Expr*, int> counts;
+    for (const auto& eq : eqs)
+    {
+        counts[eq.get()]++;
+    }
+    auto missing = counts;
+    for (const auto& eq : source_equations)
+    {
+        auto it = missing.find(eq.get());
+        if (it != missing.end() && it->second > 0)
+            it->second--;
+    }
+    for (const auto& kv : missing)
+    {
+        if (kv.second > 0)
+        {
+            throw std::runtime_error(
+                "Could not remove equation, it doesn't exist in source_equations vector.");
+        }
+    }
+
+    auto end = std::remove_if(source_equations.begin(), source_equations.end(),
+                              [&counts](const std::shared_ptr<Expr>& eq) {
+                                  auto it = counts.find(eq.get());
+                                  if (it == counts.end() || it->second == 0)
+                                      return false;
+                                  it->second--;
+                                  return true;
+                              });
+    source_equations.erase(end, source_equations.end());
+    for (const auto& eq : eqs)
+    {
+        detach_equation(eq);
+    }
+}
+
+void EquationSystem::detach_equation(const std::shared_ptr<Expr>& eq)
+{
+    auto added = std::find(added_equations.begin(), added_equations.end(), eq);
+    if (added != added_equations.end())
+    {
+        added_equations.erase(added);
+        return;
+    }
+    if (is_incremental(eq) && equation_component.count(substituted_form(eq).get()) != 0)
+    {
+        removed_equations.push_back(eq);
+        return;
+    }
     is_dirty = true;
 }
 
@@ -52,7 +117,7 @@ void EquationSystem::add_parameter(const std::shared_ptr<Param<double>>& p)
 {
     if (DEBUG)
         std::cout << "Adding Parameter: " << p->to_string() << std::endl;
-    if (std::find(parameters.begin(), parameters.end(), p) != parameters.end())
+    if (!parameter_index.emplace(p.get(), parameters.size()).second)
     {
         return;
     }
@@ -70,17 +135,63 @@ void EquationSystem::remove_parameter(const std::shared_ptr<Param<double>>& p)
 {
     if (DEBUG)
         std::cout << "Removing Parameter " << p->to_string() << std::endl;
-    auto it = std::find(parameters.begin(), parameters.end(), p);
-    if (it == parameters.end())
+    auto it = parameter_index.find(p.get());
+    if (it == parameter_index.end())
     {
         throw std::runtime_error(
             "Could not remove parameter, it doesn't exist in parameters vector.");
     }
+    std::size_t index = it->second;
+    parameter_index.erase(it);
+    parameters.erase(parameters.begin() + index);
+    for (std::size_t i = index; i < parameters.size(); i++)
+    {
+        parameter_index[parameters[i].get()] = i;
+    }
+    is_dirty = true;
+}
+
+void EquationSystem::remove_parameters(const std::vector<ParamPtr>& pv)
+{
+    for (const auto& p : pv)
+    {
+        if (parameter_index.count(p.get()) == 0)
+        {
+            throw std::runtime_error(
+                "Could not remove parameter, it doesn't exist in parameters vector.");
+        }
+    }
+    if (pv.empty())
+        return;
+
+    // marked parameters are dropped in a single pass, the others keep their order
+    for (const auto& p : pv)
+    {
+        parameter_index.erase(p.get());
+    }
+    std::size_t count = 0;
+    for (std::size_t i = 0; i < parameters.size(); i++)
+    {
+        auto it = parameter_index.find(parameters[i].get());
+        if (it == parameter_index.end())
+            continue;
+        it->second = count;
+        parameters[count++] = parameters[i];
+    }
+    parameters.resize(count);
+    is_dirty = true;
+}
+
+int EquationSystem::parameter_column(const std::shared_ptr<Param<double>>& p) const
+{
+    auto it = parameter_index.find(p.get());
+    return it != parameter_index.end() ? it->second : -1;
 }
 
 void EquationSystem::eval(xt::xtensor<double, 1>& B, bool clear_drag)
 {
     B.resize({ equations.size() });
+    tape.eval();
     for (int i = 0; i < equations.size(); i++)
     {
         if (clear_drag && equations[i]->is_drag())
@@ -88,7 +199,7 @@ void EquationSystem::eval(xt::xtensor<double, 1>& B, bool clear_drag)
             B(i) = 0.0;
             continue;
         }
-        B(i) = equations[i]->eval();
+        B(i) = tape.value(i);
     }
 }
 
@@ -115,8 +226,35 @@ bool EquationSystem::is_converged(bool check_drag, bool print_non_converged /* =
     return true;
 }
 
+void EquationSystem::store_solved_values()
+{
+    solved_values.resize(tape.params.size());
+    for (std::size_t i = 0; i < tape.params.size(); i++)
+    {
+        solved_values[i] = tape.params[i]->value();
+    }
+    is_solved = true;
+}
+
+bool EquationSystem::is_changed_since_solved()
+{
+    if (!is_solved)
+        return true;
+    for (std::size_t i = 0; i < tape.params.size(); i++)
+    {
+        if (tape.params[i]->value() != solved_values[i])
+            return true;
+    }
+    return false;
+}
+
 void EquationSystem::store_params()
 {
+    if (param_store_index.update(parameters))
+    {
+        param_store_index.save(old_param_value.data());
+        return;
+    }
     for (std::size_t i = 0; i < parameters.size(); i++)
     {
         old_param_value[i] = parameters[i]->value();
@@ -125,6 +263,11 @@ void EquationSystem::store_params()
 
 void EquationSystem::revert_params()
 {
+    if (param_store_index.update(parameters))
+    {
+        param_store_index.restore(old_param_value.data());
+        return;
+    }
     for (std::size_t i = 0; i < parameters.size(); i++)
     {
         parameters[i]->set_value(old_param_value[i]);
@@ -160,203 +303,529 @@ xt::xtensor<std::shared_ptr<Expr>, 2> EquationSystem::write_jacobian(
     return J;
 }
 
+// defined here, where the linear program types are complete
+EquationSystem::EquationSystem() = default;
+EquationSystem::~EquationSystem() = default;
+
 bool EquationSystem::has_dragged()
 {
     return std::any_of(equations.begin(), equations.end(), [](auto& e) { return e->is_drag(); });
 }
 
-void EquationSystem::eval_jacobian(const xt::xtensor<expr_ptr, 2>& J, xt::xtensor<double, 2>& A,
-                                   bool clear_drag)
+void EquationSystem::build_jacobian()
+{
+    std::unordered_map<std::shared_ptr<Param<double>>, int> columns;
+    for (std::size_t c = 0; c < current_params.size(); c++)
+    {
+        columns[current_params[c]] = c;
+    }
+    param_columns.assign(tape.params.size(), -1);
+    for (std::size_t i = 0; i < tape.params.size(); i++)
+    {
+        auto it = columns.find(tape.params[i]);
+        if (it != columns.end())
+            param_columns[i] = it->second;
+    }
+    gradient.resize(tape.params.size());
+
+    // the parameters every equation depends on are known from the tape, so is the sparsity
+    std::vector<Eigen::Triplet<double>> pattern;
+    for (std::size_t r = 0; r < equations.size(); r++)
+    {
+        for (std::size_t k = tape.root_param_begin[r]; k < tape.root_param_begin[r + 1]; k++)
+        {
+            int c = param_columns[tape.root_params[k]];
+            if (c >= 0)
+                pattern.emplace_back(r, c, 0.0);
+        }
+    }
+    A.resize(equations.size(), current_params.size());
+    A.setFromTriplets(pattern.begin(), pattern.end());
+    A.makeCompressed();
+    lp = nullptr;
+
+    empty_rows.resize(equations.size(), equations.size());
+    empty_rows.setIdentity();
+    for (auto& f : factorizations)
+    {
+        f.kind = Factorization::NONE;
+        f.is_AAT_analyzed = false;
+    }
+
+    jacobian_positions.assign(tape.root_params.size(), -1);
+    const int* outer = A.outerIndexPtr();
+    const int* inner = A.innerIndexPtr();
+    for (std::size_t r = 0; r < equations.size(); r++)
+    {
+        for (std::size_t k = tape.root_param_begin[r]; k < tape.root_param_begin[r + 1]; k++)
+        {
+            int c = param_columns[tape.root_params[k]];
+            if (c < 0)
+                continue;
+            jacobian_positions[k] = std::lower_bound(inner + outer[r], inner + outer[r + 1], c)
+                                    - inner;
+        }
+    }
+}
+
+void EquationSystem::eval_jacobian(SparseMatrix& A, bool clear_drag)
 {
     update_dirty();
-    for (std::size_t r = 0; r < J.shape(0); r++)
+    if (is_tape_dirty)
+        build_tape();
+    is_drag_cleared = clear_drag;
+    tape.eval();
+    double* values = A.valuePtr();
+    const int* outer = A.outerIndexPtr();
+    for (std::size_t r = 0; r < equations.size(); r++)
     {
         if (clear_drag && equations[r]->is_drag())
         {
-            for (std::size_t c = 0; c < J.shape(1); c++)
-            {
-                A(r, c) = 0.0;
-            }
+            std::fill(values + outer[r], values + outer[r + 1], 0.0);
             continue;
         }
-        for (std::size_t c = 0; c < J.shape(1); c++)
+        tape.gradient(r, gradient.data());
+        std::size_t first = tape.root_param_begin[r];
+        for (std::size_t k = 0; k < tape.param_count(r); k++)
         {
-            A(r, c) = J(r, c)->eval();
+            int pos = jacobian_positions[first + k];
+            if (pos >= 0)
+                values[pos] = gradient[k];
         }
     }
 }
 
-void EquationSystem::solve_least_squares(const xt::xtensor<double, 2>& A,
-                                         const xt::xtensor<double, 1>& B, xt::xtensor<double, 1>& X)
+void EquationSystem::solve_least_squares(const SparseMatrix& A, const xt::xtensor<double, 1>& B,
+                                         xt::xtensor<double, 1>& X, double damping /* = 0.0 */,
+                                         const Eigen::VectorXd* column_scale /* = nullptr */)
 {
-    // A^T * A * X = A^T * B
-    std::size_t rows = A.shape(0);
-    std::size_t cols = A.shape(1);
+    // minimum norm solution X = A^T * (A * A^T)^-1 * B
+    std::size_t rows = A.rows();
+    std::size_t cols = A.cols();
+    if (rows <= max_dense_size)
+    {
+        solve_least_squares_dense(A, B, X, damping, column_scale);
+        return;
+    }
 
+    // rows without any derivative (e.g. cleared drag equations) would make A * A^T singular,
+    // a one on their diagonal keeps it definite and their Z ends up unused
+    const double* values = A.valuePtr();
+    const int* outer = A.outerIndexPtr();
     for (std::size_t r = 0; r < rows; r++)
     {
-        // only up to `rows`?
-        for (std::size_t c = 0; c < rows; c++)
+        bool is_empty = std::all_of(values + outer[r], values + outer[r + 1],
+                                    [](double v) { return v == 0.0; });
+        empty_rows.valuePtr()[r] = is_empty ? 1.0 : 0.0;
+    }
+    // with scaled columns S the minimum of |S^-1 * X| is computed, X = S * Y with A * S * Y = B
+    const SparseMatrix* M = &A;
+    if (column_scale != nullptr)
+    {
+        scaled_A = A * column_scale->asDiagonal();
+        M = &scaled_A;
+    }
+    AAT = *M * M->transpose();
+    AAT += empty_rows;
+
+    Factorization& f = factorizations[is_drag_cleared];
+    if (!f.is_AAT_analyzed)
+    {
+        f.AAT_solver.analyzePattern(AAT);
+        f.is_AAT_analyzed = true;
+    }
+    f.AAT_solver.setShift(damping);
+    f.AAT_solver.factorize(AAT);
+
+    Eigen::Map<const Eigen::VectorXd> b(B.data(), rows);
+    Eigen::Map<Eigen::VectorXd> z(Z.data(), rows);
+    Eigen::Map<Eigen::VectorXd> x(X.data(), cols);
+    f.kind = Factorization::NONE;
+    // a damped system is definite, otherwise check it isn't rank deficient
+    auto D = f.AAT_solver.vectorD();
+    if (f.AAT_solver.info() == Eigen::Success
+        && (damping > 0.0 || D.minCoeff() > GaussianMethod::epsilon * D.maxCoeff()))
+    {
+        z = f.AAT_solver.solve(b);
+        x.noalias() = M->transpose() * z;
+        if (damping == 0.0 && column_scale == nullptr)
         {
-            double sum = 0.0;
-            for (std::size_t i = 0; i < cols; i++)
-            {
-                if (A(c, i) == 0 || A(r, i) == 0)
-                    continue;
-                sum += A(r, i) * A(c, i);
-            }
-            AAT(r, c) = sum;
+            f.kind = Factorization::SPARSE_LDLT;
+            f.A = A;
         }
     }
+    else
+    {
+        // rank deficient, a column pivoted sparse QR of M^T, M^T * P = Q * R, gives the minimum
+        // norm solution of the independent rows without forming dense matrices: with
+        // w = Q^T * X the system is R^T * w = P^T * B, whose dependent rows are skipped
+        Eigen::SparseMatrix<double> MT = M->transpose();
+        Eigen::SparseQR<Eigen::SparseMatrix<double>, Eigen::COLAMDOrdering<int>> qr;
+        qr.setPivotThreshold(GaussianMethod::epsilon);
+        qr.compute(MT);
+        int rank = qr.rank();
+        Eigen::VectorXd pb = qr.colsPermutation().transpose() * b;
+        Eigen::SparseMatrix<double> R = qr.matrixR().topLeftCorner(rank, rank);
+        Eigen::VectorXd w = Eigen::VectorXd::Zero(cols);
+        w.head(rank) = R.transpose().triangularView<Eigen::Lower>().solve(pb.head(rank));
+        Eigen::VectorXd qw = qr.matrixQ() * w;
+        x = qw;
+    }
+
+    if (column_scale != nullptr)
+        x.array() *= column_scale->array();
+}
+
+void EquationSystem::solve_least_squares_dense(const SparseMatrix& A,
+                                               const xt::xtensor<double, 1>& B,
+                                               xt::xtensor<double, 1>& X, double damping,
+                                               const Eigen::VectorXd* column_scale)
+{
+    std::size_t rows = A.rows();
+    Eigen::Map<const Eigen::VectorXd> b(B.data(), rows);
+    Eigen::Map<Eigen::VectorXd> z(Z.data(), rows);
+    Eigen::Map<Eigen::VectorXd> x(X.data(), A.cols());
+
+    Factorization& f = factorizations[is_drag_cleared];
+    f.dense_A = A;
+    if (column_scale != nullptr)
+        f.dense_A.array().rowwise() *= column_scale->transpose().array();
+    dense_AAT.setZero(rows, rows);
+    dense_AAT.selfadjointView<Eigen::Lower>().rankUpdate(f.dense_A);
+    for (std::size_t r = 0; r < rows; r++)
+    {
+        if (dense_AAT(r, r) == 0.0)
+            dense_AAT(r, r) = 1.0;
+        dense_AAT(r, r) += damping;
+    }
+    f.dense_AAT_solver.compute(dense_AAT);
+
+    // a damped system is definite, otherwise check it isn't rank deficient
+    auto D = f.dense_AAT_solver.vectorD();
+    if (f.dense_AAT_solver.info() == Eigen::Success
+        && (damping > 0.0 || D.minCoeff() > GaussianMethod::epsilon * D.maxCoeff()))
+    {
+        z = f.dense_AAT_solver.solve(b);
+        x.noalias() = f.dense_A.transpose() * z;
+        f.kind = Factorization::DENSE_LDLT;
+    }
+    else
+    {
+        // rank deficient, a complete orthogonal decomposition of A gives the minimum norm
+        // solution without going through the badly conditioned normal equations
+        f.dense_solver.setThreshold(GaussianMethod::epsilon);
+        f.dense_solver.compute(f.dense_A);
+        x = f.dense_solver.solve(b);
+        f.kind = Factorization::DENSE_COD;
+    }
+    if (damping != 0.0 || column_scale != nullptr)
+        f.kind = Factorization::NONE;
+    if (column_scale != nullptr)
+        x.array() *= column_scale->array();
+}
+
+bool EquationSystem::solve_factorized(const xt::xtensor<double, 1>& B, xt::xtensor<double, 1>& X,
+                                      bool clear_drag)
+{
+    std::size_t rows = A.rows();
+    Eigen::Map<const Eigen::VectorXd> b(B.data(), rows);
+    Eigen::Map<Eigen::VectorXd> z(Z.data(), rows);
+    Eigen::Map<Eigen::VectorXd> x(X.data(), A.cols());
+    Factorization& f = factorizations[clear_drag];
+    switch (f.kind)
+    {
+        case Factorization::DENSE_LDLT:
+            z = f.dense_AAT_solver.solve(b);
+            x.noalias() = f.dense_A.transpose() * z;
+            return true;
+        case Factorization::DENSE_COD:
+            x = f.dense_solver.solve(b);
+            return true;
+        case Factorization::SPARSE_LDLT:
+            z = f.AAT_solver.solve(b);
+            x.noalias() = f.A.transpose() * z;
+            return true;
+        default:
+            return false;
+    }
+}
 
-    GaussianMethod::solve(AAT, B, Z);
+void EquationSystem::multiply_jacobian(const double* X, double* Y, bool clear_drag)
+{
+    tape_params.resize(tape.params.size());
+    for (std::size_t i = 0; i < tape.params.size(); i++)
+    {
+        tape_params[i] = param_columns[i] >= 0 ? X[param_columns[i]] : 0.0;
+    }
+    tape.jacobian_vector(tape_params.data(), Y);
+    for (std::size_t r = 0; r < equations.size(); r++)
+    {
+        if (clear_drag && equations[r]->is_drag())
+            Y[r] = 0.0;
+    }
+}
 
-    for (int c = 0; c < cols; c++)
+void EquationSystem::multiply_jacobian_transposed(const double* Y, double* X, bool clear_drag)
+{
+    tape_roots.assign(Y, Y + equations.size());
+    for (std::size_t r = 0; r < equations.size(); r++)
     {
-        double sum = 0.0;
-        for (int r = 0; r < rows; r++)
+        if (clear_drag && equations[r]->is_drag())
+            tape_roots[r] = 0.0;
+    }
+    tape_params.resize(tape.params.size());
+    tape.vector_jacobian(tape_roots.data(), tape_params.data());
+    std::fill(X, X + current_params.size(), 0.0);
+    for (std::size_t i = 0; i < tape.params.size(); i++)
+    {
+        if (param_columns[i] >= 0)
+            X[param_columns[i]] += tape_params[i];
+    }
+}
+
+void EquationSystem::solve_iterative(const xt::xtensor<double, 1>& B, xt::xtensor<double, 1>& X,
+                                     bool clear_drag)
+{
+    // CGLS on D * A * X = D * B, started from zero the iterates stay in the range of A^T, so it
+    // converges to the minimum norm solution. The row scale D doesn't change the solutions, but
+    // with D = diag(A * A^T)^-1/2 the normal matrix is a lot better conditioned.
+    std::size_t rows = equations.size();
+    std::size_t cols = current_params.size();
+    Eigen::Map<const Eigen::VectorXd> b(B.data(), rows);
+    Eigen::Map<Eigen::VectorXd> x(X.data(), cols);
+
+    cgls_scale.setOnes(rows);
+    for (std::size_t r = 0; r < rows; r++)
+    {
+        if (clear_drag && equations[r]->is_drag())
         {
-            sum += Z(r) * A(r, c);
+            cgls_scale(r) = 0.0;
+            continue;
         }
-        X(c) = sum;
+        if (!use_jacobi_preconditioner)
+            continue;
+        tape.gradient(r, gradient.data());
+        double norm = 0.0;
+        std::size_t first = tape.root_param_begin[r];
+        for (std::size_t k = 0; k < tape.param_count(r); k++)
+        {
+            if (param_columns[tape.root_params[first + k]] >= 0)
+                norm += gradient[k] * gradient[k];
+        }
+        if (norm > 0.0)
+            cgls_scale(r) = 1.0 / std::sqrt(norm);
+    }
+
+    x.setZero();
+    cgls_r = cgls_scale.cwiseProduct(b);
+    cgls_q = cgls_scale.cwiseProduct(cgls_r);
+    cgls_s.resize(cols);
+    multiply_jacobian_transposed(cgls_q.data(), cgls_s.data(), clear_drag);
+    cgls_p = cgls_s;
+    double gamma = cgls_s.squaredNorm();
+    double stop = iterative_tolerance * iterative_tolerance * gamma;
+    for (int k = 0; k < max_iterative_steps && gamma > stop; k++)
+    {
+        // q = D * A * p
+        multiply_jacobian(cgls_p.data(), cgls_q.data(), clear_drag);
+        cgls_q.array() *= cgls_scale.array();
+        double qq = cgls_q.squaredNorm();
+        if (qq == 0.0)
+            break;
+        double alpha = gamma / qq;
+        x += alpha * cgls_p;
+        cgls_r -= alpha * cgls_q;
+
+        // s = A^T * D * r
+        cgls_q = cgls_scale.cwiseProduct(cgls_r);
+        multiply_jacobian_transposed(cgls_q.data(), cgls_s.data(), clear_drag);
+        double next = cgls_s.squaredNorm();
+        cgls_p = cgls_s + (next / gamma) * cgls_p;
+        gamma = next;
     }
 }
 
-namespace operations_research
+void EquationSystem::solve_irls(const SparseMatrix& A, const xt::xtensor<double, 1>& B,
+                                xt::xtensor<double, 1>& X)
 {
-    void glop_solve(const xt::xtensor<double, 2>& A, const xt::xtensor<double, 1>& B,
-                    xt::xtensor<double, 1>& X)
+    // iteratively reweighted least squares: the minimum of sum(X_i^2 / w_i) with w_i = |X_i| of
+    // the previous solution is the minimum of |X|_1, the weights are smoothed by eps, which is
+    // reduced every iteration
+    Eigen::Map<Eigen::VectorXd> x(X.data(), A.cols());
+    solve_least_squares(A, B, X);
+    double scale = x.lpNorm<Eigen::Infinity>();
+    if (scale == 0.0)
+        return;
+
+    double eps = 0.1 * scale;
+    double min_eps = irls_tolerance * scale;
+    for (int i = 0; i < irls_max_iterations; i++)
     {
-        std::size_t num_vars = X.shape(0);
-        std::size_t num_constraints = B.shape(0);
+        irls_previous = x;
+        // the solver takes the square roots of the weights as column scale
+        irls_weights = (x.array().square() + eps * eps).sqrt().sqrt();
+        solve_least_squares(A, B, X, 0.0, &irls_weights);
 
-        if (DEBUG)
+        double change = (x - irls_previous).lpNorm<Eigen::Infinity>();
+        if (eps <= min_eps && change <= irls_tolerance * scale)
+            break;
+        eps = std::max(0.1 * eps, min_eps);
+    }
+}
+
+void EquationSystem::damped_step(bool clear_drag)
+{
+    std::size_t rows = A.rows();
+    Eigen::Map<const Eigen::VectorXd> b(B.data(), rows);
+    Eigen::Map<const Eigen::VectorXd> x(X.data(), A.cols());
+    Eigen::Map<const Eigen::VectorXd> r(R.data(), rows);
+    Eigen::Map<Eigen::VectorXd> ax(AX.data(), rows);
+
+    double error = b.squaredNorm();
+    if (damping < 0.0)
+    {
+        // start relative to the largest diagonal entry of A * A^T
+        double max_diagonal = 0.0;
+        for (std::size_t i = 0; i < rows; i++)
         {
-            std::cout << "Number of variables: " << num_vars << "\n";
-            std::cout << "Number of constraints: " << num_constraints << "\n";
+            max_diagonal = std::max(max_diagonal, A.row(i).squaredNorm());
         }
+        damping = 1e-6 * max_diagonal;
+    }
 
-        const double infinity = MPSolver::infinity();
-        MPModelProto model_proto;
-        model_proto.set_name("L1_Minimization");
-        std::string equations;
-
-        // add positive variables
-        for (int i = 0; i < num_vars; i++)
+    for (int tries = 0; tries < max_damping_tries; tries++)
+    {
+        solve_least_squares(A, B, X, damping);
+        for (std::size_t i = 0; i < current_params.size(); i++)
         {
-            MPVariableProto* u = model_proto.add_variable();
-            u->set_name("u" + std::to_string(i));
-            u->set_lower_bound(0.0);
-            u->set_upper_bound(infinity);
-            u->set_is_integer(false);
-            u->set_objective_coefficient(1.0);
+            current_params[i]->set_value(current_params[i]->value() - X(i));
         }
 
-        // add negative variables
-        for (int i = 0; i < num_vars; i++)
+        eval(R, clear_drag);
+        ax.noalias() = A * x;
+        double actual = error - r.squaredNorm();
+        double predicted = error - (b - ax).squaredNorm();
+        if (actual > 0.0 && predicted > 0.0)
         {
-            MPVariableProto* v = model_proto.add_variable();
-            v->set_name("v" + std::to_string(i));
-            v->set_lower_bound(0.0);
-            v->set_upper_bound(infinity);
-            v->set_is_integer(false);
-            v->set_objective_coefficient(1.0);
+            // accept, trust the linearization more the better it predicted the decrease
+            double rho = actual / predicted;
+            damping *= std::max(1.0 / 3.0, 1.0 - std::pow(2.0 * rho - 1.0, 3));
+            damping_increase = 2.0;
+            return;
         }
-        // minimize the objective function
-        model_proto.set_maximize(false);
 
-        // add constraints
-        for (int j = 0; j < num_constraints; j++)
+        // reject, go back and try a shorter step
+        for (std::size_t i = 0; i < current_params.size(); i++)
         {
-            MPConstraintProto* constraint_proto = model_proto.add_constraint();
-            constraint_proto->set_name("c" + std::to_string(j));
-            constraint_proto->set_lower_bound(B(j));
-            constraint_proto->set_upper_bound(B(j));
+            current_params[i]->set_value(current_params[i]->value() + X(i));
+        }
+        damping *= damping_increase;
+        damping_increase *= 2.0;
+    }
+}
 
-            // add positive variable coefficients to the constraint
-            for (int k = 0; k < num_vars; k++)
-            {
-                double coefficient = A(j, k);
-                if (coefficient != 0.0)
-                {
-                    constraint_proto->add_var_index(k);
-                    constraint_proto->add_coefficient(coefficient);
-                    equations += std::to_string(coefficient) + "u" + std::to_string(k) + " ";
-                }
-            }
+void EquationSystem::build_linear_program()
+{
+    using namespace operations_research;
+    std::size_t num_vars = A.cols();
+    std::size_t num_constraints = A.rows();
 
-            // add negative variable coefficients to the constraint
-            for (int k = num_vars; k < (2 * num_vars); k++)
-            {
-                double coefficient = -A(j, (k - num_vars));
-                if (coefficient != 0.0)
-                {
-                    constraint_proto->add_var_index(k);
-                    constraint_proto->add_coefficient(coefficient);
-                    equations += std::to_string(coefficient) + "v" + std::to_string(k) + " ";
-                }
-            }
+    if (DEBUG)
+    {
+        std::cout << "Number of variables: " << num_vars << "\n";
+        std::cout << "Number of constraints: " << num_constraints << "\n";
+    }
 
+    // minimize |X| as sum(u + v) with X = u - v, u >= 0, v >= 0 subject to A * X = B
+    lp = std::make_unique<MPSolver>("L1_Minimization", MPSolver::GLOP_LINEAR_PROGRAMMING);
+    const double infinity = MPSolver::infinity();
+    MPObjective* objective = lp->MutableObjective();
+    lp_u.resize(num_vars);
+    lp_v.resize(num_vars);
+    for (std::size_t i = 0; i < num_vars; i++)
+    {
+        lp_u[i] = lp->MakeNumVar(0.0, infinity, "");
+        lp_v[i] = lp->MakeNumVar(0.0, infinity, "");
+        objective->SetCoefficient(lp_u[i], 1.0);
+        objective->SetCoefficient(lp_v[i], 1.0);
+    }
+    objective->SetMinimization();
 
-            equations += "= " + std::to_string(B(j)) + "\n";
-        }
+    lp_rows.resize(num_constraints);
+    for (std::size_t j = 0; j < num_constraints; j++)
+    {
+        lp_rows[j] = lp->MakeRowConstraint(0.0, 0.0);
+    }
+}
+
+void EquationSystem::solve_linear_program(const SparseMatrix& A, const xt::xtensor<double, 1>& B,
+                                          xt::xtensor<double, 1>& X)
+{
+    using namespace operations_research;
+    if (l1_method == IRLS)
+    {
+        solve_irls(A, B, X);
+        return;
+    }
 
-        MPModelRequest model_request;
-        *model_request.mutable_model() = model_proto;
-        // set solver to glop or clp
-        model_request.set_solver_type(MPModelRequest::GLOP_LINEAR_PROGRAMMING);
-        MPSolutionResponse solution_response;
-        MPSolver::SolveWithProto(model_request, &solution_response);
+    // the model is kept between iterations, only coefficients and bounds are updated, so glop
+    // starts from the basis of the previous step
+    if (lp == nullptr)
+        build_linear_program();
 
-        // CHECK_EQ(MPSOLVER_OPTIMAL, solution_response.status());
-        if (solution_response.status() == MPSOLVER_OPTIMAL
-            || solution_response.status() == MPSOLVER_FEASIBLE)
+    for (std::size_t j = 0; j < A.rows(); j++)
+    {
+        lp_rows[j]->SetBounds(B(j), B(j));
+        for (SparseMatrix::InnerIterator it(A, j); it; ++it)
         {
-            for (int i = 0; i < num_vars; i++)
-            {
-                // x = u - v
-                double u = solution_response.variable_value(i);
-                double v = solution_response.variable_value(i + num_vars);
-                if (DEBUG)
-                {
-                    std::cout << model_proto.variable(i).name() << " = " << u << std::endl;
-                    std::cout << model_proto.variable(i + num_vars).name() << " = " << v
-                              << std::endl;
-                }
-                X(i) = u - v;
-            }
+            lp_rows[j]->SetCoefficient(lp_u[it.col()], it.value());
+            lp_rows[j]->SetCoefficient(lp_v[it.col()], -it.value());
+        }
+    }
 
-            if (DEBUG)
+    MPSolver::ResultStatus status = lp->Solve();
+    if (status == MPSolver::OPTIMAL || status == MPSolver::FEASIBLE)
+    {
+        for (std::size_t i = 0; i < A.cols(); i++)
+        {
+            // x = u - v
+            X(i) = lp_u[i]->solution_value() - lp_v[i]->solution_value();
+        }
+
+        if (DEBUG)
+        {
+            // print x for debugging output
+            std::string x_values = "X(";
+            for (std::size_t i = 0; i < A.cols(); i++)
             {
-                // print x for debugging output
-                std::string x_values = "X(";
-                for (int i = 0; i < num_vars; i++)
-                {
-                    x_values += std::to_string(X(i)) + ", ";
-                }
-                x_values += ")";
-                std::cout << x_values << std::endl;
+                x_values += std::to_string(X(i)) + ", ";
             }
+            x_values += ")";
+            std::cout << x_values << std::endl;
         }
-        else
+        return;
+    }
+
+    std::string equations;
+    for (std::size_t j = 0; j < A.rows(); j++)
+    {
+        for (SparseMatrix::InnerIterator it(A, j); it; ++it)
         {
-            std::cout << "No solution found for the following system:" << std::endl
-                      << equations << std::endl;
+            std::string k = std::to_string(it.col());
+            equations += std::to_string(it.value()) + "u" + k + " ";
+            equations += std::to_string(-it.value()) + "v" + k + " ";
         }
+        equations += "= " + std::to_string(B(j)) + "\n";
     }
-}
-
-void EquationSystem::solve_linear_program(const xt::xtensor<double, 2>& A,
-                                          const xt::xtensor<double, 1>& B,
-                                          xt::xtensor<double, 1>& X)
-{
-    operations_research::glop_solve(A, B, X);
+    std::cout << "No solution found for the following system:" << std::endl
+              << equations << std::endl;
 }
 
 
 void EquationSystem::clear()
 {
     parameters.clear();
+    parameter_index.clear();
     current_params.clear();
     equations.clear();
     source_equations.clear();
@@ -366,14 +835,84 @@ void EquationSystem::clear()
 
 bool EquationSystem::test_rank(int& dof)
 {
-    eval_jacobian(J, A, false);
-    int rank = GaussianMethod::rank(A);
-    dof = A.shape(1) - rank;
-    return rank == A.shape(0);
+    const auto& result = analyze();
+    dof = result.dof;
+    return result.rank == result.equations;
+}
+
+const DofAnalysis& EquationSystem::analyze()
+{
+    update_dirty();
+    if (!components.empty())
+    {
+        // cheap to put together again, only changed components redo their factorization
+        analysis = DofAnalysis();
+        for (const auto& component : components)
+        {
+            const auto& part = component->analyze();
+            analysis.rank += part.rank;
+            analysis.equations += part.equations;
+            analysis.free_params.insert(analysis.free_params.end(), part.free_params.begin(),
+                                        part.free_params.end());
+        }
+        for (const auto& p : current_params)
+        {
+            if (param_component[p.get()] < 0)
+                analysis.free_params.push_back(p);
+        }
+        analysis.dof = current_params.size() - analysis.rank;
+        return analysis;
+    }
+    if (is_analyzed)
+        return analysis;
+
+    analysis = DofAnalysis();
+    analysis.equations = redundant_equations.size();
+    eval_jacobian(A, false);
+    std::vector<Eigen::Triplet<double>> entries;
+    int rows = 0;
+    for (std::size_t r = 0; r < equations.size(); r++)
+    {
+        if (equations[r]->is_drag())
+            continue;
+        for (SparseMatrix::InnerIterator it(A, r); it; ++it)
+        {
+            entries.emplace_back(rows, it.col(), it.value());
+        }
+        rows++;
+    }
+    analysis.equations += rows;
+
+    std::vector<int> order;
+    if (rows > 0 && !current_params.empty())
+    {
+        Eigen::SparseMatrix<double> M(rows, current_params.size());
+        M.setFromTriplets(entries.begin(), entries.end());
+        order = GaussianMethod::independent_columns(M, analysis.rank, rows <= max_dense_size);
+    }
+    else
+    {
+        for (std::size_t c = 0; c < current_params.size(); c++)
+        {
+            order.push_back(c);
+        }
+    }
+    for (std::size_t k = analysis.rank; k < order.size(); k++)
+    {
+        analysis.free_params.push_back(current_params[order[k]]);
+    }
+    analysis.dof = current_params.size() - analysis.rank;
+    is_analyzed = true;
+    return analysis;
 }
 
 void EquationSystem::update_dirty()
 {
+    // the incremental update keeps the substitutions, it has to end up with the system a rebuild
+    // would make
+    bool is_changed = !added_equations.empty() || !removed_equations.empty();
+    if (!is_dirty && is_changed && has_pending_substitution())
+        is_dirty = true;
     if (is_dirty)
     {
         // equations = source_equations.Select(e => e.DeepClone()).ToList();
@@ -384,92 +923,737 @@ void EquationSystem::update_dirty()
             e.ReduceParams(current_params);
         }*/
         // current_params = parameters.Where(p => equations.Any(e => e.IsDependOn(p))).ToList();
-        subs = solve_by_substitution();
-
-        J = write_jacobian(equations, current_params);
-        A = xt::empty<double>(J.shape());
-        B = xt::empty<double>({ equations.size() });
-        X = xt::empty<double>({ current_params.size() });
-        Z = xt::empty<double>({ A.shape(0) });
-        AAT = xt::empty<double>({ A.shape(0), A.shape(0) });
+        subs.clear();
+        substituted.clear();
+        pending_substitutions.clear();
+        presolved.clear();
+        substitution.clear();
+        if (use_substitution)
+            subs = solve_by_substitution();
+
+        build_tape();
+        build_components();
+        added_equations.clear();
+        removed_equations.clear();
+
         old_param_value = xt::empty<double>({ parameters.size() });
+        param_store_index.reset();
         is_dirty = false;
+        is_solved = false;
+        dof_changed = true;
+        is_analyzed = false;
+        if (components.empty())
+            find_redundant();
+    }
+    else if (is_changed)
+    {
+        update_components();
         dof_changed = true;
+        is_analyzed = false;
     }
 }
 
-void EquationSystem::back_substitution(
-    std::unordered_map<std::shared_ptr<Param<double>>, std::shared_ptr<Param<double>>>& subs)
+void EquationSystem::build_tape()
 {
-    if (subs.empty())
+    tape.clear();
+    for (const auto& eq : equations)
+    {
+        tape.add(eq);
+    }
+    build_jacobian();
+
+    B = xt::empty<double>({ equations.size() });
+    X = xt::empty<double>({ current_params.size() });
+    Z = xt::empty<double>({ equations.size() });
+    R = xt::empty<double>({ equations.size() });
+    AX = xt::empty<double>({ equations.size() });
+    is_tape_dirty = false;
+}
+
+// sum of coefficient * parameter plus a constant
+struct LinearForm
+{
+    std::vector<std::pair<std::shared_ptr<Param<double>>, double>> terms;
+    std::unordered_map<const Param<double>*, std::size_t> index;
+    double constant = 0.0;
+};
+
+using LinearForms = std::unordered_map<const Param<double>*, LinearForm>;
+
+static void add_param(const std::shared_ptr<Param<double>>& p, double scale,
+                      const LinearForms& eliminated, LinearForm& form);
+
+static void add_form(const LinearForm& f, double scale, const LinearForms& eliminated,
+                     LinearForm& form)
+{
+    form.constant += scale * f.constant;
+    for (const auto& t : f.terms)
+    {
+        add_param(t.first, scale * t.second, eliminated, form);
+    }
+}
+
+// eliminated parameters are replaced by their linear form
+static void add_param(const std::shared_ptr<Param<double>>& p, double scale,
+                      const LinearForms& eliminated, LinearForm& form)
+{
+    auto it = eliminated.find(p.get());
+    if (it != eliminated.end())
+    {
+        add_form(it->second, scale, eliminated, form);
         return;
-    for (std::size_t i = 0; i < parameters.size(); i++)
+    }
+    auto i = form.index.emplace(p.get(), form.terms.size());
+    if (i.second)
+        form.terms.emplace_back(p, 0.0);
+    form.terms[i.first->second].second += scale;
+}
+
+// adds scale * e to `form`, false if e is not linear in its parameters with constant coefficients
+static bool add_linear(const std::shared_ptr<Expr>& e, double scale, const ParamSubstitution& subs,
+                       const LinearForms& eliminated, LinearForm& form)
+{
+    switch (e->op)
     {
-        auto& p = parameters[i];
-        if (subs.find(p) == subs.end())
-            continue;
-        p->set_value(subs[p]->value());
+        case Op::Const:
+            form.constant += scale * e->value;
+            return true;
+        case Op::ParamOp:
+        {
+            auto it = subs.find(e->param);
+            add_param(it != subs.end() ? it->second : e->param, scale, eliminated, form);
+            return true;
+        }
+        case Op::Add:
+            return add_linear(e->a, scale, subs, eliminated, form)
+                   && add_linear(e->b, scale, subs, eliminated, form);
+        case Op::Sub:
+            return add_linear(e->a, scale, subs, eliminated, form)
+                   && add_linear(e->b, -scale, subs, eliminated, form);
+        case Op::Neg:
+            return add_linear(e->a, -scale, subs, eliminated, form);
+        case Op::Pos:
+            return add_linear(e->a, scale, subs, eliminated, form);
+        case Op::Mul:
+            if (e->a->is_const())
+                return add_linear(e->b, scale * e->a->value, subs, eliminated, form);
+            if (e->b->is_const())
+                return add_linear(e->a, scale * e->b->value, subs, eliminated, form);
+            return false;
+        case Op::Div:
+            if (e->b->is_const() && std::abs(e->b->value) > GaussianMethod::epsilon)
+                return add_linear(e->a, scale / e->b->value, subs, eliminated, form);
+            return false;
+        default:
+            return false;
+    }
+}
+
+static bool is_linear(const std::shared_ptr<Expr>& e)
+{
+    LinearForm form;
+    return add_linear(e, 1.0, ParamSubstitution(), LinearForms(), form);
+}
+
+static std::shared_ptr<Expr> to_expr(const LinearForm& form)
+{
+    std::shared_ptr<Expr> e = expr(form.constant);
+    for (const auto& t : form.terms)
+    {
+        e = e + expr(t.second) * t.first->expr();
+    }
+    return e;
+}
+
+// equations that don't change the substitutions can be added to or removed from the components
+// directly, without going through a full rebuild
+bool EquationSystem::is_incremental(const std::shared_ptr<Expr>& eq)
+{
+    return !is_dirty && !components.empty() && !eq->is_substitution_form()
+           && !(use_presolve && is_linear(eq));
+}
+
+bool EquationSystem::has_pending_substitution() const
+{
+    auto root = [this](const std::shared_ptr<Param<double>>& p) {
+        auto it = subs.find(p);
+        return it != subs.end() ? it->second : p;
+    };
+    for (const auto& eq : pending_substitutions)
+    {
+        auto a = root(eq->get_substitution_param_a());
+        auto b = root(eq->get_substitution_param_b());
+        if (a != b && std::abs(a->value() - b->value()) <= GaussianMethod::epsilon
+            && (parameter_index.count(a.get()) != 0 || parameter_index.count(b.get()) != 0))
+            return true;
+    }
+    return false;
+}
+
+static void collect_params(const std::shared_ptr<Expr>& e,
+                           std::vector<std::shared_ptr<Param<double>>>& params)
+{
+    if (e->op == Op::ParamOp)
+    {
+        params.push_back(e->param);
+        return;
+    }
+    if (e->a != nullptr)
+        collect_params(e->a, params);
+    if (e->b != nullptr)
+        collect_params(e->b, params);
+}
+
+void EquationSystem::update_components()
+{
+    for (const auto& source : removed_equations)
+    {
+        auto eq = substituted_form(source);
+        substituted.erase(source.get());
+        auto it = equation_component.find(eq.get());
+        components[it->second]->remove_equation(eq);
+        equation_component.erase(it);
+        equations.erase(std::find(equations.begin(), equations.end(), eq));
+    }
+
+    std::vector<std::shared_ptr<Param<double>>> params;
+    std::unordered_map<const Expr*, std::shared_ptr<Expr>> rewritten;
+    for (const auto& source : added_equations)
+    {
+        auto eq = substitute(source, substitution, rewritten);
+        if (eq != source)
+            substituted[source.get()] = eq;
+
+        // the new equation joins all the components of the unknowns it depends on
+        params.clear();
+        collect_params(eq, params);
+        int target = -1;
+        std::vector<int> joined;
+        std::vector<std::shared_ptr<Param<double>>> unused;
+        for (const auto& p : params)
+        {
+            auto it = param_component.find(p.get());
+            if (it == param_component.end())
+                continue;
+            if (it->second < 0)
+            {
+                unused.push_back(p);
+                continue;
+            }
+            if (std::find(joined.begin(), joined.end(), it->second) != joined.end())
+                continue;
+            joined.push_back(it->second);
+            if (target < 0
+                || components[it->second]->equations.size()
+                       > components[target]->equations.size())
+                target = it->second;
+        }
+        if (target < 0 && unused.empty())
+        {
+            if (constant_component < 0)
+                constant_component = add_component();
+            target = constant_component;
+        }
+        else if (target < 0)
+        {
+            target = add_component();
+        }
+
+        EquationSystem& component = *components[target];
+        for (int id : joined)
+        {
+            if (id == target)
+                continue;
+            // merged components are left empty, they are dropped on the next full rebuild
+            EquationSystem& other = *components[id];
+            for (const auto& e : other.source_equations)
+            {
+                component.add_equation(e);
+                equation_component[e.get()] = target;
+            }
+            for (const auto& p : other.parameters)
+            {
+                component.add_parameter(p);
+                param_component[p.get()] = target;
+            }
+            other.clear();
+        }
+        for (const auto& p : unused)
+        {
+            component.add_parameter(p);
+            param_component[p.get()] = target;
+        }
+        component.add_equation(eq);
+        equation_component[eq.get()] = target;
+        equations.push_back(eq);
     }
+
+    component_results.resize(components.size(), SolveResult::OKAY);
+    added_equations.clear();
+    removed_equations.clear();
+    is_tape_dirty = true;
 }
 
-std::unordered_map<std::shared_ptr<Param<double>>, std::shared_ptr<Param<double>>>
-EquationSystem::solve_by_substitution()
+void EquationSystem::back_substitution(const ParamSubstitution& subs)
 {
-    std::unordered_map<std::shared_ptr<Param<double>>, std::shared_ptr<Param<double>>> subs;
+    for (const auto& p : presolved)
+    {
+        p.first->set_value(p.second->eval());
+    }
+    for (const auto& kv : subs)
+    {
+        if (parameter_index.count(kv.first.get()) != 0)
+            kv.first->set_value(kv.second->value());
+    }
+}
+
+ParamSubstitution EquationSystem::solve_by_substitution()
+{
+    ParamSubstitution subs;
+    substituted.clear();
+    pending_substitutions.clear();
     if (DEBUG)
         std::cout << "Solving by substitution" << std::endl;
+
+    // union-find over the parameters of the substitution equations, the root of a set is the
+    // parameter all others of the set are replaced with
+    std::unordered_set<const Param<double>*> unknowns;
+    for (const auto& p : current_params)
+    {
+        unknowns.insert(p.get());
+    }
+    std::unordered_map<const Param<double>*, int> index;
+    std::vector<std::shared_ptr<Param<double>>> params;
+    std::vector<int> parent;
+    auto node = [&](const std::shared_ptr<Param<double>>& p) {
+        auto it = index.emplace(p.get(), params.size());
+        if (it.second)
+        {
+            params.push_back(p);
+            parent.push_back(parent.size());
+        }
+        return it.first->second;
+    };
+    auto find = [&parent](int i) {
+        while (parent[i] != i)
+        {
+            parent[i] = parent[parent[i]];
+            i = parent[i];
+        }
+        return i;
+    };
+
+    std::vector<bool> is_removed(equations.size(), false);
     for (std::size_t i = 0; i < equations.size(); i++)
     {
-        auto& eq = equations[i];
+        const auto& eq = equations[i];
         if (!eq->is_substitution_form())
+            continue;
+        int a = find(node(eq->get_substitution_param_a()));
+        int b = find(node(eq->get_substitution_param_b()));
+        if (a == b)
         {
+            // already implied by the previous substitutions
+            is_removed[i] = true;
             continue;
         }
-        auto a = eq->get_substitution_param_a();
-        auto b = eq->get_substitution_param_b();
-        if (std::abs(a->value() - b->value()) > GaussianMethod::epsilon)
+        bool is_a_unknown = unknowns.count(params[a].get()) != 0;
+        bool is_b_unknown = unknowns.count(params[b].get()) != 0;
+        if (!is_a_unknown && !is_b_unknown)
             continue;
-        // check if b in current params
-        if (std::find(current_params.begin(), current_params.end(), b) != current_params.end())
+        if (std::abs(params[a]->value() - params[b]->value()) > GaussianMethod::epsilon)
         {
-            // check if pointer swap is enough?!
-            std::swap(a, b);
+            pending_substitutions.push_back(eq);
+            continue;
         }
-        // TODO: Check errors
-        // if(!parameters.Contains(b)) {
-        //  continue;
-        //}
+        // a is replaced by b, unless a is not an unknown
+        if (!is_a_unknown)
+            std::swap(a, b);
+        parent[a] = b;
+        is_removed[i] = true;
+    }
+
+    for (std::size_t i = 0; i < params.size(); i++)
+    {
+        int root = find(i);
+        if (root != i)
+            subs[params[i]] = params[root];
+    }
+
+    current_params.erase(std::remove_if(current_params.begin(), current_params.end(),
+                                        [&subs](const std::shared_ptr<Param<double>>& p) {
+                                            return subs.count(p) != 0;
+                                        }),
+                         current_params.end());
+
+    if (use_presolve)
+        presolve(subs, is_removed);
+    for (const auto& p : presolved)
+    {
+        substitution[p.first] = p.second;
+    }
+    for (const auto& kv : subs)
+    {
+        auto it = substitution.find(kv.second);
+        substitution[kv.first] = it != substitution.end() ? it->second : kv.second->expr();
+    }
+
+    // the equations are rewritten in a single pass, the source equations are left untouched
+    std::unordered_map<const Expr*, std::shared_ptr<Expr>> rewritten;
+    std::size_t count = 0;
+    for (std::size_t i = 0; i < equations.size(); i++)
+    {
+        if (is_removed[i])
+            continue;
+        auto eq = substitute(equations[i], substitution, rewritten);
+        if (eq != equations[i])
+            substituted[equations[i].get()] = eq;
+        equations[count++] = eq;
+    }
+    equations.resize(count);
+    return subs;
+}
+
+void EquationSystem::presolve(const ParamSubstitution& subs, std::vector<bool>& is_removed)
+{
+    std::unordered_set<const Param<double>*> unknowns;
+    for (const auto& p : current_params)
+    {
+        unknowns.insert(p.get());
+    }
+
+    // eliminated unknowns are expressed by the parameters that were left at the time, equations
+    // are revisited when one of their unknowns is eliminated
+    LinearForms eliminated;
+    std::vector<std::shared_ptr<Param<double>>> order;
+    std::unordered_map<const Param<double>*, std::vector<std::size_t>> param_equations;
+    std::vector<std::size_t> queue;
+    for (std::size_t i = 0; i < equations.size(); i++)
+    {
+        if (!is_removed[i] && is_linear(equations[i]))
+            queue.push_back(i);
+    }
+    for (std::size_t head = 0; head < queue.size(); head++)
+    {
+        std::size_t i = queue[head];
+        if (is_removed[i])
+            continue;
+        LinearForm form;
+        add_linear(equations[i], 1.0, subs, eliminated, form);
 
-        for (auto& kv : subs)
+        std::shared_ptr<Param<double>> pivot;
+        double coefficient = 0.0;
+        int count = 0;
+        for (const auto& t : form.terms)
         {
-            if (subs[kv.first] == b)
+            if (std::abs(t.second) <= GaussianMethod::epsilon || unknowns.count(t.first.get()) == 0)
+                continue;
+            count++;
+            param_equations[t.first.get()].push_back(i);
+            if (std::abs(t.second) > std::abs(coefficient))
             {
-                subs[kv.first] = a;
+                pivot = t.first;
+                coefficient = t.second;
             }
         }
-        subs[b] = a;
+        if (count == 0 || (count > 1 && !eliminate_linear))
+            continue;
 
-        equations.erase(equations.begin() + i);
-        i--;
-        current_params.erase(std::find(current_params.begin(), current_params.end(), b));
-        for (std::size_t j = 0; j < equations.size(); j++)
+        LinearForm& solved = eliminated[pivot.get()];
+        solved.constant = -form.constant / coefficient;
+        for (const auto& t : form.terms)
+        {
+            if (t.first != pivot && std::abs(t.second) > GaussianMethod::epsilon)
+                add_param(t.first, -t.second / coefficient, LinearForms(), solved);
+        }
+        unknowns.erase(pivot.get());
+        order.push_back(pivot);
+        is_removed[i] = true;
+        for (std::size_t j : param_equations[pivot.get()])
         {
-            equations[j]->substitute(b, a);
+            if (!is_removed[j])
+                queue.push_back(j);
         }
     }
-    return subs;
+    if (order.empty())
+        return;
+
+    // a form only refers to unknowns eliminated after it, so going backwards every form can be
+    // expanded by the final ones
+    for (std::size_t k = order.size(); k-- > 0;)
+    {
+        auto it = eliminated.find(order[k].get());
+        LinearForm expanded;
+        add_form(it->second, 1.0, eliminated, expanded);
+        it->second = std::move(expanded);
+        presolved.emplace_back(order[k], to_expr(it->second));
+    }
+    current_params.erase(std::remove_if(current_params.begin(), current_params.end(),
+                                        [&eliminated](const std::shared_ptr<Param<double>>& p) {
+                                            return eliminated.count(p.get()) != 0;
+                                        }),
+                         current_params.end());
+}
+
+const std::shared_ptr<Expr>&
+EquationSystem::substituted_form(const std::shared_ptr<Expr>& eq) const
+{
+    auto it = substituted.find(eq.get());
+    return it != substituted.end() ? it->second : eq;
+}
+
+void EquationSystem::find_redundant()
+{
+    redundant_equations.clear();
+    if (!remove_redundant || use_iterative_solver || equations.empty())
+        return;
+
+    // the same equation twice is always redundant, drag equations are never left out and
+    // equations without unknowns are not part of the steps anyway
+    std::vector<bool> is_redundant(equations.size(), false);
+    std::unordered_set<const Expr*> seen;
+    std::vector<int> rows;
+    const int* outer = A.outerIndexPtr();
+    for (std::size_t r = 0; r < equations.size(); r++)
+    {
+        if (equations[r]->is_drag() || outer[r] == outer[r + 1])
+            continue;
+        if (!seen.insert(equations[r].get()).second)
+        {
+            is_redundant[r] = true;
+            continue;
+        }
+        rows.push_back(r);
+    }
+
+    if (rows.empty())
+        return;
+
+    // QR of A^T pivots over the rows of A
+    eval_jacobian(A, false);
+    std::vector<Eigen::Triplet<double>> entries;
+    for (std::size_t k = 0; k < rows.size(); k++)
+    {
+        for (SparseMatrix::InnerIterator it(A, rows[k]); it; ++it)
+        {
+            entries.emplace_back(it.col(), k, it.value());
+        }
+    }
+    Eigen::SparseMatrix<double> AT(A.cols(), rows.size());
+    AT.setFromTriplets(entries.begin(), entries.end());
+    int rank;
+    auto order = GaussianMethod::independent_columns(AT, rank, rows.size() <= max_dense_size);
+    for (std::size_t k = rank; k < order.size(); k++)
+    {
+        is_redundant[rows[order[k]]] = true;
+    }
+
+    std::size_t count = 0;
+    for (std::size_t r = 0; r < equations.size(); r++)
+    {
+        if (is_redundant[r])
+            redundant_equations.push_back(equations[r]);
+        else
+            equations[count++] = equations[r];
+    }
+    if (redundant_equations.empty())
+        return;
+    equations.resize(count);
+    build_tape();
+}
+
+bool EquationSystem::check_redundant()
+{
+    // the rows were only dependent at the point the system was built, e.g. for a degenerate
+    // configuration, so they are solved for again
+    for (const auto& eq : redundant_equations)
+    {
+        if (std::abs(eq->eval()) < GaussianMethod::epsilon)
+            continue;
+        equations.insert(equations.end(), redundant_equations.begin(), redundant_equations.end());
+        redundant_equations.clear();
+        build_tape();
+        return false;
+    }
+    return true;
+}
+
+std::vector<std::shared_ptr<Expr>> EquationSystem::get_redundant_equations() const
+{
+    std::unordered_set<const Expr*> redundant;
+    for (const auto& eq : redundant_equations)
+    {
+        redundant.insert(eq.get());
+    }
+    for (const auto& component : components)
+    {
+        for (const auto& eq : component->redundant_equations)
+        {
+            redundant.insert(eq.get());
+        }
+    }
+    std::vector<std::shared_ptr<Expr>> result;
+    for (const auto& eq : source_equations)
+    {
+        if (redundant.count(substituted_form(eq).get()) != 0)
+            result.push_back(eq);
+    }
+    return result;
+}
+
+int EquationSystem::add_component()
+{
+    auto component = std::make_unique<EquationSystem>();
+    component->decompose = false;
+    component->use_substitution = false;
+    component->use_presolve = false;
+    components.push_back(std::move(component));
+    return components.size() - 1;
+}
+
+void EquationSystem::build_components()
+{
+    components.clear();
+    component_results.clear();
+    equation_component.clear();
+    param_component.clear();
+    constant_component = -1;
+    if (!decompose)
+        return;
+
+    // union-find over the columns, every equation joins the parameters it depends on
+    std::vector<int> parent(current_params.size());
+    for (std::size_t c = 0; c < parent.size(); c++)
+    {
+        parent[c] = c;
+    }
+    auto find = [&parent](int c) {
+        while (parent[c] != c)
+        {
+            parent[c] = parent[parent[c]];
+            c = parent[c];
+        }
+        return c;
+    };
+    const int* outer = A.outerIndexPtr();
+    const int* inner = A.innerIndexPtr();
+    for (std::size_t r = 0; r < equations.size(); r++)
+    {
+        for (int k = outer[r] + 1; k < outer[r + 1]; k++)
+        {
+            parent[find(inner[k])] = find(inner[outer[r]]);
+        }
+    }
+
+    // equations without any unknown are put together in one more component
+    std::vector<int> component_of_root(current_params.size(), -1);
+    int count = 0;
+    for (std::size_t r = 0; r < equations.size(); r++)
+    {
+        int& id = outer[r] == outer[r + 1] ? constant_component
+                                           : component_of_root[find(inner[outer[r]])];
+        if (id < 0)
+            id = count++;
+        equation_component[equations[r].get()] = id;
+    }
+
+    for (int i = 0; i < count; i++)
+    {
+        add_component();
+    }
+    for (const auto& eq : equations)
+    {
+        components[equation_component[eq.get()]]->add_equation(eq);
+    }
+    // unknowns no equation depends on yet are recorded with -1
+    for (std::size_t c = 0; c < current_params.size(); c++)
+    {
+        int id = component_of_root[find(c)];
+        param_component[current_params[c].get()] = id;
+        if (id >= 0)
+            components[id]->add_parameter(current_params[c]);
+    }
+    component_results.assign(count, SolveResult::OKAY);
+}
+
+SolveResult EquationSystem::solve_components()
+{
+    std::size_t size = 0;
+    for (auto& component : components)
+    {
+        component->max_steps = max_steps;
+        component->drag_steps = drag_steps;
+        component->revert_when_not_converged = revert_when_not_converged;
+        component->use_linear_program = use_linear_program;
+        component->use_damping = use_damping;
+        component->l1_method = l1_method;
+        component->irls_max_iterations = irls_max_iterations;
+        component->irls_tolerance = irls_tolerance;
+        component->max_damping_tries = max_damping_tries;
+        component->use_quasi_newton = use_quasi_newton;
+        component->quasi_newton_contraction = quasi_newton_contraction;
+        component->use_iterative_solver = use_iterative_solver;
+        component->iterative_tolerance = iterative_tolerance;
+        component->max_iterative_steps = max_iterative_steps;
+        component->use_jacobi_preconditioner = use_jacobi_preconditioner;
+        component->max_dense_size = max_dense_size;
+        component->remove_redundant = remove_redundant;
+        size += component->equations.size();
+    }
+
+    auto solve_component = [this](std::size_t i) { component_results[i] = components[i]->solve(); };
+    if (size >= min_parallel_size)
+    {
+        ThreadPool::shared().parallel_for(components.size(), solve_component);
+    }
+    else
+    {
+        for (std::size_t i = 0; i < components.size(); i++)
+        {
+            solve_component(i);
+        }
+    }
+
+    // components that didn't converge have reverted their own parameters already
+    back_substitution(subs);
+    counted_steps = 0;
+    SolveResult result = SolveResult::OKAY;
+    for (std::size_t i = 0; i < components.size(); i++)
+    {
+        counted_steps = std::max(counted_steps, components[i]->counted_steps);
+        dof_changed = dof_changed || components[i]->dof_changed;
+        if (component_results[i] == SolveResult::DIDNT_CONVERGE)
+            result = SolveResult::DIDNT_CONVERGE;
+        else if (component_results[i] != SolveResult::OKAY && result == SolveResult::OKAY)
+            result = component_results[i];
+    }
+    return result;
 }
 
 SolveResult EquationSystem::solve()
 {
     dof_changed = false;
     update_dirty();
+    if (!components.empty())
+        return solve_components();
+    // e.g. a component that is not connected to the dragged point
+    if (!is_changed_since_solved())
+    {
+        back_substitution(subs);
+        counted_steps = 0;
+        return SolveResult::OKAY;
+    }
     store_params();
+    damping = -1.0;
+    damping_increase = 2.0;
+    double previous_error = 0.0;
+    bool was_chord_step = false;
     int steps = 0;
     do
     {
         bool is_drag_step = steps <= drag_steps;
         eval(B, /*clear_drag*/ !is_drag_step);
+        double error = Eigen::Map<const Eigen::VectorXd>(B.data(), B.size()).squaredNorm();
         /*
         if(steps > 0) {
             BackSubstitution(subs);
@@ -477,11 +1661,20 @@ SolveResult EquationSystem::solve()
         }
         */
 
-        if (is_converged(is_drag_step))
+        bool converged = is_converged(is_drag_step);
+        if (converged && !check_redundant())
+        {
+            // the redundant equations are part of the system again, this step solves for them too
+            eval(B, /*clear_drag*/ !is_drag_step);
+            error = Eigen::Map<const Eigen::VectorXd>(B.data(), B.size()).squaredNorm();
+            converged = false;
+        }
+        if (converged)
         {
             if (steps > 0)
             {
                 dof_changed = true;
+                is_analyzed = false;
                 // std::cout << "Solved " << equations.size() << " equations with "
                 //           << current_params.size() << " unknowns in " << steps << " steps.\n";
             }
@@ -490,6 +1683,7 @@ SolveResult EquationSystem::solve()
             back_substitution(subs);
             if (DEBUG)
             {
+                auto J = write_jacobian(equations, current_params);
                 for (std::size_t i = 0; i < J.shape(0); ++i)
                 {
                     for (std::size_t j = 0; j < J.shape(1); ++j)
@@ -504,16 +1698,55 @@ SolveResult EquationSystem::solve()
                 }
             }
             counted_steps = steps;
+            store_solved_values();
+            // equations left out as redundant are reported by get_redundant_equations
             return SolveResult::OKAY;
         }
-        eval_jacobian(J, A, !is_drag_step);
-        if (use_linear_program)
+        // a chord step that increased the residual is taken back, and done again from the
+        // previous point with a fresh jacobian. Clearing the drag equations doesn't increase the
+        // residual, so this holds for the last drag step as well
+        bool is_rejected = was_chord_step && error > previous_error;
+        if (is_rejected)
         {
-            solve_linear_program(A, B, X);
+            for (int i = 0; i < current_params.size(); i++)
+            {
+                current_params[i]->set_value(current_params[i]->value() + X(i));
+            }
+            eval(B, /*clear_drag*/ !is_drag_step);
+            error = previous_error;
         }
-        else
+        // the factorization of the previous step is kept while the residual contracts, a solve
+        // starts with the last one of the previous solve, e.g. of the previous drag position
+        bool is_contracting = !is_rejected
+                              && (steps == 0
+                                  || error < quasi_newton_contraction * quasi_newton_contraction
+                                                 * previous_error);
+        previous_error = error;
+        bool is_iterative_step = use_iterative_solver && !use_damping && !use_linear_program;
+        bool is_chord_step = use_quasi_newton && !use_damping && !use_linear_program
+                             && !is_iterative_step && is_contracting
+                             && solve_factorized(B, X, !is_drag_step);
+        was_chord_step = is_chord_step;
+        if (is_iterative_step)
         {
-            solve_least_squares(A, B, X);
+            solve_iterative(B, X, /*clear_drag*/ !is_drag_step);
+        }
+        else if (!is_chord_step)
+        {
+            eval_jacobian(A, !is_drag_step);
+            if (use_damping && !use_linear_program)
+            {
+                damped_step(/*clear_drag*/ !is_drag_step);
+                continue;
+            }
+            if (use_linear_program)
+            {
+                solve_linear_program(A, B, X);
+            }
+            else
+            {
+                solve_least_squares(A, B, X);
+            }
         }
 
         for (int i = 0; i < current_params.size(); i++)
@@ -524,6 +1757,7 @@ SolveResult EquationSystem::solve()
 
     if (DEBUG)
     {
+        auto J = write_jacobian(equations, current_params);
         for (std::size_t i = 0; i < J.shape(0); ++i)
         {
             for (std::size_t j = 0; j < J.shape(1); ++j)
@@ -545,7 +1779,12 @@ SolveResult EquationSystem::solve()
         revert_params();
         dof_changed = false;
     }
+    else
+    {
+        is_analyzed = false;
+    }
 
+    is_solved = false;
     counted_steps = steps;
     return SolveResult::DIDNT_CONVERGE;
 }
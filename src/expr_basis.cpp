@@ -93,7 +93,7 @@ bool ExpBasis::changed()
 {
     bool changed = false;
     apply_each_param([&changed](auto& p) {
-        if (!changed && p->m_changed)
+        if (!changed && p->is_changed())
         {
             changed = true;
         }
@@ -103,7 +103,7 @@ bool ExpBasis::changed()
 
 void ExpBasis::mark_unchanged()
 {
-    apply_each_param([](auto& p) { p->m_changed = false; });
+    apply_each_param([](auto& p) { p->set_changed(false); });
 }
 
 /**
@@ -187,7 +187,7 @@ bool ExpBasis2d::changed()
 {
     bool changed = false;
     apply_each_param([&changed](auto& p) {
-        if (!changed && p->m_changed)
+        if (!changed && p->is_changed())
         {
             changed = true;
         }
@@ -197,5 +197,5 @@ bool ExpBasis2d::changed()
 
 void ExpBasis2d::mark_unchanged()
 {
-    apply_each_param([](auto& p) { p->m_changed = false; });
+    apply_each_param([](auto& p) { p->set_changed(false); });
 }
\ No newline at end of file
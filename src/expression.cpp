@@ -2,20 +2,31 @@
 #include <memory>
 #include <cmath>
 #include <iostream>
+#include <algorithm>
 
 #include "expression.hpp"
 
 std::shared_ptr<Expr> expr(double);
 
+// allocates a new node, or returns the interned one if an arena is active
+static std::shared_ptr<Expr> make_expr(const Op& op, const std::shared_ptr<Expr>& a,
+                                       const std::shared_ptr<Expr>& b = nullptr)
+{
+    ExprArena* arena = ExprArena::current();
+    if (arena != nullptr)
+        return arena->intern(op, a, b);
+    return std::make_shared<Expr>(op, a, b);
+}
+
 std::shared_ptr<Expr> operator-(const std::shared_ptr<Expr>& a)
 {
     if (a->is_zero_const())
         return a;
     if (a->is_const())
-        return std::make_shared<Expr>(-a->value);
+        return expr(-a->value);
     if (a->op == Op::Neg)
         return a->a;
-    return std::make_shared<Expr>(Op::Neg, a, nullptr);
+    return make_expr(Op::Neg, a);
 }
 
 std::shared_ptr<Expr> operator-(const std::shared_ptr<Expr>& a, const std::shared_ptr<Expr>& b)
@@ -24,7 +35,7 @@ std::shared_ptr<Expr> operator-(const std::shared_ptr<Expr>& a, const std::share
         return -b;
     if (b->is_zero_const())
         return a;
-    return std::make_shared<Expr>(Op::Sub, a, b);
+    return make_expr(Op::Sub, a, b);
 }
 
 std::shared_ptr<Expr> operator+(const std::shared_ptr<Expr>& a, const std::shared_ptr<Expr>& b)
@@ -37,7 +48,7 @@ std::shared_ptr<Expr> operator+(const std::shared_ptr<Expr>& a, const std::share
         return a - b->a;
     if (b->op == Op::Pos)
         return a + b->a;
-    return std::make_shared<Expr>(Op::Add, a, b);
+    return make_expr(Op::Add, a, b);
 }
 
 std::shared_ptr<Expr> operator*(const std::shared_ptr<Expr>& a, const std::shared_ptr<Expr>& b)
@@ -55,8 +66,8 @@ std::shared_ptr<Expr> operator*(const std::shared_ptr<Expr>& a, const std::share
     if (b->is_minus_one_const())
         return -a;
     if (a->is_const() && b->is_const())
-        return std::make_shared<Expr>(a->value * b->value);
-    return std::make_shared<Expr>(Op::Mul, a, b);
+        return expr(a->value * b->value);
+    return make_expr(Op::Mul, a, b);
 }
 
 std::shared_ptr<Expr> operator/(const std::shared_ptr<Expr>& a, const std::shared_ptr<Expr>& b)
@@ -67,64 +78,64 @@ std::shared_ptr<Expr> operator/(const std::shared_ptr<Expr>& a, const std::share
         return zero;
     if (b->is_minus_one_const())
         return -a;
-    return std::make_shared<Expr>(Op::Div, a, b);
+    return make_expr(Op::Div, a, b);
 }
 
 std::shared_ptr<Expr> sin(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::Sin, x);
+    return make_expr(Op::Sin, x);
 }
 std::shared_ptr<Expr> cos(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::Cos, x);
+    return make_expr(Op::Cos, x);
 }
 std::shared_ptr<Expr> acos(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::ACos, x);
+    return make_expr(Op::ACos, x);
 }
 std::shared_ptr<Expr> asin(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::ASin, x);
+    return make_expr(Op::ASin, x);
 }
 std::shared_ptr<Expr> sqrt(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::Sqrt, x);
+    return make_expr(Op::Sqrt, x);
 }
 std::shared_ptr<Expr> sqr(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::Sqr, x);
+    return make_expr(Op::Sqr, x);
 }
 std::shared_ptr<Expr> abs(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::Abs, x);
+    return make_expr(Op::Abs, x);
 }
 std::shared_ptr<Expr> sign(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::Sign, x);
+    return make_expr(Op::Sign, x);
 }
 std::shared_ptr<Expr> atan2(const std::shared_ptr<Expr>& x, const std::shared_ptr<Expr>& y)
 {
-    return std::make_shared<Expr>(Op::Atan2, x, y);
+    return make_expr(Op::Atan2, x, y);
 }
 std::shared_ptr<Expr> expo(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::Exp, x);
+    return make_expr(Op::Exp, x);
 }
 std::shared_ptr<Expr> sinh(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::Sinh, x);
+    return make_expr(Op::Sinh, x);
 }
 std::shared_ptr<Expr> cosh(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::Cosh, x);
+    return make_expr(Op::Cosh, x);
 }
 std::shared_ptr<Expr> sfres(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::SFres, x);
+    return make_expr(Op::SFres, x);
 }
 std::shared_ptr<Expr> cfres(const std::shared_ptr<Expr>& x)
 {
-    return std::make_shared<Expr>(Op::CFres, x);
+    return make_expr(Op::CFres, x);
 }
 
 
@@ -303,7 +314,7 @@ std::string Expr::to_string()
         case Op::Const:
             return std::to_string(value);
         case Op::ParamOp:
-            return param->m_name;
+            return param->name();
         case Op::Add:
             return a->to_string() + " + " + b->to_string();
         case Op::Sub:
@@ -424,6 +435,9 @@ std::shared_ptr<Expr> Expr::d(const std::shared_ptr<Param<double>>& p)
 
 std::shared_ptr<Expr> expr(double value)
 {
+    ExprArena* arena = ExprArena::current();
+    if (arena != nullptr)
+        return arena->constant(value);
     return std::make_shared<Expr>(value);
 }
 
@@ -491,6 +505,31 @@ void Expr::substitute(std::shared_ptr<Param<double>>& p, std::shared_ptr<Expr> e
     }
 }
 
+std::shared_ptr<Expr> substitute(const std::shared_ptr<Expr>& e, const ExprSubstitution& subs,
+                                 std::unordered_map<const Expr*, std::shared_ptr<Expr>>& rewritten)
+{
+    auto it = rewritten.find(e.get());
+    if (it != rewritten.end())
+        return it->second;
+
+    std::shared_ptr<Expr> result = e;
+    if (e->op == Op::ParamOp)
+    {
+        auto sub = subs.find(e->param);
+        if (sub != subs.end())
+            result = sub->second;
+    }
+    else if (e->a != nullptr)
+    {
+        auto a = substitute(e->a, subs, rewritten);
+        auto b = e->b != nullptr ? substitute(e->b, subs, rewritten) : nullptr;
+        if (a != e->a || b != e->b)
+            result = std::make_shared<Expr>(e->op, a, b);
+    }
+    rewritten[e.get()] = result;
+    return result;
+}
+
 bool Expr::has_two_operands() const
 {
     return a != nullptr && b != nullptr;
@@ -502,6 +541,100 @@ Op Expr::get_op() const
 }
 
 
+static thread_local ExprArena* current_arena = nullptr;
+
+ExprArena::Scope::Scope(ExprArena& arena)
+    : previous(current_arena)
+{
+    current_arena = &arena;
+}
+
+ExprArena::Scope::~Scope()
+{
+    current_arena = previous;
+}
+
+ExprArena* ExprArena::current()
+{
+    return current_arena;
+}
+
+std::size_t ExprArena::KeyHash::operator()(const Key& k) const
+{
+    std::size_t h = std::hash<int>()(k.op);
+    h ^= std::hash<const Expr*>()(k.a) + 0x9e3779b9 + (h << 6) + (h >> 2);
+    h ^= std::hash<const Expr*>()(k.b) + 0x9e3779b9 + (h << 6) + (h >> 2);
+    h ^= std::hash<double>()(k.value) + 0x9e3779b9 + (h << 6) + (h >> 2);
+    return h;
+}
+
+std::shared_ptr<Expr> ExprArena::lookup(const Key& key)
+{
+    auto it = nodes.find(key);
+    if (it == nodes.end())
+        return nullptr;
+    // an expired entry means the node (and with it the children in its key) is gone
+    return it->second.lock();
+}
+
+void ExprArena::insert(const Key& key, const std::shared_ptr<Expr>& e)
+{
+    if (nodes.size() >= purge_at)
+    {
+        for (auto it = nodes.begin(); it != nodes.end();)
+        {
+            if (it->second.expired())
+                it = nodes.erase(it);
+            else
+                ++it;
+        }
+        purge_at = std::max<std::size_t>(1024, 2 * nodes.size());
+    }
+    nodes[key] = e;
+}
+
+std::shared_ptr<Expr> ExprArena::intern(const Op& op, const std::shared_ptr<Expr>& a,
+                                        const std::shared_ptr<Expr>& b)
+{
+    Key key{ op, a.get(), b.get(), 0.0 };
+    auto e = lookup(key);
+    if (e == nullptr)
+    {
+        e = std::make_shared<Expr>(op, a, b);
+        insert(key, e);
+    }
+    return e;
+}
+
+std::shared_ptr<Expr> ExprArena::constant(double value)
+{
+    Key key{ Op::Const, nullptr, nullptr, value };
+    auto e = lookup(key);
+    if (e == nullptr)
+    {
+        e = std::make_shared<Expr>(value);
+        insert(key, e);
+    }
+    return e;
+}
+
+std::size_t ExprArena::size()
+{
+    std::size_t count = 0;
+    for (const auto& kv : nodes)
+    {
+        if (!kv.second.expired())
+            count++;
+    }
+    return count;
+}
+
+void ExprArena::clear()
+{
+    nodes.clear();
+    purge_at = 1024;
+}
+
 // public void Walk(Action<Exp> action) {
 //  action(this);
 //  if(a != null) {
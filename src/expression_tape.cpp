@@ -0,0 +1,373 @@
+#include <vector>
+#include <memory>
+#include <cmath>
+#include <algorithm>
+
+#include "expression.hpp"
+#include "expression_tape.hpp"
+
+// result of a division, with the same guard against tiny denominators as Expr::eval
+static inline double safe_div(double a, double b)
+{
+    if (std::abs(b) < 1e-10)
+    {
+        b = 1.0;
+    }
+    return a / b;
+}
+
+// same semantics as Expr::eval, but on already evaluated operands
+static inline double apply(Op op, double a, double b)
+{
+    switch (op)
+    {
+        case Op::Add:
+            return a + b;
+        case Op::Drag:
+        case Op::Sub:
+            return a - b;
+        case Op::Mul:
+            return a * b;
+        case Op::Div:
+            return safe_div(a, b);
+        case Op::Sin:
+            return std::sin(a);
+        case Op::Cos:
+            return std::cos(a);
+        case Op::ACos:
+            return std::acos(a);
+        case Op::ASin:
+            return std::asin(a);
+        case Op::Sqrt:
+            return std::sqrt(a);
+        case Op::Sqr:
+            return a * a;
+        case Op::Atan2:
+            return std::atan2(a, b);
+        case Op::Abs:
+            return std::abs(a);
+        case Op::Sign:
+            return sign(a);
+        case Op::Neg:
+            return -a;
+        case Op::Pos:
+            return a;
+        case Op::Exp:
+            return std::exp(a);
+        case Op::Sinh:
+            return std::sinh(a);
+        case Op::Cosh:
+            return std::cosh(a);
+        case Op::SFres:
+            return s_fres(a);
+        case Op::CFres:
+            return c_fres(a);
+    }
+    return 0.0;
+}
+
+// partial derivatives of `op` by its operands, mirroring the rules of Expr::d
+static inline void partials(Op op, double a, double b, double out, double& da, double& db)
+{
+    db = 0.0;
+    switch (op)
+    {
+        case Op::Add:
+            da = 1.0;
+            db = 1.0;
+            return;
+        case Op::Drag:
+        case Op::Sub:
+            da = 1.0;
+            db = -1.0;
+            return;
+        case Op::Mul:
+            da = b;
+            db = a;
+            return;
+        case Op::Div:
+            da = safe_div(b, b * b);
+            db = safe_div(-a, b * b);
+            return;
+        case Op::Sin:
+            da = std::cos(a);
+            return;
+        case Op::Cos:
+            da = -std::sin(a);
+            return;
+        case Op::ASin:
+            da = safe_div(1.0, std::sqrt(1.0 - a * a));
+            return;
+        case Op::ACos:
+            da = safe_div(-1.0, std::sqrt(1.0 - a * a));
+            return;
+        case Op::Sqrt:
+            da = safe_div(1.0, 2.0 * std::sqrt(a));
+            return;
+        case Op::Sqr:
+            da = 2.0 * a;
+            return;
+        case Op::Atan2:
+            da = safe_div(b, a * a + b * b);
+            db = safe_div(-a, a * a + b * b);
+            return;
+        case Op::Abs:
+            da = sign(a);
+            return;
+        case Op::Neg:
+            da = -1.0;
+            return;
+        case Op::Pos:
+            da = 1.0;
+            return;
+        case Op::Exp:
+            da = out;
+            return;
+        case Op::Sinh:
+            da = std::cosh(a);
+            return;
+        case Op::Cosh:
+            da = std::sinh(a);
+            return;
+        case Op::SFres:
+            da = std::sin(M_PI * a * a / 2.0);
+            return;
+        case Op::CFres:
+            da = std::cos(M_PI * a * a / 2.0);
+            return;
+    }
+    da = 0.0;
+}
+
+void ExprTape::clear()
+{
+    instructions.clear();
+    values.clear();
+    params.clear();
+    param_slots.clear();
+    roots.clear();
+    root_param_begin = { 0 };
+    root_params.clear();
+    sources.clear();
+    expr_slots.clear();
+    param_index.clear();
+    slot_instruction.clear();
+    slot_param.clear();
+    cone_begin = { 0 };
+    cones.clear();
+    adjoints.clear();
+    tangents.clear();
+    marks.clear();
+    store_index.reset();
+}
+
+std::size_t ExprTape::add(const std::shared_ptr<Expr>& e)
+{
+    // keep the tree alive, so the node addresses used as keys stay unique
+    sources.push_back(e);
+    roots.push_back(compile(e));
+    add_cone(roots.back());
+    return roots.size() - 1;
+}
+
+int ExprTape::new_slot(double value)
+{
+    values.push_back(value);
+    slot_instruction.push_back(-1);
+    slot_param.push_back(-1);
+    return values.size() - 1;
+}
+
+void ExprTape::add_cone(int root_slot)
+{
+    marks.resize(values.size(), -1);
+    adjoints.resize(values.size(), 0.0);
+    int id = roots.size() - 1;
+
+    std::vector<int> stack = { root_slot };
+    std::size_t first = cones.size();
+    marks[root_slot] = id;
+    while (!stack.empty())
+    {
+        int slot = stack.back();
+        stack.pop_back();
+        if (slot_param[slot] >= 0)
+        {
+            root_params.push_back(slot_param[slot]);
+            continue;
+        }
+        int i = slot_instruction[slot];
+        if (i < 0)
+            continue;
+        cones.push_back(i);
+        for (int operand : { instructions[i].a, instructions[i].b })
+        {
+            if (operand < 0 || marks[operand] == id)
+                continue;
+            marks[operand] = id;
+            stack.push_back(operand);
+        }
+    }
+    // instructions are stored in evaluation order, so sorting restores it for the cone
+    std::sort(cones.begin() + first, cones.end());
+    cone_begin.push_back(cones.size());
+    root_param_begin.push_back(root_params.size());
+}
+
+int ExprTape::compile(const std::shared_ptr<Expr>& e)
+{
+    auto it = expr_slots.find(e.get());
+    if (it != expr_slots.end())
+        return it->second;
+
+    int slot;
+    switch (e->op)
+    {
+        case Op::Const:
+            slot = new_slot(e->value);
+            break;
+        case Op::ParamOp:
+        {
+            // several nodes can point to the same parameter, load it only once
+            auto pit = param_index.find(e->param.get());
+            if (pit != param_index.end())
+            {
+                slot = param_slots[pit->second];
+                break;
+            }
+            slot = new_slot(e->param->value());
+            slot_param[slot] = params.size();
+            param_index[e->param.get()] = params.size();
+            params.push_back(e->param);
+            param_slots.push_back(slot);
+            break;
+        }
+        default:
+        {
+            int a = e->a != nullptr ? compile(e->a) : -1;
+            int b = e->b != nullptr ? compile(e->b) : -1;
+            slot = new_slot(0.0);
+            slot_instruction[slot] = instructions.size();
+            instructions.push_back({ e->op, a, b, slot });
+            break;
+        }
+    }
+    expr_slots[e.get()] = slot;
+    return slot;
+}
+
+void ExprTape::eval(std::size_t end)
+{
+    double* v = values.data();
+    if (store_index.update(params))
+    {
+        store_index.gather(v, param_slots.data());
+    }
+    else
+    {
+        for (std::size_t i = 0; i < params.size(); i++)
+        {
+            v[param_slots[i]] = params[i]->value();
+        }
+    }
+    for (std::size_t i = 0; i < end; i++)
+    {
+        const Instruction& ins = instructions[i];
+        v[ins.out] = apply(ins.op, v[ins.a], ins.b >= 0 ? v[ins.b] : 0.0);
+    }
+}
+
+void ExprTape::eval()
+{
+    eval(instructions.size());
+}
+
+void ExprTape::gradient(std::size_t root, double* grad)
+{
+    double* v = values.data();
+    double* adj = adjoints.data();
+    adj[roots[root]] = 1.0;
+    for (std::size_t k = cone_begin[root + 1]; k-- > cone_begin[root];)
+    {
+        const Instruction& ins = instructions[cones[k]];
+        double g = adj[ins.out];
+        adj[ins.out] = 0.0;
+        if (g == 0.0)
+            continue;
+        double da, db;
+        double vb = ins.b >= 0 ? v[ins.b] : 0.0;
+        partials(ins.op, v[ins.a], vb, v[ins.out], da, db);
+        adj[ins.a] += g * da;
+        if (ins.b >= 0)
+            adj[ins.b] += g * db;
+    }
+    for (std::size_t k = root_param_begin[root]; k < root_param_begin[root + 1]; k++)
+    {
+        int slot = param_slots[root_params[k]];
+        *grad++ = adj[slot];
+        adj[slot] = 0.0;
+    }
+    // constants collect adjoints as well, clear them for the next sweep
+    for (std::size_t k = cone_begin[root]; k < cone_begin[root + 1]; k++)
+    {
+        const Instruction& ins = instructions[cones[k]];
+        adj[ins.a] = 0.0;
+        if (ins.b >= 0)
+            adj[ins.b] = 0.0;
+    }
+    adj[roots[root]] = 0.0;
+}
+
+void ExprTape::jacobian_vector(const double* v, double* out)
+{
+    const double* val = values.data();
+    tangents.assign(values.size(), 0.0);
+    double* t = tangents.data();
+    for (std::size_t i = 0; i < params.size(); i++)
+    {
+        t[param_slots[i]] = v[i];
+    }
+    for (const Instruction& ins : instructions)
+    {
+        double ta = t[ins.a];
+        double tb = ins.b >= 0 ? t[ins.b] : 0.0;
+        if (ta == 0.0 && tb == 0.0)
+            continue;
+        double da, db;
+        double vb = ins.b >= 0 ? val[ins.b] : 0.0;
+        partials(ins.op, val[ins.a], vb, val[ins.out], da, db);
+        t[ins.out] = da * ta + db * tb;
+    }
+    for (std::size_t r = 0; r < roots.size(); r++)
+    {
+        out[r] = t[roots[r]];
+    }
+}
+
+void ExprTape::vector_jacobian(const double* w, double* out)
+{
+    const double* val = values.data();
+    double* adj = adjoints.data();
+    for (std::size_t r = 0; r < roots.size(); r++)
+    {
+        adj[roots[r]] += w[r];
+    }
+    for (std::size_t i = instructions.size(); i-- > 0;)
+    {
+        const Instruction& ins = instructions[i];
+        double g = adj[ins.out];
+        if (g == 0.0)
+            continue;
+        double da, db;
+        double vb = ins.b >= 0 ? val[ins.b] : 0.0;
+        partials(ins.op, val[ins.a], vb, val[ins.out], da, db);
+        adj[ins.a] += g * da;
+        if (ins.b >= 0)
+            adj[ins.b] += g * db;
+    }
+    for (std::size_t i = 0; i < params.size(); i++)
+    {
+        out[i] = adj[param_slots[i]];
+    }
+    std::fill(adjoints.begin(), adjoints.end(), 0.0);
+}
@@ -1,115 +1,88 @@
 #include "gaussian_method.hpp"
 
+#include <cmath>
+#include <algorithm>
+
 #include <xtensor/xtensor.hpp>
 #include <xtensor/xio.hpp>
+#include <Eigen/Dense>
+#include <Eigen/SparseQR>
+#include <Eigen/OrderingMethods>
+
+using RowMajorMatrix = Eigen::Matrix<double, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>;
 
-// copy A so it doesn't get overwritten
-// note: could use xt::linalg::rank
-int GaussianMethod::rank(xt::xtensor<double, 2> A)
+// the decompositions keep their storage between calls, so solving systems of the same size
+// doesn't allocate again
+int GaussianMethod::rank(const xt::xtensor<double, 2>& A)
 {
-    std::ptrdiff_t rows = A.shape(0);
-    std::ptrdiff_t cols = A.shape(1);
+    thread_local Eigen::ColPivHouseholderQR<Eigen::MatrixXd> qr;
 
-    int rank = 0;
-    xt::xtensor<double, 1> rowsLength = xt::empty<double>({ rows });
+    Eigen::Map<const RowMajorMatrix> a(A.data(), A.shape(0), A.shape(1));
+    // QR of A^T pivots over the rows of A, |R(i, i)| is the distance of the i-th picked row to
+    // the span of the previous ones
+    qr.compute(a.transpose());
 
-    for (std::ptrdiff_t i = 0; i < rows; i++)
+    int rank = 0;
+    auto diagonal = qr.matrixQR().diagonal();
+    for (Eigen::Index i = 0; i < diagonal.size(); i++)
     {
-        for (std::ptrdiff_t ii = 0; ii < i; ii++)
-        {
-            if (rowsLength(ii) <= rank_epsilon)
-                continue;
-
-            double sum = 0;
-            for (std::ptrdiff_t j = 0; j < cols; j++)
-            {
-                sum += A(ii, j) * A(i, j);
-            }
-
-            for (std::ptrdiff_t j = 0; j < cols; j++)
-            {
-                A(i, j) -= A(ii, j) * sum / rowsLength(ii);
-            }
-        }
-
-        double len = 0;
-        for (int j = 0; j < cols; j++)
-        {
-            len += A(i, j) * A(i, j);
-        }
-        if (len > rank_epsilon)
+        if (diagonal(i) * diagonal(i) > rank_epsilon)
         {
             rank++;
         }
-        rowsLength(i) = len;
     }
-
     return rank;
 }
 
-// copy A & B so they don't get overwritten
-void GaussianMethod::solve(xt::xtensor<double, 2> A, xt::xtensor<double, 1> B,
-                           xt::xtensor<double, 1>& X)
+std::vector<int> GaussianMethod::independent_columns(const Eigen::SparseMatrix<double>& M,
+                                                    int& rank, bool dense)
 {
-    std::ptrdiff_t rows = A.shape(0);
-    std::ptrdiff_t cols = A.shape(1);
-    double t = 0.0;
-
-    for (std::ptrdiff_t r = 0; r < rows; r++)
+    std::vector<int> order(M.cols());
+    if (dense)
     {
-        std::ptrdiff_t mr = r;
-        double max = 0.0;
-        for (std::ptrdiff_t rr = r; rr < rows; rr++)
-        {
-            if (std::abs(A(rr, r)) <= max)
-                continue;
-            max = std::abs(A(rr, r));
-            mr = rr;
-        }
-
-        if (max < epsilon)
-            continue;
-
-        for (std::ptrdiff_t c = 0; c < cols; c++)
+        thread_local Eigen::ColPivHouseholderQR<Eigen::MatrixXd> qr;
+        qr.setThreshold(std::sqrt(rank_epsilon));
+        qr.compute(Eigen::MatrixXd(M));
+        rank = 0;
+        auto diagonal = qr.matrixQR().diagonal();
+        for (Eigen::Index i = 0; i < diagonal.size(); i++)
         {
-            t = A(r, c);
-            A(r, c) = A(mr, c);
-            A(mr, c) = t;
-        }
-
-        t = B(r);
-        B(r) = B(mr);
-        B(mr) = t;
-
-        // normalize
-        /*
-        double scale = A[r, r];
-        for(std::ptrdiff_t c = 0; c < cols; c++) {
-            A[r, c] /= scale;
+            if (diagonal(i) * diagonal(i) > rank_epsilon)
+                rank++;
         }
-        B[r] /= scale;
-        */
-
-        for (std::ptrdiff_t rr = r + 1; rr < rows; rr++)
+        for (Eigen::Index i = 0; i < M.cols(); i++)
         {
-            double coef = A(rr, r) / A(r, r);
-            for (std::ptrdiff_t c = 0; c < cols; c++)
-            {
-                A(rr, c) -= A(r, c) * coef;
-            }
-            B(rr) -= B(r) * coef;
+            order[i] = qr.colsPermutation().indices()(i);
         }
+        return order;
     }
 
-    for (std::ptrdiff_t r = rows; r >= 0; r--)
+    // sparse QR of M with a fill reducing column order, columns whose distance to the span of
+    // the ones before them is below the threshold are moved to the end, so they are the
+    // dependent ones
+    thread_local Eigen::SparseQR<Eigen::SparseMatrix<double>, Eigen::COLAMDOrdering<int>> qr;
+    qr.setPivotThreshold(std::sqrt(rank_epsilon));
+    Eigen::SparseMatrix<double> m = M;
+    m.makeCompressed();
+    qr.compute(m);
+    rank = qr.rank();
+    for (Eigen::Index i = 0; i < M.cols(); i++)
     {
-        if (std::abs(A(r, r)) < epsilon)
-            continue;
-        double xx = B(r) / A(r, r);
-        for (std::ptrdiff_t rr = rows - 1; rr > r; rr--)
-        {
-            xx -= X(rr) * A(r, rr) / A(r, r);
-        }
-        X(r) = xx;
+        order[i] = qr.colsPermutation().indices()(i);
     }
+    return order;
+}
+
+void GaussianMethod::solve(const xt::xtensor<double, 2>& A, const xt::xtensor<double, 1>& B,
+                           xt::xtensor<double, 1>& X)
+{
+    thread_local Eigen::CompleteOrthogonalDecomposition<Eigen::MatrixXd> cod;
+
+    Eigen::Map<const RowMajorMatrix> a(A.data(), A.shape(0), A.shape(1));
+    Eigen::Map<const Eigen::VectorXd> b(B.data(), B.shape(0));
+    Eigen::Map<Eigen::VectorXd> x(X.data(), X.shape(0));
+
+    cod.setThreshold(epsilon);
+    cod.compute(a);
+    x = cod.solve(b);
 }
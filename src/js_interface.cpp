@@ -6,9 +6,20 @@
 
 using namespace emscripten;
 
+static std::string param_name(const Param<double>& p)
+{
+    return p.name();
+}
 
 EMSCRIPTEN_BINDINGS(adjacent_api)
 {
+    enum_<L1Method>("L1Method").value("GLOP", GLOP).value("IRLS", IRLS);
+    enum_<SolveResult>("SolveResult")
+        .value("OKAY", OKAY)
+        .value("DIDNT_CONVERGE", DIDNT_CONVERGE)
+        .value("REDUNDANT", REDUNDANT)
+        .value("POSTPONE", POSTPONE);
+
     class_<Sketch>("Sketch")
         .constructor<>()
         .function("add_entity", &Sketch::add_entity)
@@ -21,13 +32,24 @@ EMSCRIPTEN_BINDINGS(adjacent_api)
         .function("remove_expressionVector", &Sketch::remove_expressionVector)
         .function("is_using_linear_program", &Sketch::is_using_linear_program)
         .function("use_linear_program", &Sketch::use_linear_program)
+        .function("get_l1_method", &Sketch::get_l1_method)
+        .function("set_l1_method", &Sketch::set_l1_method)
+        .function("is_using_damping", &Sketch::is_using_damping)
+        .function("use_damping", &Sketch::use_damping)
+        .function("is_using_quasi_newton", &Sketch::is_using_quasi_newton)
+        .function("use_quasi_newton", &Sketch::use_quasi_newton)
+        .function("is_using_iterative_solver", &Sketch::is_using_iterative_solver)
+        .function("use_iterative_solver", &Sketch::use_iterative_solver)
+        .function("get_result", &Sketch::get_result)
+        .function("get_component_results", &Sketch::get_component_results)
+        .function("dof", &Sketch::dof)
         .function("update", &Sketch::update);
 
     using Prm = Param<double>;
     class_<Prm>("Param")
         .smart_ptr_constructor("Param", &std::make_shared<Prm, std::string, double>)
         // .constructor<std::string, double>()
-        .property("name", &Prm::m_name)
+        .property("name", &param_name)
         .function("set_value", &Prm::set_value)
         .function("expr", &Prm::expr)
         .function("value", &Prm::value)
@@ -36,6 +58,7 @@ EMSCRIPTEN_BINDINGS(adjacent_api)
     class_<Entity>("Entity").smart_ptr<std::shared_ptr<Entity>>("Entity");
 
     register_vector<double>("VectorDouble");
+    register_vector<SolveResult>("VectorSolveResult");
 
     class_<PointE, base<Entity>>("Point")
         .smart_ptr_constructor("Point", &std::make_shared<PointE, ParamPtr, ParamPtr, ParamPtr>)
@@ -1,5 +1,6 @@
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
+#include <pybind11/numpy.h>
 
 #include "expression.hpp"
 #include "entity.hpp"
@@ -8,23 +9,192 @@
 
 namespace py = pybind11;
 
+using DoubleArray = py::array_t<double, py::array::c_style | py::array::forcecast>;
+using IndexArray = py::array_t<std::int64_t, py::array::c_style | py::array::forcecast>;
+
+// handles first ... first + n - 1 as returned by the array builders
+static IndexArray handle_range(std::size_t first, std::size_t n)
+{
+    IndexArray res(n);
+    auto r = res.mutable_unchecked<1>();
+    for (std::size_t i = 0; i < n; i++)
+    {
+        r(i) = first + i;
+    }
+    return res;
+}
+
+// constraint type of a class of the constraints submodule (or its name)
+static CONSTRAINT_TYPE constraint_type(const py::handle& kind)
+{
+    static const std::map<std::string, CONSTRAINT_TYPE> types = {
+        { "PointOn", PointOn },
+        { "Coincident", PointsCoincident },
+        { "CenterTriangle", PointCenterTriangle },
+        { "MidPoint", MidPoint },
+        { "Parallel", Parallel },
+        { "Orthogonal", Orthogonal },
+        { "Length", Length },
+        { "Distance", PointsDistance },
+        { "HV", HV },
+        { "Angle", Angle },
+        { "Diameter", Diameter },
+        { "Tangent", Tangent },
+        { "Equal", Equal },
+    };
+    auto name = py::isinstance<py::str>(kind) ? kind.cast<std::string>()
+                                               : kind.attr("__name__").cast<std::string>();
+    auto it = types.find(name);
+    if (it == types.end())
+        throw py::value_error("unknown constraint type " + name);
+    return it->second;
+}
+
 PYBIND11_MODULE(adjacent_api, m)
 {
+    py::enum_<L1Method>(m, "L1Method").value("GLOP", GLOP).value("IRLS", IRLS);
+    py::enum_<SolveResult>(m, "SolveResult")
+        .value("OKAY", OKAY)
+        .value("DIDNT_CONVERGE", DIDNT_CONVERGE)
+        .value("REDUNDANT", REDUNDANT)
+        .value("POSTPONE", POSTPONE);
+
+    py::class_<DofAnalysis>(m, "DofAnalysis")
+        .def_readonly("rank", &DofAnalysis::rank)
+        .def_readonly("dof", &DofAnalysis::dof)
+        .def_readonly("equations", &DofAnalysis::equations)
+        .def_readonly("free_params", &DofAnalysis::free_params);
+
     py::class_<Sketch>(m, "Sketch")
         .def(py::init<>())
         .def("add_entity", &Sketch::add_entity)
+        .def("remove_entity", &Sketch::remove_entity)
         .def("add_constraint", &Sketch::add_constraint)
+        .def("remove_constraint", &Sketch::remove_constraint)
+        .def("add_expression", &Sketch::add_expression)
+        .def("remove_expression", &Sketch::remove_expression)
         .def("add_expressionVector", &Sketch::add_expressionVector)
-        .def("update", &Sketch::update)
+        .def("remove_expressionVector", &Sketch::remove_expressionVector)
+        .def("entity", &Sketch::entity)
+        .def("values",
+             [](Sketch& self)
+             {
+                 // the view keeps the block alive, see ParamStore
+                 auto block = new std::shared_ptr<std::vector<double>>(self.store.block());
+                 py::capsule owner(block, [](void* b)
+                                   { delete static_cast<std::shared_ptr<std::vector<double>>*>(b); });
+                 return py::array_t<double>(self.store.size(), (*block)->data(), owner);
+             })
+        .def("param_names",
+             [](Sketch& self)
+             {
+                 std::vector<std::string> names(self.store.size());
+                 for (std::size_t i = 0; i < names.size(); i++)
+                 {
+                     if (self.store.owner(i) != nullptr)
+                         names[i] = self.store.name(i);
+                 }
+                 return names;
+             })
+        .def("param_index", &Sketch::param_index)
+        .def("param_indices",
+             [](Sketch& self, const IndexArray& handles)
+             {
+                 if (handles.ndim() != 1)
+                     throw py::value_error("expected an array of shape (n,)");
+                 std::size_t n = handles.size();
+                 std::size_t k = n > 0 ? self.entity(handles.at(0))->parameters().size() : 0;
+                 IndexArray res({ n, k });
+                 auto r = res.mutable_unchecked<2>();
+                 for (std::size_t i = 0; i < n; i++)
+                 {
+                     auto params = self.entity(handles.at(i))->parameters();
+                     if (params.size() != k)
+                         throw py::value_error("entities with different numbers of parameters");
+                     for (std::size_t j = 0; j < k; j++)
+                     {
+                         r(i, j) = self.param_index(params[j]);
+                     }
+                 }
+                 return res;
+             })
+        .def("add_points",
+             [](Sketch& self, const DoubleArray& xy)
+             {
+                 if (xy.ndim() != 2)
+                     throw py::value_error("expected an array of shape (n, 2) or (n, 3)");
+                 std::size_t n = xy.shape(0);
+                 return handle_range(self.add_points(xy.data(), n, xy.shape(1)), n);
+             })
+        .def("add_lines",
+             [](Sketch& self, const IndexArray& idx)
+             {
+                 if (idx.ndim() != 2 || idx.shape(1) != 2)
+                     throw py::value_error("expected an array of shape (n, 2)");
+                 std::size_t n = idx.shape(0);
+                 return handle_range(self.add_lines(idx.data(), n), n);
+             })
+        .def("add_circles",
+             [](Sketch& self, const IndexArray& centers, const DoubleArray& radii)
+             {
+                 std::size_t n = centers.size();
+                 if (centers.ndim() != 1 || radii.ndim() != 1 || radii.size() != n)
+                     throw py::value_error("expected centers and radii of shape (n,)");
+                 return handle_range(self.add_circles(centers.data(), radii.data(), n), n);
+             })
+        .def(
+            "add_constraints",
+            [](Sketch& self, const py::handle& kind, const IndexArray& entity_idx,
+               const py::object& values)
+            {
+                if (entity_idx.ndim() < 1 || entity_idx.ndim() > 2)
+                    throw py::value_error("expected an array of shape (n,) or (n, k)");
+                std::size_t n = entity_idx.shape(0);
+                std::size_t arity = entity_idx.ndim() == 2 ? entity_idx.shape(1) : 1;
+                DoubleArray v;
+                if (!values.is_none())
+                {
+                    v = values.cast<DoubleArray>();
+                    if (v.ndim() != 1 || v.size() != n)
+                        throw py::value_error("expected values of shape (n,)");
+                }
+                self.add_constraints(constraint_type(kind), entity_idx.data(), n, arity,
+                                     values.is_none() ? nullptr : v.data());
+            },
+            py::arg("kind"), py::arg("entity_idx"), py::arg("values") = py::none())
+        // independent sketches can be solved from several threads at once
+        .def("update", &Sketch::update, py::call_guard<py::gil_scoped_release>())
+        .def("get_result", &Sketch::get_result)
+        .def("get_component_results", &Sketch::get_component_results)
+        .def("get_redundant_equations", &Sketch::get_redundant_equations)
+        .def("get_redundant_constraints", &Sketch::get_redundant_constraints)
+        .def("analyze", &Sketch::analyze, py::call_guard<py::gil_scoped_release>())
+        .def("dof", &Sketch::dof, py::call_guard<py::gil_scoped_release>())
         .def("is_using_linear_program", &Sketch::is_using_linear_program)
-        .def("use_linear_program", &Sketch::use_linear_program);
+        .def("use_linear_program", &Sketch::use_linear_program)
+        .def("get_l1_method", &Sketch::get_l1_method)
+        .def("set_l1_method", &Sketch::set_l1_method)
+        .def("is_using_damping", &Sketch::is_using_damping)
+        .def("use_damping", &Sketch::use_damping)
+        .def("is_using_quasi_newton", &Sketch::is_using_quasi_newton)
+        .def("use_quasi_newton", &Sketch::use_quasi_newton)
+        .def("is_using_iterative_solver", &Sketch::is_using_iterative_solver)
+        .def("use_iterative_solver", &Sketch::use_iterative_solver);
+
+    py::class_<SolveStats>(m, "SolveStats")
+        .def_readonly("result", &SolveStats::result)
+        .def_readonly("steps", &SolveStats::steps)
+        .def_readonly("time", &SolveStats::time);
+
+    m.def("solve_many", &solve_many, py::arg("sketches"), py::arg("threads") = 0,
+          py::call_guard<py::gil_scoped_release>());
 
     using Prm = Param<double>;
     py::class_<Prm, std::shared_ptr<Prm>>(m, "Param")
         .def(py::init<std::string, double>())
         .def("set_value", &Prm::set_value)
         .def("value", &Prm::value)
-        .def("name", [](Prm& self) { return self.m_name; })
+        .def("name", &Prm::name)
         .def("__repr__", &Prm::to_string);
 
     py::class_<Entity, std::shared_ptr<Entity>>(m, "Entity");
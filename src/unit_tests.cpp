@@ -0,0 +1,994 @@
+#include <cmath>
+#include <functional>
+#include <iostream>
+#include <memory>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include <ortools/linear_solver/linear_solver.h>
+
+#include "expression.hpp"
+#include "expression_tape.hpp"
+#include "entity.hpp"
+#include "constraint.hpp"
+#include "gaussian_method.hpp"
+
+// Behavior tests of the solver, run by ctest. Every test is a function registered in main, a
+// failed CHECK is reported and makes the program exit with a non zero status.
+
+static int failures = 0;
+
+#define CHECK(cond)                                                                     \
+    do                                                                                  \
+    {                                                                                   \
+        if (!(cond))                                                                    \
+        {                                                                               \
+            std::cerr << __FILE__ << ":" << __LINE__ << ": CHECK(" #cond ") failed\n"; \
+            failures++;                                                                 \
+        }                                                                               \
+    } while (0)
+
+#define CHECK_NEAR(a, b, tol) CHECK(std::abs((a) - (b)) <= (tol))
+
+static std::shared_ptr<PointE> point(const std::string& name, double x, double y)
+{
+    return std::make_shared<PointE>(param(name + "_x", x), param(name + "_y", y),
+                                    param(name + "_z", 0.0));
+}
+
+static double distance(const PointE& a, const PointE& b)
+{
+    return std::hypot(a.x->value() - b.x->value(), a.y->value() - b.y->value());
+}
+
+// turns off presolve, so the equations are solved as they are
+static void use_plain_solve(EquationSystem& sys)
+{
+    sys.use_substitution = false;
+    sys.use_presolve = false;
+    sys.decompose = false;
+}
+
+// roots sharing the subtree x * y, with most of the operations
+static std::vector<ExprPtr> tape_roots(const ParamPtr& x, const ParamPtr& y, const ParamPtr& z)
+{
+    auto xy = x->expr() * y->expr();
+    return {
+        sin(x->expr()) * y->expr() + sqrt(x->expr() * x->expr() + z->expr() * z->expr()),
+        atan2(xy, z->expr()) - expo(xy) / (y->expr() + two),
+        cos(z->expr()) * sqr(xy) + abs(y->expr() - x->expr()),
+        acos(x->expr() / expr(4.0)) + sinh(y->expr()) * cosh(z->expr()),
+        z->expr() * z->expr() - one,
+    };
+}
+
+// the gradients of the tape against the symbolic derivatives of Expr::d
+static void test_tape_gradient()
+{
+    auto x = param("x", 0.7);
+    auto y = param("y", -1.3);
+    auto z = param("z", 2.1);
+    auto roots = tape_roots(x, y, z);
+    ExprTape tape;
+    for (const auto& r : roots)
+    {
+        tape.add(r);
+    }
+    tape.eval();
+
+    std::size_t n = tape.params.size();
+    CHECK(n == 3);
+    std::vector<std::vector<double>> J(roots.size(), std::vector<double>(n, 0.0));
+    for (std::size_t i = 0; i < roots.size(); i++)
+    {
+        CHECK_NEAR(tape.value(i), roots[i]->eval(), 1e-12);
+        for (std::size_t k = 0; k < n; k++)
+        {
+            J[i][k] = roots[i]->d(tape.params[k])->eval();
+        }
+        std::vector<double> grad(tape.param_count(i));
+        tape.gradient(i, grad.data());
+        for (std::size_t k = 0; k < grad.size(); k++)
+        {
+            int c = tape.root_params[tape.root_param_begin[i] + k];
+            CHECK_NEAR(grad[k], J[i][c], 1e-12);
+        }
+    }
+    CHECK(tape.param_count(4) == 1);
+
+    // new parameter values are picked up by the next eval
+    x->set_value(-0.4);
+    tape.eval();
+    std::vector<double> grad(tape.param_count(0));
+    tape.gradient(0, grad.data());
+    for (std::size_t k = 0; k < grad.size(); k++)
+    {
+        int c = tape.root_params[tape.root_param_begin[0] + k];
+        CHECK_NEAR(grad[k], roots[0]->d(tape.params[c])->eval(), 1e-12);
+    }
+}
+
+// a - b, b - c and c - a merge a, b and c into one unknown, the last of them is implied by the
+// others. a - d doesn't hold yet, so it stays an equation.
+static void test_substitution()
+{
+    EquationSystem sys;
+    sys.use_presolve = false;
+    sys.decompose = false;
+    auto a = param("a", 1.0);
+    auto b = param("b", 1.0);
+    auto c = param("c", 1.0);
+    auto d = param("d", 2.0);
+    sys.add_parameters({ a, b, c, d });
+    sys.add_equation(a->expr() - b->expr());
+    sys.add_equation(b->expr() - c->expr());
+    sys.add_equation(c->expr() - a->expr());
+    sys.add_equation(a->expr() - d->expr());
+    sys.add_equation(a->expr() * b->expr() * c->expr() - expr(8.0));
+    sys.update_dirty();
+    CHECK(sys.subs.size() == 2);
+    CHECK(sys.current_params.size() == 2);
+    CHECK(sys.equations.size() == 2);
+    CHECK(sys.source_equations.size() == 5);
+    CHECK(sys.solve() == OKAY);
+    for (const auto& p : { a, b, c, d })
+    {
+        CHECK_NEAR(p->value(), 2.0, 1e-9);
+    }
+}
+
+// the linear equations are solved before the Newton steps, with and without eliminate_linear,
+// the results have to match the plain solve
+static void test_presolve()
+{
+    std::vector<double> results[3];
+    for (int mode = 0; mode < 3; mode++)
+    {
+        EquationSystem sys;
+        sys.decompose = false;
+        // the presolve is part of the substitution
+        sys.use_substitution = mode > 0;
+        sys.use_presolve = mode > 0;
+        sys.eliminate_linear = mode == 2;
+        auto x = param("x", 0.0);
+        auto y = param("y", 0.0);
+        auto z = param("z", 1.0);
+        auto w = param("w", 1.0);
+        sys.add_parameters({ x, y, z, w });
+        sys.add_equation(x->expr() - expr(2.0));
+        sys.add_equation(x->expr() + y->expr() - expr(3.0));
+        sys.add_equation(z->expr() * z->expr() + y->expr() - expr(5.0));
+        sys.add_equation(w->expr() + two * z->expr() - x->expr());
+        sys.update_dirty();
+        if (mode == 1)
+        {
+            // x and y are determined, the last one has two unknowns
+            CHECK(sys.presolved.size() == 2);
+            CHECK(sys.equations.size() == 2);
+        }
+        else if (mode == 2)
+        {
+            CHECK(sys.presolved.size() == 3);
+            CHECK(sys.equations.size() == 1);
+            CHECK(sys.current_params.size() == 1);
+        }
+        CHECK(sys.solve() == OKAY);
+        CHECK_NEAR(x->value(), 2.0, 1e-9);
+        CHECK_NEAR(y->value(), 1.0, 1e-9);
+        CHECK_NEAR(z->value() * z->value(), 4.0, 1e-9);
+        CHECK_NEAR(w->value() + 2.0 * z->value(), 2.0, 1e-9);
+        results[mode] = { x->value(), y->value(), z->value(), w->value() };
+    }
+    for (int k = 0; k < 4; k++)
+    {
+        CHECK_NEAR(results[1][k], results[0][k], 1e-8);
+        CHECK_NEAR(results[2][k], results[0][k], 1e-8);
+    }
+}
+
+// equations added to and removed from a solved system update its components in place, the
+// result has to be the one of a system built from scratch
+static void test_incremental_equations()
+{
+    auto build = [](EquationSystem& sys, std::vector<ParamPtr>& p)
+    {
+        sys.use_presolve = false;
+        for (int i = 0; i < 6; i++)
+        {
+            p.push_back(param("p" + std::to_string(i), 1.0 + 0.5 * i));
+        }
+        sys.add_parameters(p);
+        sys.add_equation(p[0]->expr() * p[0]->expr() + p[1]->expr() * p[1]->expr() - expr(4.0));
+        sys.add_equation(p[2]->expr() * p[3]->expr() - expr(6.0));
+        sys.add_equation(p[4]->expr() * p[4]->expr() - expr(9.0));
+    };
+    EquationSystem sys;
+    std::vector<ParamPtr> p;
+    build(sys, p);
+    CHECK(sys.solve() == OKAY);
+    CHECK(sys.components.size() == 3);
+
+    // joins the first two components and starts one for p5
+    auto join = p[1]->expr() * p[2]->expr() - expr(2.0);
+    auto fix = p[5]->expr() * p[5]->expr() - expr(16.0);
+    sys.add_equation(join);
+    sys.add_equation(fix);
+    CHECK(!sys.is_dirty);
+    CHECK(sys.solve() == OKAY);
+    CHECK(!sys.is_dirty);
+    // the merged component is left empty until the next full rebuild
+    int used = 0;
+    for (const auto& component : sys.components)
+    {
+        used += !component->source_equations.empty();
+    }
+    CHECK(used == 3);
+
+    EquationSystem fresh;
+    std::vector<ParamPtr> q;
+    build(fresh, q);
+    CHECK(fresh.solve() == OKAY);
+    for (int i = 0; i < 6; i++)
+    {
+        q[i]->set_value(p[i]->value());
+    }
+    fresh.add_equation(q[1]->expr() * q[2]->expr() - expr(2.0));
+    fresh.add_equation(q[5]->expr() * q[5]->expr() - expr(16.0));
+    fresh.is_dirty = true;
+    CHECK(fresh.solve() == OKAY);
+    for (int i = 0; i < 6; i++)
+    {
+        CHECK_NEAR(p[i]->value(), q[i]->value(), 1e-9);
+    }
+    CHECK_NEAR(p[1]->value() * p[2]->value(), 2.0, 1e-9);
+    CHECK_NEAR(std::abs(p[5]->value()), 4.0, 1e-9);
+
+    sys.remove_equation(join);
+    sys.add_equation(p[0]->expr() - p[1]->expr() * two);
+    CHECK(!sys.is_dirty);
+    CHECK(sys.solve() == OKAY);
+    CHECK_NEAR(p[0]->value(), 2.0 * p[1]->value(), 1e-9);
+    CHECK_NEAR(p[0]->value() * p[0]->value() + p[1]->value() * p[1]->value(), 4.0, 1e-9);
+    CHECK_NEAR(p[2]->value() * p[3]->value(), 6.0, 1e-9);
+    CHECK(sys.source_equations.size() == 5);
+}
+
+// a - b is kept as an equation while a and b differ. Once the solve made them equal, adding an
+// equation that merges two components has to substitute it like a rebuild does.
+static void test_incremental_substitution()
+{
+    auto build = [](EquationSystem& sys, std::vector<ParamPtr>& p, const double* values)
+    {
+        sys.use_presolve = false;
+        for (int i = 0; i < 4; i++)
+        {
+            p.push_back(param(std::string(1, 'a' + i), values[i]));
+        }
+        sys.add_parameters(p);
+        sys.add_equation(p[0]->expr() * p[0]->expr() - expr(4.0));
+        sys.add_equation(p[0]->expr() - p[1]->expr());
+        sys.add_equation(p[1]->expr() * p[2]->expr() - two);
+        sys.add_equation(p[3]->expr() * p[3]->expr() - expr(9.0));
+    };
+    EquationSystem sys;
+    std::vector<ParamPtr> p;
+    const double start[] = { 1.0, 2.0, 1.5, 2.5 };
+    build(sys, p, start);
+    sys.update_dirty();
+    CHECK(sys.subs.empty());
+    CHECK(sys.equations.size() == 4);
+    CHECK(sys.solve() == OKAY);
+    CHECK(sys.components.size() == 2);
+
+    sys.add_equation(p[2]->expr() * p[3]->expr() - expr(3.0));
+    CHECK(!sys.is_dirty);
+    sys.update_dirty();
+
+    EquationSystem fresh;
+    std::vector<ParamPtr> q;
+    const double solved[] = { p[0]->value(), p[1]->value(), p[2]->value(), p[3]->value() };
+    build(fresh, q, solved);
+    fresh.add_equation(q[2]->expr() * q[3]->expr() - expr(3.0));
+    fresh.update_dirty();
+    CHECK(fresh.subs.size() == 1);
+    CHECK(sys.subs.size() == fresh.subs.size());
+    CHECK(sys.current_params.size() == fresh.current_params.size());
+    CHECK(sys.equations.size() == fresh.equations.size());
+
+    CHECK(sys.solve() == OKAY);
+    CHECK(fresh.solve() == OKAY);
+    for (int i = 0; i < 4; i++)
+    {
+        CHECK_NEAR(p[i]->value(), q[i]->value(), 1e-9);
+    }
+    CHECK_NEAR(p[1]->value(), p[0]->value(), 1e-9);
+    CHECK_NEAR(p[2]->value() * p[3]->value(), 3.0, 1e-9);
+}
+
+// the Rosenbrock system from its usual start, and a well conditioned one where the damped steps
+// have to find the same root as the plain ones
+static void test_damped_steps()
+{
+    EquationSystem sys;
+    use_plain_solve(sys);
+    sys.use_damping = true;
+    sys.max_steps = 100;
+    auto x = param("x", -1.2);
+    auto y = param("y", 1.0);
+    sys.add_parameters({ x, y });
+    sys.add_equation(expr(10.0) * (y->expr() - x->expr() * x->expr()));
+    sys.add_equation(one - x->expr());
+    CHECK(sys.solve() == OKAY);
+    CHECK_NEAR(x->value(), 1.0, 1e-9);
+    CHECK_NEAR(y->value(), 1.0, 1e-9);
+
+    double results[2][2];
+    for (int damped = 0; damped < 2; damped++)
+    {
+        EquationSystem sys;
+        use_plain_solve(sys);
+        sys.use_damping = damped;
+        auto u = param("u", 2.0);
+        auto v = param("v", 0.5);
+        sys.add_parameters({ u, v });
+        sys.add_equation(u->expr() * u->expr() + v->expr() * v->expr() - expr(4.0));
+        sys.add_equation(u->expr() - v->expr() * v->expr());
+        CHECK(sys.solve() == OKAY);
+        results[damped][0] = u->value();
+        results[damped][1] = v->value();
+    }
+    CHECK_NEAR(results[0][0], results[1][0], 1e-9);
+    CHECK_NEAR(results[0][1], results[1][1], 1e-9);
+}
+
+// x + 2 y = 4 from the origin: the step of least L1 norm only moves y, the one of least L2 norm
+// moves both
+static void test_irls_step()
+{
+    for (int l1 = 0; l1 < 2; l1++)
+    {
+        EquationSystem sys;
+        use_plain_solve(sys);
+        sys.use_linear_program = l1;
+        sys.l1_method = IRLS;
+        auto x = param("x", 0.0);
+        auto y = param("y", 0.0);
+        sys.add_parameters({ x, y });
+        sys.add_equation(x->expr() + two * y->expr() - expr(4.0));
+        CHECK(sys.solve() == OKAY);
+        CHECK_NEAR(x->value(), l1 ? 0.0 : 0.8, 1e-6);
+        CHECK_NEAR(y->value(), l1 ? 2.0 : 1.6, 1e-6);
+    }
+}
+
+// the L1 model of a system is kept across its Newton steps. Solving for a jacobian and residual
+// close to the previous ones starts from the previous basis, so it takes fewer simplex
+// iterations than a new model and ends at the same step.
+static void test_linear_program_reuse()
+{
+    EquationSystem sys;
+    use_plain_solve(sys);
+    sys.use_linear_program = true;
+    auto x = param("x", 1.0);
+    auto y = param("y", 1.0);
+    auto z = param("z", 1.0);
+    sys.add_parameters({ x, y, z });
+    sys.add_equation(x->expr() * y->expr() - two);
+    sys.add_equation(y->expr() * z->expr() - expr(3.0));
+    CHECK(sys.solve() == OKAY);
+    CHECK(sys.lp != nullptr);
+    CHECK_NEAR(x->value() * y->value(), 2.0, 1e-9);
+    CHECK_NEAR(y->value() * z->value(), 3.0, 1e-9);
+
+    const int m = 40;
+    const int n = 100;
+    std::vector<Eigen::Triplet<double>> entries;
+    for (int j = 0; j < m; j++)
+    {
+        for (int k = 0; k < 5; k++)
+        {
+            entries.emplace_back(j, (7 * j + 13 * k) % n, std::sin(j + 3.0 * k));
+        }
+    }
+    SparseMatrix A(m, n);
+    A.setFromTriplets(entries.begin(), entries.end());
+    xt::xtensor<double, 1> B = xt::empty<double>({ m });
+    for (int j = 0; j < m; j++)
+    {
+        B(j) = std::cos(j);
+    }
+    xt::xtensor<double, 1> X = xt::empty<double>({ n });
+    xt::xtensor<double, 1> Y = xt::empty<double>({ n });
+
+    EquationSystem kept;
+    kept.A = A;
+    std::int64_t kept_iterations = 0;
+    std::int64_t new_iterations = 0;
+    for (int step = 0; step < 5; step++)
+    {
+        double scale = std::pow(0.3, step);
+        for (int j = 0; j < m; j++)
+        {
+            for (SparseMatrix::InnerIterator it(A, j); it; ++it)
+            {
+                it.valueRef() += 0.05 * scale * std::sin(step + j + it.col());
+            }
+            B(j) = 0.3 * B(j) + 0.01 * scale * std::cos(step * j);
+        }
+        EquationSystem fresh;
+        fresh.A = A;
+        kept.solve_linear_program(A, B, X);
+        fresh.solve_linear_program(A, B, Y);
+        for (int i = 0; i < n; i++)
+        {
+            CHECK_NEAR(X(i), Y(i), 1e-9);
+        }
+        for (int j = 0; j < m; j++)
+        {
+            double ax = 0.0;
+            for (SparseMatrix::InnerIterator it(A, j); it; ++it)
+            {
+                ax += it.value() * X(it.col());
+            }
+            CHECK_NEAR(ax, B(j), 1e-9);
+        }
+        if (step > 0)
+        {
+            kept_iterations += kept.lp->iterations();
+            new_iterations += fresh.lp->iterations();
+        }
+    }
+    CHECK(2 * kept_iterations < new_iterations);
+}
+
+// the products of the tape with the jacobian against the one of Expr::d
+static void test_tape_products()
+{
+    auto x = param("x", 0.7);
+    auto y = param("y", -1.3);
+    auto z = param("z", 2.1);
+    auto roots = tape_roots(x, y, z);
+    ExprTape tape;
+    for (const auto& r : roots)
+    {
+        tape.add(r);
+    }
+    tape.eval();
+    std::size_t n = tape.params.size();
+    std::vector<std::vector<double>> J(roots.size(), std::vector<double>(n));
+    for (std::size_t i = 0; i < roots.size(); i++)
+    {
+        for (std::size_t k = 0; k < n; k++)
+        {
+            J[i][k] = roots[i]->d(tape.params[k])->eval();
+        }
+    }
+    std::vector<double> v = { 0.5, -2.0, 1.5 };
+    std::vector<double> w = { 1.0, -0.5, 2.0, 0.25, -3.0 };
+    std::vector<double> jv(roots.size()), wj(n);
+    tape.jacobian_vector(v.data(), jv.data());
+    tape.vector_jacobian(w.data(), wj.data());
+    for (std::size_t i = 0; i < roots.size(); i++)
+    {
+        double expected = 0.0;
+        for (std::size_t k = 0; k < n; k++)
+        {
+            expected += J[i][k] * v[k];
+        }
+        CHECK_NEAR(jv[i], expected, 1e-12);
+    }
+    for (std::size_t k = 0; k < n; k++)
+    {
+        double expected = 0.0;
+        for (std::size_t i = 0; i < roots.size(); i++)
+        {
+            expected += J[i][k] * w[i];
+        }
+        CHECK_NEAR(wj[k], expected, 1e-12);
+    }
+
+}
+
+// CGLS takes the same minimum norm steps as the factorization, with and without the
+// preconditioner
+static void test_iterative_solver()
+{
+    const int n = 30;
+    std::vector<double> results[3];
+    for (int mode = 0; mode < 3; mode++)
+    {
+        EquationSystem sys;
+        use_plain_solve(sys);
+        sys.use_iterative_solver = mode > 0;
+        sys.use_jacobi_preconditioner = mode == 2;
+        std::vector<ParamPtr> x;
+        for (int i = 0; i < n; i++)
+        {
+            x.push_back(param("x" + std::to_string(i), 1.0 + 0.1 * i));
+        }
+        sys.add_parameters(x);
+        for (int i = 0; i + 2 < n; i += 2)
+        {
+            sys.add_equation(x[i]->expr() * x[i + 1]->expr() - expr(i + 2.0));
+            sys.add_equation(expr(3.0) * x[i + 2]->expr() - x[i + 1]->expr() - one);
+        }
+        CHECK(sys.solve() == OKAY);
+        for (int i = 0; i + 2 < n; i += 2)
+        {
+            CHECK_NEAR(x[i]->value() * x[i + 1]->value(), i + 2.0, 1e-9);
+        }
+        for (const auto& p : x)
+        {
+            results[mode].push_back(p->value());
+        }
+    }
+    for (int i = 0; i < n; i++)
+    {
+        CHECK_NEAR(results[1][i], results[0][i], 1e-8);
+        CHECK_NEAR(results[2][i], results[0][i], 1e-8);
+    }
+}
+
+// a quadrilateral where the second chord step increases the residual from about 18 to 5e7, and
+// keeping it made the chord iteration diverge while plain Gauss-Newton converges in 5 steps
+static void test_rejected_chord_step()
+{
+    for (int quasi_newton = 0; quasi_newton < 2; quasi_newton++)
+    {
+        Sketch s;
+        const double xy[] = { -1.6, -2.6, 0.7, 2.2, -1.5, -2.5, -2.8, -1.3 };
+        s.add_points(xy, 4, 2);
+        const std::int64_t pairs[] = { 0, 1, 1, 2, 2, 3, 3, 0 };
+        s.add_lines(pairs, 4);
+        const std::int64_t lines[] = { 4, 5, 6, 7 };
+        const double lengths[] = { 2.8, 2.5 };
+        s.add_constraints(Length, lines, 2, 1, lengths);
+        s.add_constraints(Orthogonal, lines, 2, 2, nullptr);
+        s.use_quasi_newton(quasi_newton);
+        s.update();
+        CHECK(s.get_result() == OKAY);
+        auto p0 = entity_cast<PointE>(s.entity(0));
+        auto p1 = entity_cast<PointE>(s.entity(1));
+        auto p2 = entity_cast<PointE>(s.entity(2));
+        CHECK_NEAR(distance(*p0, *p1), 2.8, 1e-9);
+        CHECK_NEAR(distance(*p1, *p2), 2.5, 1e-9);
+    }
+}
+
+// columns of a large norm that are close to each other: the pair at distance 1e-3 is independent
+// and the one at distance 1e-6 is not, on both paths
+static void test_nearly_dependent_columns()
+{
+    const int blocks = 100;
+    const double scale = 1e6;
+    std::vector<Eigen::Triplet<double>> entries;
+    for (int b = 0; b < blocks; b++)
+    {
+        int r = 3 * b;
+        int c = 3 * b;
+        // u = (1, 1, 0) / sqrt(2), v = (0, 0, 1) in the rows of the block
+        double u = scale / std::sqrt(2.0);
+        entries.emplace_back(r, c, u);
+        entries.emplace_back(r + 1, c, u);
+        entries.emplace_back(r, c + 1, u);
+        entries.emplace_back(r + 1, c + 1, u);
+        entries.emplace_back(r + 2, c + 1, b % 2 ? 1e-3 : 1e-6);
+        entries.emplace_back(r + 2, c + 2, 1.0);
+        entries.emplace_back(r, c + 2, 1.0);
+    }
+    Eigen::SparseMatrix<double> M(3 * blocks, 3 * blocks);
+    M.setFromTriplets(entries.begin(), entries.end());
+    for (int dense = 0; dense < 2; dense++)
+    {
+        int rank = 0;
+        auto order = GaussianMethod::independent_columns(M, rank, dense);
+        CHECK(rank == 3 * blocks - blocks / 2);
+        std::vector<bool> independent(M.cols(), false);
+        for (int k = 0; k < rank; k++)
+        {
+            independent[order[k]] = true;
+        }
+        for (int b = 0; b < blocks; b++)
+        {
+            // one of the pair at distance 1e-6 is dependent
+            int count = independent[3 * b] + independent[3 * b + 1];
+            CHECK(count == (b % 2 ? 2 : 1));
+            CHECK(independent[3 * b + 2]);
+        }
+    }
+}
+
+// a chain of n linear equations in 2 n unknowns, with combinations of neighbouring equations
+// added, so rank and dof are known. It is large enough for the sparse path.
+static void test_large_dof()
+{
+    const int n = 400;
+    EquationSystem sys;
+    use_plain_solve(sys);
+    std::vector<ParamPtr> x;
+    for (int i = 0; i < 2 * n; i++)
+    {
+        x.push_back(param("x" + std::to_string(i), 0.01 * i));
+    }
+    sys.add_parameters(x);
+    std::vector<ExprPtr> chain;
+    for (int i = 0; i < n; i++)
+    {
+        chain.push_back(x[i + 1]->expr() - x[i]->expr() - one);
+        sys.add_equation(chain.back());
+    }
+    for (int i = 0; i + 1 < n; i += 4)
+    {
+        sys.add_equation(chain[i] + expr(3.0) * chain[i + 1]);
+    }
+    CHECK((int) sys.source_equations.size() > sys.max_dense_size);
+    const auto& analysis = sys.analyze();
+    CHECK(analysis.rank == n);
+    CHECK(analysis.dof == n);
+    CHECK(analysis.equations == n + n / 4);
+    CHECK((int) analysis.free_params.size() == n);
+    int dof = 0;
+    CHECK(!sys.test_rank(dof));
+    CHECK(dof == n);
+}
+
+// two sketches sharing entities, the one owning their store is destroyed before the other one
+// is updated again
+static void test_store_outlived_by_other_sketch()
+{
+    auto p0 = point("a", 0, 0);
+    auto p1 = point("b", 3, 1);
+    EntityPtr l = std::make_shared<LineE>(*p0, *p1);
+    ConstraintPtr c = std::make_shared<LengthConstraint>(l, 2.0);
+    auto a = std::make_unique<Sketch>();
+    a->add_entity(l);
+    a->add_constraint(c);
+    a->update();
+    auto b = std::make_unique<Sketch>();
+    b->add_entity(l);
+    b->add_constraint(c);
+    b->update();
+    p1->x->set_value(7.0);
+    a->update();
+    b.reset();
+    p1->x->set_value(9.0);
+    a->update();
+    CHECK(a->get_result() == OKAY);
+    CHECK_NEAR(distance(*p0, *p1), 2.0, 1e-9);
+}
+
+static void test_revert_marks_changed()
+{
+    ParamStore store;
+    auto p = param("p", 1.0);
+    auto q = param("q", 2.0);
+    store.adopt(*p);
+    store.adopt(*q);
+    std::vector<ParamPtr> params = { q, p };
+    ParamStoreIndex index;
+    CHECK(index.update(params));
+    double saved[2];
+    index.save(saved);
+    p->set_value(5.0);
+    p->set_changed(false);
+    q->set_changed(false);
+    index.restore(saved);
+    CHECK(p->value() == 1.0);
+    CHECK(q->value() == 2.0);
+    CHECK(p->is_changed());
+    CHECK(!q->is_changed());
+}
+
+static void test_revert_params_marks_changed()
+{
+    EquationSystem sys;
+    auto p = param("p", 1.0);
+    sys.add_parameter(p);
+    sys.add_equation(p->expr() - expr(4.0));
+    sys.update_dirty();
+    sys.store_params();
+    p->set_value(3.0);
+    p->set_changed(false);
+    sys.revert_params();
+    CHECK(p->value() == 1.0);
+    CHECK(p->is_changed());
+}
+
+static void test_duplicate_equation_is_redundant()
+{
+    EquationSystem sys;
+    use_plain_solve(sys);
+    auto x = param("x", 0.0);
+    auto y = param("y", 0.0);
+    sys.add_parameters({ x, y });
+    sys.add_equation(x->expr() + y->expr() - expr(3.0));
+    sys.add_equation(x->expr() + y->expr() - expr(3.0));
+    sys.add_equation(x->expr() - y->expr() - expr(1.0));
+    CHECK(sys.solve() == OKAY);
+    CHECK(sys.get_redundant_equations().size() == 1);
+    CHECK_NEAR(x->value(), 2.0, 1e-9);
+    CHECK_NEAR(y->value(), 1.0, 1e-9);
+}
+
+static void test_implied_equation_is_redundant()
+{
+    EquationSystem sys;
+    use_plain_solve(sys);
+    auto x = param("x", 0.0);
+    auto y = param("y", 0.0);
+    sys.add_parameters({ x, y });
+    sys.add_equation(x->expr() + y->expr() - expr(3.0));
+    sys.add_equation(x->expr() - y->expr() - expr(1.0));
+    sys.add_equation(two * x->expr() - expr(4.0));
+    CHECK(sys.solve() == OKAY);
+    CHECK(sys.get_redundant_equations().size() == 1);
+    CHECK_NEAR(x->value(), 2.0, 1e-9);
+    CHECK_NEAR(y->value(), 1.0, 1e-9);
+}
+
+// y - 2 + x z only depends on y at the start, like y - 1, so it is left out. It doesn't hold
+// once the others converged and is put back, without counting an extra step.
+static void test_redundant_equation_put_back()
+{
+    EquationSystem sys;
+    use_plain_solve(sys);
+    auto x = param("x", 0.0);
+    auto y = param("y", 0.0);
+    auto z = param("z", 0.0);
+    sys.add_parameters({ x, y, z });
+    sys.add_equation(y->expr() - one);
+    sys.add_equation(y->expr() - two + x->expr() * z->expr());
+    sys.add_equation(x->expr() - one);
+    CHECK(sys.solve() == OKAY);
+    CHECK(sys.get_redundant_equations().empty());
+    CHECK(sys.counted_steps == 2);
+    CHECK_NEAR(x->value(), 1.0, 1e-9);
+    CHECK_NEAR(y->value(), 1.0, 1e-9);
+    CHECK_NEAR(z->value(), 1.0, 1e-9);
+}
+
+static void test_redundant_constraints_of_sketch()
+{
+    auto p0 = point("a", 0, 0);
+    auto p1 = point("b", 3, 1);
+    auto l = std::make_shared<LineE>(*p0, *p1);
+    ConstraintPtr c0 = std::make_shared<LengthConstraint>(l, 2.0);
+    ConstraintPtr c1 = std::make_shared<PointsDistanceConstraint>(p0, p1, 2.0);
+    Sketch s;
+    s.add_entity(l);
+    s.add_constraint(c0);
+    s.add_constraint(c1);
+    s.update();
+    CHECK(s.get_result() == OKAY);
+    CHECK(s.get_redundant_constraints().size() == 1);
+    CHECK_NEAR(distance(*p0, *p1), 2.0, 1e-9);
+}
+
+// redundant equations kept in the system, so the sparse path has to handle a singular A * A^T
+static void test_sparse_least_squares_rank_deficient()
+{
+    const int n = 40;
+    std::vector<double> results[2];
+    for (int dense = 0; dense < 2; dense++)
+    {
+        EquationSystem sys;
+        use_plain_solve(sys);
+        sys.remove_redundant = false;
+        sys.max_dense_size = dense ? 1000 : 0;
+        std::vector<ParamPtr> x;
+        for (int i = 0; i < n; i++)
+        {
+            x.push_back(param("x" + std::to_string(i), 0.1 * i));
+        }
+        sys.add_parameters(x);
+        for (int i = 0; i + 2 < n; i += 2)
+        {
+            sys.add_equation(x[i + 2]->expr() - x[i]->expr() - one);
+            // the same equation again, and one implied by the neighbours
+            sys.add_equation(x[i + 2]->expr() - x[i]->expr() - one);
+            sys.add_equation(x[i + 1]->expr() * x[i + 1]->expr() - expr(i + 1.0));
+        }
+        CHECK(sys.solve() == OKAY);
+        for (const auto& p : x)
+        {
+            results[dense].push_back(p->value());
+        }
+        for (int i = 0; i + 2 < n; i += 2)
+        {
+            CHECK_NEAR(x[i + 2]->value() - x[i]->value(), 1.0, 1e-9);
+        }
+    }
+    for (int i = 0; i < n; i++)
+    {
+        CHECK_NEAR(results[0][i], results[1][i], 1e-8);
+    }
+}
+
+static void test_analyze_dof()
+{
+    EquationSystem sys;
+    use_plain_solve(sys);
+    auto x = param("x", 0.0);
+    auto y = param("y", 0.0);
+    auto z = param("z", 0.0);
+    sys.add_parameters({ x, y, z });
+    sys.add_equation(x->expr() + y->expr() - expr(3.0));
+    int dof = 0;
+    CHECK(sys.test_rank(dof));
+    CHECK(dof == 2);
+    CHECK(sys.analyze().free_params.size() == 2);
+
+    sys.add_equation(x->expr() - y->expr() - expr(1.0));
+    // a drag equation doesn't count
+    sys.add_equation(std::make_shared<Expr>(Op::Drag, z->expr(), expr(5.0)));
+    CHECK(sys.test_rank(dof));
+    CHECK(dof == 1);
+    const auto& analysis = sys.analyze();
+    CHECK(analysis.rank == 2);
+    CHECK(analysis.equations == 2);
+    CHECK(analysis.free_params.size() == 1 && analysis.free_params[0] == z);
+
+    // the same constraint again, it doesn't change the dof but the equations are dependent
+    sys.add_equation(two * x->expr() - two * y->expr() - two);
+    CHECK(!sys.test_rank(dof));
+    CHECK(dof == 1);
+    CHECK(sys.analyze().equations == 3);
+}
+
+// two independent components, changing one of them keeps the analysis of the other
+static void test_analyze_incremental()
+{
+    EquationSystem sys;
+    sys.use_substitution = false;
+    sys.use_presolve = false;
+    std::vector<ParamPtr> a, b;
+    for (int i = 0; i < 3; i++)
+    {
+        a.push_back(param("a" + std::to_string(i), 1.0 + i));
+        b.push_back(param("b" + std::to_string(i), 2.0 + i));
+    }
+    sys.add_parameters(a);
+    sys.add_parameters(b);
+    sys.add_equation(a[0]->expr() * a[1]->expr() - a[2]->expr());
+    sys.add_equation(b[0]->expr() * b[0]->expr() + b[1]->expr() * b[1]->expr() - expr(13.0));
+    CHECK(sys.analyze().dof == 4);
+    CHECK(sys.components.size() == 2);
+
+    auto eq = a[0]->expr() + a[1]->expr() - expr(3.0);
+    sys.add_equation(eq);
+    sys.update_dirty();
+    int analyzed = 0;
+    for (const auto& component : sys.components)
+    {
+        analyzed += component->is_analyzed && !component->is_dirty;
+    }
+    CHECK(analyzed == 1);
+    CHECK(sys.analyze().dof == 3);
+
+    sys.remove_equation(eq);
+    CHECK(sys.analyze().dof == 4);
+    sys.add_equation(b[2]->expr() - one);
+    CHECK(sys.analyze().dof == 3);
+    int dof = 0;
+    CHECK(sys.test_rank(dof));
+    CHECK(dof == 3);
+}
+
+// bad handles are reported as std::invalid_argument before anything is added
+static void test_invalid_handles()
+{
+    Sketch s;
+    const double xy[] = { 0, 0, 1, 0, 1, 1 };
+    std::size_t first = s.add_points(xy, 3, 2);
+    CHECK(first == 0);
+    const std::int64_t lines[] = { 0, 1, 1, 5 };
+    bool thrown = false;
+    try
+    {
+        s.add_lines(lines, 2);
+    }
+    catch (const std::invalid_argument& e)
+    {
+        thrown = std::string(e.what()).find("5") != std::string::npos;
+    }
+    CHECK(thrown);
+    CHECK(s.handles.size() == 3);
+
+    const std::int64_t pairs[] = { 0, 1, 1, -1 };
+    const double distances[] = { 1.0, 1.0 };
+    thrown = false;
+    try
+    {
+        s.add_constraints(PointsDistance, pairs, 2, 2, distances);
+    }
+    catch (const std::invalid_argument&)
+    {
+        thrown = true;
+    }
+    CHECK(thrown);
+    CHECK(s.constraints.empty());
+
+    thrown = false;
+    try
+    {
+        s.entity(3);
+    }
+    catch (const std::invalid_argument&)
+    {
+        thrown = true;
+    }
+    CHECK(thrown);
+    CHECK(entity_cast<PointE>(s.entity(2)) != nullptr);
+
+    // the handle of a removed entity is invalid, the others keep theirs
+    s.remove_entity(s.entity(1));
+    thrown = false;
+    try
+    {
+        s.entity(1);
+    }
+    catch (const std::invalid_argument&)
+    {
+        thrown = true;
+    }
+    CHECK(thrown);
+    const std::int64_t kept[] = { 0, 2 };
+    CHECK(s.add_lines(kept, 1) == 3);
+}
+
+static void test_component_results()
+{
+    Sketch s;
+    const double xy[] = { 0, 0, 3, 1, 10, 10, 12, 11 };
+    s.add_points(xy, 4, 2);
+    const std::int64_t pairs[] = { 0, 1, 2, 3 };
+    const double distances[] = { 2.0, 5.0 };
+    s.add_constraints(PointsDistance, pairs, 2, 2, distances);
+    s.update();
+    CHECK(s.get_result() == OKAY);
+    auto results = s.get_component_results();
+    CHECK(results.size() == 2);
+    for (auto r : results)
+    {
+        CHECK(r == OKAY);
+    }
+}
+
+int main()
+{
+    std::vector<std::pair<std::string, std::function<void()>>> tests = {
+        { "tape_gradient", test_tape_gradient },
+        { "substitution", test_substitution },
+        { "presolve", test_presolve },
+        { "incremental_equations", test_incremental_equations },
+        { "incremental_substitution", test_incremental_substitution },
+        { "damped_steps", test_damped_steps },
+        { "irls_step", test_irls_step },
+        { "linear_program_reuse", test_linear_program_reuse },
+        { "tape_products", test_tape_products },
+        { "iterative_solver", test_iterative_solver },
+        { "rejected_chord_step", test_rejected_chord_step },
+        { "store_outlived_by_other_sketch", test_store_outlived_by_other_sketch },
+        { "revert_marks_changed", test_revert_marks_changed },
+        { "revert_params_marks_changed", test_revert_params_marks_changed },
+        { "duplicate_equation_is_redundant", test_duplicate_equation_is_redundant },
+        { "implied_equation_is_redundant", test_implied_equation_is_redundant },
+        { "redundant_equation_put_back", test_redundant_equation_put_back },
+        { "redundant_constraints_of_sketch", test_redundant_constraints_of_sketch },
+        { "sparse_least_squares_rank_deficient", test_sparse_least_squares_rank_deficient },
+        { "analyze_dof", test_analyze_dof },
+        { "analyze_incremental", test_analyze_incremental },
+        { "nearly_dependent_columns", test_nearly_dependent_columns },
+        { "large_dof", test_large_dof },
+        { "invalid_handles", test_invalid_handles },
+        { "component_results", test_component_results },
+    };
+    for (const auto& t : tests)
+    {
+        int before = failures;
+        t.second();
+        std::cout << (failures == before ? "ok     " : "FAILED ") << t.first << std::endl;
+    }
+    return failures == 0 ? 0 : 1;
+}